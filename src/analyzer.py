@@ -45,27 +45,29 @@ def debug_wipes(lines, show_lines=False):
             feed_rates = []
         if not cmd:
             continue
-        elif gcode.is_extrusion_move(cmd):
+        extrusion_move = gcode.is_extrusion_move(cmd)
+        head_move = None if extrusion_move else gcode.is_head_move(cmd)
+        if extrusion_move:
             ## debugging feed rates
-            pos = (gcode.last_match[0], gcode.last_match[1])
+            pos = (extrusion_move[0], extrusion_move[1])
 
             try:
-                last_speed = gcode.last_match[4]
+                last_speed = extrusion_move[4]
             except Exception as e:
                 #print(e)
                 pass
 
             if prev_position:
-                if gcode.last_match[3] < 0:
-                    e_pos += gcode.last_match[3]
+                if extrusion_move[3] < 0:
+                    e_pos += extrusion_move[3]
                     move_type = "wipe"
-                    wipes.append(gcode.last_match[3])
+                    wipes.append(extrusion_move[3])
                 else:
                     move_type = "print"
                     e_pos = 0
                 length = gcode.calculate_path_length(prev_position, pos)
                 if length > 0.1:
-                    _e_pos = gcode.last_match[3]
+                    _e_pos = extrusion_move[3]
                     feed_rate = gcode.calculate_feed_rate(length, _e_pos)
                     feed_rates.append(feed_rate)
                     if show_lines:
@@ -77,15 +79,17 @@ def debug_wipes(lines, show_lines=False):
                             speed = 1/rate*_e_pos
                         print("#%d %.5f %.2f" % (lnr, feed_rate, speed))
             prev_position = pos
-        elif gcode.is_head_move(cmd):
-            prev_position = (gcode.last_match[0], gcode.last_match[1])
+        elif head_move:
+            prev_position = (head_move[0], head_move[1])
             if wipes:
                 wipe_totals.append(sum(wipes))
                 if show_lines:
                     print("#%d wipe total %.1f" % (lnr, sum(wipes)))
                 wipes = []
-        elif gcode.is_extruder_move(cmd):
-            e_pos += gcode.last_match[0]
+        else:
+            extruder_move = gcode.is_extruder_move(cmd)
+            if extruder_move:
+                e_pos += extruder_move[0]
     layer_feed_rates.append(feed_rates)
 
     lnum = 0
@@ -116,22 +120,24 @@ def debug_outer_perimeter(lines):
         if cmd:
             if is_outer:
                 position = None
-                if gcode.is_extrusion_move(cmd):
-                    if gcode.last_match[3] > 0 and gcode.last_match[4] is not None:
-                        speeds.append(gcode.last_match[4])
-                    position = gcode.last_match[0], gcode.last_match[1]
+                extrusion_move = gcode.is_extrusion_move(cmd)
+                if extrusion_move:
+                    if extrusion_move[3] > 0 and extrusion_move[4] is not None:
+                        speeds.append(extrusion_move[4])
+                    position = extrusion_move[0], extrusion_move[1]
 
                 if prev_position and position:
                     length = gcode.calculate_path_length(prev_position, position)
-                    _e_pos = gcode.last_match[3]
+                    _e_pos = extrusion_move[3]
                     if _e_pos > 0:
                         feed_rate = gcode.calculate_feed_rate(length, _e_pos)
                         print(lnr, feed_rate)
                         feed_rates.append(feed_rate)
                 if position:
                     prev_position = position
-            if gcode.is_head_move(cmd):
-                prev_position = (gcode.last_match[0], gcode.last_match[1])
+            head_move = gcode.is_head_move(cmd)
+            if head_move:
+                prev_position = (head_move[0], head_move[1])
     # print(speeds)
     print(max(feed_rates))
     outer_perimeter_speed = sum(speeds) / len(speeds)
@@ -61,34 +61,18 @@ def adjust(lines, x, y, z):
         elif gcode.is_absolute_positioning(cmd):
             absolute = False
             new_lines.append((cmd, comment))
-        elif gcode.is_head_move(cmd):
-            x_pos = gcode.last_match[0]
-            y_pos = gcode.last_match[1]
-            speed = gcode.last_match[2]
-
-            x_dir, new_x_pos = check_backlash(x, prev_x, x_pos, x_dir)
-            prev_x = x_pos
-
-            y_dir, new_y_pos = check_backlash(y, prev_y, y_pos, y_dir)
-            prev_y = y_pos
+        else:
+            head_move = gcode.is_head_move(cmd)
+            if head_move:
+                x_pos = head_move[0]
+                y_pos = head_move[1]
 
+                x_dir, new_x_pos = check_backlash(x, prev_x, x_pos, x_dir)
+                prev_x = x_pos
 
+                y_dir, new_y_pos = check_backlash(y, prev_y, y_pos, y_dir)
+                prev_y = y_pos
 
-            new_lines.append((cmd, comment))
-        # elif not skip and gcode.is_extrusion_move(cmd):
-        #     new_x = gcode.last_match[0] + x
-        #     new_y = gcode.last_match[1] + y
-        #     e_length = gcode.last_match[2]
-        #     new_cmd = gcode.gen_extrusion_move(new_x, new_y, e_length)
-        #     new_lines.append((new_cmd, comment))
-        # elif not skip and gcode.is_extrusion_speed_move(cmd):
-        #     new_x = gcode.last_match[0] + x
-        #     new_y = gcode.last_match[1] + y
-        #     e_length = gcode.last_match[2]
-        #     speed = gcode.last_match[3]
-        #     new_cmd = gcode.gen_extrusion_speed_move(new_x, new_y, speed, e_length)
-        #     new_lines.append((new_cmd, comment))
-        else:
             new_lines.append((cmd, comment))
 
     return new_lines
@@ -0,0 +1,112 @@
+import concurrent.futures
+import glob
+import logging
+import os
+import time
+
+from slicers import detect_file_type
+
+# processed files get this suffix, they are skipped when looking for files to process
+OUTPUT_SUFFIX = "_fs"
+
+
+class FileResult:
+    """
+    Processing result of one file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.new_file = None
+        self.wall_time = 0
+        self.lines = 0
+        self.tool_changes = 0
+        self.tool_changes_saved = 0
+        self.error = None
+
+
+def find_files(target):
+    """
+    Find g-code files to process
+    :param target: directory or glob pattern
+    :return: sorted list of file paths
+    """
+    if os.path.isdir(target):
+        files = glob.glob(os.path.join(target, "*.gcode"))
+    else:
+        files = glob.glob(target)
+    return sorted(f for f in files if os.path.isfile(f) and not os.path.splitext(f)[0].endswith(OUTPUT_SUFFIX))
+
+
+def process_file(path, settings):
+    """
+    Detect file type and process file. Run in worker process, errors are returned in the result
+    :param path: g-code file path
+    :param settings: Settings object
+    :return: FileResult
+    """
+    log = logging.getLogger("filaswitch.batch.%d" % os.getpid())
+    if not log.handlers:
+        # per file messages would be interleaved, summary table reports the errors
+        log.addHandler(logging.NullHandler())
+        log.propagate = False
+
+    result = FileResult(path)
+    start = time.perf_counter()
+    try:
+        print_type = detect_file_type(path, log)
+        if not print_type:
+            raise ValueError("No supported gcode file detected")
+        pf = print_type(log, settings)
+        new_file = pf.process(path)
+        if new_file == 1:
+            raise IOError("Could not save file")
+        result.new_file = new_file
+        result.lines = sum(layer.source_line_count for layer in pf.layers)
+        result.tool_changes = sum(layer.tool_change_count for layer in pf.layers)
+        result.tool_changes_saved = pf.tool_changes_saved
+    except Exception as e:
+        result.error = "%s: %s" % (type(e).__name__, e)
+    result.wall_time = time.perf_counter() - start
+    return result
+
+
+def run_batch(files, settings, jobs=None):
+    """
+    Process files in a process pool
+    :param files: g-code file paths
+    :param settings: Settings object, shared by all files
+    :param jobs: number of worker processes, CPU count by default
+    :return: list of FileResult in file order
+    """
+    if not files:
+        return []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_file, path, settings) for path in files]
+        return [f.result() for f in futures]
+
+
+def format_summary(results, wall_time=None):
+    """
+    Format summary table of batch results
+    :param results: list of FileResult
+    :param wall_time: total wall time of the batch
+    :return: list of table lines
+    """
+    name_width = max([len("File")] + [len(os.path.basename(r.path)) for r in results])
+    row = "{:<%d}  {:>8}  {:>10}  {:>12}  {:>5}  {}" % name_width
+    lines = [row.format("File", "Time (s)", "Lines", "Tool changes", "Saved", "Result")]
+    failed = 0
+    for r in results:
+        if r.error:
+            failed += 1
+            status = "FAILED " + r.error
+        else:
+            status = os.path.basename(r.new_file)
+        lines.append(row.format(os.path.basename(r.path), "%.2f" % r.wall_time, r.lines, r.tool_changes,
+                                r.tool_changes_saved, status))
+    total = "%d files, %d failed" % (len(results), failed)
+    if wall_time is not None:
+        total += ", total time %.2f s" % wall_time
+    lines.append(total)
+    return lines
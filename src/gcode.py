@@ -18,13 +18,10 @@ TYPE_DELTA = 1
 
 class GCode:
 
-    MOVE_RE = re.compile(b"^G0\s+|^G1\s+")
-    X_COORD_RE = re.compile(b".*\s+X([-]*\d+\.*\d*)")
-    Y_COORD_RE = re.compile(b".*\s+Y([-]*\d+\.*\d*)")
-    E_COORD_RE = re.compile(b".*\s+E([-]*\d+\.*\d*)")
-    Z_COORD_RE = re.compile(b".*\s+Z([-]*\d+\.*\d*)")
-
-    SPEED_VAL_RE = re.compile(b".*\s+F(\d+\.*\d*)")
+    # move commands and the axis words parsed from them. Axis index is the position in the
+    # (x, y, z, e, speed) tuple returned by _parse_move_args
+    MOVE_OPCODES = (b"G0", b"G1")
+    MOVE_AXES = {b"X": 0, b"Y": 1, b"Z": 2, b"E": 3, b"F": 4}
 
     #SPEED_RE = re.compile(b"^G1\s+F(\d+\.*\d*)$")
 
@@ -40,9 +37,6 @@ class GCode:
     PRESSURE_ADVANCE_RE = re.compile(b"M572\s+D([:0-9]+)\s+S(\d.*\d+)")
     FAN_SPEED_RE = re.compile(b"M106\s+S(\d+)")
 
-    def __init__(self):
-        self.last_match = None
-
     @staticmethod
     def read_gcode_line(line):
         """
@@ -95,202 +89,202 @@ class GCode:
         rate = extrusion_length / path_len
         return rate
 
-    def is_tool_change(self, line):
+    @classmethod
+    def is_tool_change(cls, line):
         """
         Match given line against tool change regex
         :param line: g-code line
         :return: None or tool number
         """
-        self.last_match = None
-        m = self.TOOL_RE.match(line)
+        m = cls.TOOL_RE.match(line)
         if m:
-            self.last_match = int(m.groups()[0])
-        return self.last_match
+            return int(m.groups()[0])
+        return None
 
-    def is_extrusion_move(self, line):
+    @classmethod
+    def is_extrusion_move(cls, line):
         """
         Match given line against extrusion move regex
         :param line: g-code line
         :return: None or tuple with X, Y and E positions
         """
-        self.last_match = None
-        m = self._parse_move_args(line)
+        m = cls._parse_move_args(line)
         if m and (m[0] is not None or m[1] is not None) and m[3] is not None and m[3] != 0:
-            self.last_match = m
-        return self.last_match
-
-    def _parse_move_args(self, line):
-
-        self.last_match = None
-        m = self.MOVE_RE.match(line)
-        if m:
-            x = None
-            y = None
-            z = None
-            e = None
-            speed = None
-
-            m = self.X_COORD_RE.match(line)
-            if m:
-                x = float(m.groups()[0])
-
-            m = self.Y_COORD_RE.match(line)
-            if m:
-                y = float(m.groups()[0])
+            return m
+        return None
 
-            m = self.Z_COORD_RE.match(line)
-            if m:
-                z = float(m.groups()[0])
-
-            m = self.E_COORD_RE.match(line)
-            if m:
-                e = float(m.groups()[0])
+    @classmethod
+    def _parse_move_args(cls, line):
+        """
+        Tokenize G0/G1 line in a single pass. Axis words can be in any order.
+        :param line: g-code line
+        :return: None or tuple with X, Y, Z, E and speed values (None if not given)
+        """
+        if len(line) < 3:
+            return None
+        return cls.parse_move_words(line.split())
 
-            m = self.SPEED_VAL_RE.match(line)
-            if m:
-                speed = float(m.groups()[0])
+    @classmethod
+    def parse_move_words(cls, words):
+        """
+        Parse axis words of a split G0/G1 command
+        :param words: command split to words
+        :return: None or tuple with X, Y, Z, E and speed values (None if not given)
+        """
+        if not words or words[0] not in cls.MOVE_OPCODES:
+            return None
 
-            return x, y, z, e, speed
+        args = [None, None, None, None, None]
+        axes = cls.MOVE_AXES
+        for word in words[1:]:
+            i = axes.get(word[:1])
+            if i is None:
+                continue
+            try:
+                args[i] = float(word[1:])
+            except ValueError:
+                pass
+        return tuple(args)
 
-    def is_z_move(self, line):
+    @classmethod
+    def is_z_move(cls, line):
         """
         Match given line against z move regex
         :param line: g-code line
         :return: None or z value
         """
-        self.last_match = None
-        m = self._parse_move_args(line)
+        m = cls._parse_move_args(line)
         if m and m[0] is None and m[1] is None and m[2] is not None:
-            self.last_match = (m[2], m[4])
-        return self.last_match
+            return (m[2], m[4])
+        return None
 
-    def is_extruder_move(self, line):
+    @classmethod
+    def is_extruder_move(cls, line):
         """
         Match given line against extruder move regex
         :param line: g-code line
         :return: None or extruder position and speed
         """
-        self.last_match = None
-        m = self._parse_move_args(line)
+        m = cls._parse_move_args(line)
         if m and m[0] is None and m[1] is None and m[2] is None and m[3] is not None:
-            self.last_match = (m[3], m[4])
-        return self.last_match
+            return (m[3], m[4])
+        return None
 
-    def is_head_move(self, line):
+    @classmethod
+    def is_head_move(cls, line):
         """
         Match given line against heade move regex
         :param line: g-code line
         :return: None or head position and speed
         """
-        self.last_match = None
-        m = self._parse_move_args(line)
+        m = cls._parse_move_args(line)
         if m and (m[0] is not None or m[1] is not None) and (m[3] is None or m[3] == 0):
-            self.last_match = (m[0], m[1], m[2], m[4])
-        return self.last_match
+            return (m[0], m[1], m[2], m[4])
+        return None
 
-    def is_relative_positioning(self, line):
+    @classmethod
+    def is_relative_positioning(cls, line):
         """
         Match given line against relative positioning regex
         :param line: g-code line
         :return: boolean
         """
-        self.last_match = None
-        m = self.RELATIVE_POSITIONING_RE.match(line)
+        m = cls.RELATIVE_POSITIONING_RE.match(line)
         return m is not None
 
-    def is_absolute_positioning(self, line):
+    @classmethod
+    def is_absolute_positioning(cls, line):
         """
         Match given line against absolute positioning regex
         :param line: g-code line
         :return: boolean
         """
-        self.last_match = None
-        m = self.ABSOLUTE_POSITIONING_RE.match(line)
+        m = cls.ABSOLUTE_POSITIONING_RE.match(line)
         return m is not None
 
-    def is_temp_nowait(self, line):
+    @classmethod
+    def is_temp_nowait(cls, line):
         """
         Match given line against temperature change no wait regex
         :param line: g-code line
         :return: boolean
         """
-        self.last_match = None
-        m = self.TEMP_NOWAIT_RE.match(line)
+        m = cls.TEMP_NOWAIT_RE.match(line)
         if m:
-            self.last_match = int(m.groups()[0])
-        return self.last_match
+            return int(m.groups()[0])
+        return None
 
-    def is_temp_nowait_tool(self, line):
+    @classmethod
+    def is_temp_nowait_tool(cls, line):
         """
         Match given line against temperature change no wait tool regex
         :param line: g-code line
         :return: boolean
         """
-        self.last_match = None
-        m = self.TEMP_NOWAIT_TOOL_RE.match(line)
+        m = cls.TEMP_NOWAIT_TOOL_RE.match(line)
         if m:
-            self.last_match = int(m.groups()[0]), int(m.groups()[1])
-        return self.last_match
+            return int(m.groups()[0]), int(m.groups()[1])
+        return None
 
-    def is_temp_wait(self, line):
+    @classmethod
+    def is_temp_wait(cls, line):
         """
         Match given line against temperature change wait regex
         :param line: g-code line
         :return: boolean
         """
-        self.last_match = None
-        m = self.TEMP_WAIT_RE.match(line)
+        m = cls.TEMP_WAIT_RE.match(line)
         if m:
-            self.last_match = int(m.groups()[0])
-        return self.last_match
+            return int(m.groups()[0])
+        return None
 
-    def is_temp_wait_tool(self, line):
+    @classmethod
+    def is_temp_wait_tool(cls, line):
         """
         Match given line against temperature change wait tool regex
         :param line: g-code line
         :return: boolean
         """
-        self.last_match = None
-        m = self.TEMP_WAIT_TOOL_RE.match(line)
+        m = cls.TEMP_WAIT_TOOL_RE.match(line)
         if m:
-            self.last_match = int(m.groups()[0]), int(m.groups()[1])
-        return self.last_match
+            return int(m.groups()[0]), int(m.groups()[1])
+        return None
 
-    def is_lin_advance(self, line):
+    @classmethod
+    def is_lin_advance(cls, line):
         """
         Match given line against linear advance regex
         :param line: g-code line
         :return: K value or none
         """
-        self.last_match = None
-        m = self.LIN_ADVANCE_RE.match(line)
+        m = cls.LIN_ADVANCE_RE.match(line)
         if m:
-            self.last_match = float(m.groups()[0])
-        return self.last_match
+            return float(m.groups()[0])
+        return None
 
-    def is_pressure_advance(self, line):
+    @classmethod
+    def is_pressure_advance(cls, line):
         """
         Match given line against pressure advance regex
         :param line: g-code line
         :return: D and S value tuple or None
         """
-        self.last_match = None
-        m = self.PRESSURE_ADVANCE_RE.match(line)
+        m = cls.PRESSURE_ADVANCE_RE.match(line)
         if m:
-            self.last_match = m.groups()[0], float(m.groups()[1])
-        return self.last_match
+            return m.groups()[0], float(m.groups()[1])
+        return None
 
-    def is_fan_speed(self, line):
+    @classmethod
+    def is_fan_speed(cls, line):
         """
         Match given line against fan speed regex
         :param line: g-code line
         :return: K value or none
         """
-        self.last_match = None
-        m = self.FAN_SPEED_RE.match(line)
+        m = cls.FAN_SPEED_RE.match(line)
         if m:
-            self.last_match = int(m.groups()[0])
-        return self.last_match
+            return int(m.groups()[0])
+        return None
 
     @staticmethod
     def gen_lin_advance(k_val):
@@ -534,6 +528,16 @@ class GCode:
         """
         return b"M83"
 
+    @staticmethod
+    def gen_progress(percent, minutes):
+        """
+        Generate g-code line for print progress
+        :param percent: percent done
+        :param minutes: remaining time in minutes
+        :return: byte string
+        """
+        return "M73 P{} R{}".format(percent, minutes).encode()
+
     @staticmethod
     def _get_coordinates(direction, length):
         """
@@ -603,10 +607,14 @@ class GCode:
 
         if start_x == 0 and start_y == 0:
             return start_x, start_y
+        elif direction == 0 and (offset_x == 0 or offset_y == 0):
+            return start_x + offset_x, start_y + offset_y
         elif offset_x == 0:
-            return start_x, start_y + offset_y
+            x, y = self._get_coordinates(direction + 90, offset_y)
+            return start_x + x, start_y + y
         elif offset_y == 0:
-            return start_x + offset_x, start_y
+            x, y = self._get_coordinates(direction, offset_x)
+            return start_x + x, start_y + y
 
         length = math.sqrt(offset_x ** 2 + offset_y ** 2)
 
@@ -647,3 +655,84 @@ class GCode:
         if direction >= 180:
             return direction - 180
         return direction + 180
+
+
+class GCodeLine:
+    """
+    G-code line parsed once to opcode and move values. Original command and comment are kept as is,
+    line is turned back to bytes only when saving.
+    Tool change lines get opcode b"T" and the tool number in 'tool'
+    """
+
+    __slots__ = ("cmd", "comment", "opcode", "x", "y", "z", "e", "f", "tool")
+
+    def __init__(self, cmd, comment=None):
+        self.cmd = cmd
+        self.comment = comment
+        self.opcode = None
+        self.x = None
+        self.y = None
+        self.z = None
+        self.e = None
+        self.f = None
+        self.tool = None
+
+        if not cmd:
+            return
+        words = cmd.split()
+        if not words:
+            return
+        opcode = words[0]
+        if opcode in GCode.MOVE_OPCODES:
+            self.opcode = opcode
+            if len(cmd) >= 3:
+                self.x, self.y, self.z, self.e, self.f = GCode.parse_move_words(words)
+        else:
+            m = GCode.TOOL_RE.match(cmd)
+            if m:
+                self.opcode = b"T"
+                self.tool = int(m.groups()[0])
+            else:
+                self.opcode = opcode
+
+    def extrusion_move(self):
+        """
+        Check if line is an extrusion move
+        :return: None or tuple with X, Y, Z, E and speed values
+        """
+        if (self.x is not None or self.y is not None) and self.e:
+            return self.x, self.y, self.z, self.e, self.f
+
+    def head_move(self):
+        """
+        Check if line is a head move (no extrusion)
+        :return: None or tuple with X, Y, Z and speed values
+        """
+        if (self.x is not None or self.y is not None) and not self.e:
+            return self.x, self.y, self.z, self.f
+
+    def z_move(self):
+        """
+        Check if line is a z move
+        :return: None or tuple with Z and speed values
+        """
+        if self.x is None and self.y is None and self.z is not None:
+            return self.z, self.f
+
+    def extruder_move(self):
+        """
+        Check if line is an extruder only move
+        :return: None or tuple with E and speed values
+        """
+        if self.x is None and self.y is None and self.z is None and self.e is not None:
+            return self.e, self.f
+
+    def to_bytes(self):
+        """
+        Format line back to byte string
+        :return: byte string
+        """
+        return GCode.format_to_string(self.cmd, self.comment)
+
+    def __repr__(self):
+        return "GCodeLine(%r, %r)" % (self.cmd, self.comment)
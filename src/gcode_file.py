@@ -1,8 +1,14 @@
+import collections
+import itertools
 import os
 
-from gcode import GCode
-from layer import Layer, FirstLayer, ACT_PASS, ACT_INFILL, ACT_SWITCH
+from gcode import GCode, GCodeLine
+from gcode_io import GCodeReader, GCodeWriter
+from parse_cache import ParseCache, file_hash
+from layer import Layer, FirstLayer, LineIndex, ACT_PASS, ACT_INFILL, ACT_SWITCH
 from switch_tower import SwitchTower
+from time_estimator import TimeEstimator, add_progress
+import tool_order
 from preprime import PrePrime
 from settings import Settings
 
@@ -14,6 +20,45 @@ SLICER_SIMPLIFY3D = "Simplify3d"
 SLICER_SLIC3R = "Slic3r"
 SLICER_PRUSA_SLIC3R = "PrusaSlic3r"
 
+# settings read from the g-code file, stored to parse cache
+PARSED_SETTINGS = ("machine_type", "stroke_x", "stroke_y", "origin_offset_x", "origin_offset_y", "z_offset",
+                   "extrusion_width", "linear_advance", "pressure_advance", "default_speed", "travel_xy_speed",
+                   "travel_z_speed", "outer_perimeter_speed", "first_layer_speed")
+# attributes that are not part of parse results
+NOT_CACHED = ("log", "settings", "gcode_file", "stream", "preprime", "_handlers", "parse_cache", "cache_key")
+
+
+class ToolChangeState:
+    """
+    State carried through the tool change processing loop
+    """
+    __slots__ = ("e_pos", "is_tool_change", "z_move_needed", "prime_needed", "prime_ok", "last_pos", "fan_speed")
+
+    def __init__(self):
+        self.e_pos = 0
+        self.is_tool_change = False
+        # flag to indicate if z-move is needed after tower g-code
+        self.z_move_needed = False
+        # flag to indicate if prime is needed after purge tower g-code
+        self.prime_needed = False
+        # flag for post-tower prime
+        self.prime_ok = False
+        # Keep track of last X, Y position
+        self.last_pos = None
+        self.fan_speed = 0
+
+    def update_retract_position(self, change):
+        """
+        Update E position value. In case of negative value we want to have
+        cumulative status to understand how much retraction is done. In case of positive
+        value we don't care, so 0 is ok.
+        :param change: extruder position change
+        :return: none
+        """
+        self.e_pos += change
+        if self.e_pos > -0.00001:
+            self.e_pos = 0
+
 
 class GCodeFile:
     slicer_type = None
@@ -50,6 +95,12 @@ class GCodeFile:
         # max slots needed
         self.max_slots = None
 
+        # tool changes removed by tool order optimization
+        self.tool_changes_saved = 0
+
+        # estimated print time of the new file
+        self.print_time = None
+
         # preprime handler
         self.preprime = None
 
@@ -62,6 +113,25 @@ class GCodeFile:
         # Slicer version
         self.version = None
 
+        # slicer config block, read in parse_header
+        self.config = None
+
+        # cache of parse results, used when cache dir is set
+        self.parse_cache = None
+        self.cache_key = None
+
+        # streaming mode, layers are processed and written one by one
+        self.stream = settings.stream
+
+        # tool change processing state, set when tool change g-code is added
+        self.tool_change_state = None
+        self._handlers = {
+            b"G0": self._handle_move,
+            b"G1": self._handle_move,
+            b"M106": self._handle_fan_speed,
+            b"T": self._handle_tool_change,
+        }
+
     def parse_header(self):
         """
         Parse header of gcode file, if any.
@@ -74,36 +144,47 @@ class GCodeFile:
         """ Parse print settings """
 
         # find start script end
-        is_tool_change = False
-        for cmd, comment, index in self.layers[0].read_lines():
-            if comment and comment.strip() == b"START SCRIPT END":
-                self.layers[0].start_gcode_end = index
-                self.pr_index = index
-                break
+        start_script_end = self.layers[0].offsets.first(LineIndex.START_SCRIPT_END)
+        if start_script_end is not None:
+            self.layers[0].start_gcode_end = start_script_end
+            self.pr_index = start_script_end
 
+        if self.settings.optimize_tool_order:
+            self.optimize_tool_order()
+
+        prev_layer = None
         for layer in self.layers:
-            for cmd, comment, index in layer.read_lines():
-                # find valid tool changes
-                if comment and comment.strip() == b"TOOL CHANGE":
-                    first_layer = isinstance(layer, FirstLayer)
-                    if first_layer and index < layer.start_gcode_end:
-                        continue
-                    is_tool_change = True
-
-                elif cmd:
-                    # find linear advance commands
-                    if is_tool_change and gcode.is_tool_change(cmd) is not None:
-                        # add unique tools to list
-                        if gcode.last_match not in self.tools:
-                            self.tools.append(gcode.last_match)
-                        self.tool_switch_heights[gcode.last_match] = layer.z
-                    elif gcode.is_lin_advance(cmd) and gcode.last_match != 0:
-                        self.settings.linear_advance = gcode.last_match
-                    elif gcode.is_pressure_advance(cmd) and gcode.last_match != 0:
-                        self.settings.pressure_advance = gcode.last_match
-                    is_tool_change = False
+            # find valid tool changes, i.e. tool change commands right after TOOL CHANGE comment
+            for index in layer.offsets.get(b"T"):
+                line = layer.lines[index]
+                if line.comment and line.comment.strip() == b"TOOL CHANGE":
+                    continue
+                if index:
+                    comment_layer, comment_index = layer, index - 1
+                elif prev_layer is not None and len(prev_layer.lines):
+                    comment_layer, comment_index = prev_layer, len(prev_layer.lines) - 1
                 else:
-                    is_tool_change = False
+                    continue
+                comment = comment_layer.lines[comment_index].comment
+                if not comment or comment.strip() != b"TOOL CHANGE":
+                    continue
+                if isinstance(comment_layer, FirstLayer) and comment_index < comment_layer.start_gcode_end:
+                    continue
+                # add unique tools to list
+                if line.tool not in self.tools:
+                    self.tools.append(line.tool)
+                self.tool_switch_heights[line.tool] = layer.z
+
+            # find linear advance commands
+            for index in layer.offsets.get(b"M900"):
+                k_val = gcode.is_lin_advance(layer.lines[index].cmd)
+                if k_val:
+                    self.settings.linear_advance = k_val
+            for index in layer.offsets.get(b"M572"):
+                pressure_advance = gcode.is_pressure_advance(layer.lines[index].cmd)
+                if pressure_advance:
+                    self.settings.pressure_advance = pressure_advance
+            prev_layer = layer
 
         if not self.layers[0].start_gcode_end:
             raise ValueError("Cannot find 'START SCRIPT END'-comment. Please add it to your Slicer's config")
@@ -112,12 +193,10 @@ class GCodeFile:
             self.last_switch_height = max(self.tool_switch_heights.values())
 
         # prerun prime handling
-        if self.settings.get_hw_config_value("prerun.prime") == "True":
+        if self.settings.hw.prerun_prime:
             self.log.debug("Preprime enabled")
             self.preprime = PrePrime(self.log, self.settings, self.max_slots, self.extruders, self.tools)
-            for line in self.preprime.get_prime_lines():
-                if line:
-                    self.pr_index += self.layers[0].insert_line(self.pr_index, line[0], line[1])
+            self.pr_index += self.layers[0].insert_lines(self.pr_index, self.preprime.get_prime_lines())
             self.active_e = self.preprime.last_extruder
             self.layers[0].start_gcode_end = self.pr_index
         else:
@@ -126,69 +205,214 @@ class GCodeFile:
 
         # find first tool change and remove it if it's before any print moves. No need to
         # do tool change here
-        for cmd, comment, index in self.layers[0].read_lines():
-            if not cmd or index <= self.layers[0].start_gcode_end:
+        for index, line in enumerate(self.layers[0].lines):
+            if not line.cmd or index <= self.layers[0].start_gcode_end:
                 continue
-            if gcode.is_tool_change(cmd) is not None:
-                if self.settings.get_hw_config_value("prerun.prime") == "True" or gcode.last_match == 0:
-                    self.log.debug("Remove first tool change: {}".format(gcode.last_match))
+            if line.tool is not None:
+                if self.settings.hw.prerun_prime or line.tool == 0:
+                    self.log.debug("Remove first tool change: {}".format(line.tool))
                     self.layers[0].delete_line(index)
                 break
-            elif gcode.is_extrusion_move(cmd):
+            elif line.extrusion_move():
                 # if print move before tool change, bail out. Tool change cannot be removed
                 break
 
         # update extruder coasting value
+        coasting = self.settings.hw.post_tower_coast
+        if coasting:
+            for e in self.extruders:
+                self.extruders[e].coasting += coasting
+
+    def optimize_tool_order(self):
+        """
+        Reorder the tools of each layer so that fewer tool changes are needed
+        :return: none
+        """
+        before, after = tool_order.optimize_tool_order(self.layers)
+        self.tool_changes_saved = before - after
+        self.log.info("Tool order optimized, {} tool changes instead of {}".format(after, before))
+
+    def load_parsed(self, gcode_file):
+        """
+        Load the state after parse_print_settings from cache. Cache is not used in streaming mode
+        :param gcode_file: g-code file path
+        :return: true if state was loaded
+        """
+        self.gcode_file = gcode_file
+        if not self.settings.cache_dir or self.stream:
+            return False
+        self.parse_cache = ParseCache(self.settings.cache_dir, self.settings.cache_size)
+        hw_config = self.settings.hw_configurations.get(self.settings.hw_config, {})
+        self.cache_key = ParseCache.make_key(type(self).__name__, file_hash(gcode_file), self.settings.hw_config,
+                                             sorted(hw_config.items()), self.settings.brim_auto,
+                                             self.settings.optimize_tool_order)
+        state = self.parse_cache.load(self.cache_key)
+        if state is None:
+            return False
+        parsed_settings, attributes = state
+        for name, value in parsed_settings.items():
+            setattr(self.settings, name, value)
+        self.__dict__.update(attributes)
+        self.log.info("Using cached parse results for %s" % gcode_file)
+        return True
+
+    def store_parsed(self):
+        """
+        Store the state after parse_print_settings to cache
+        :return: none
+        """
+        if self.parse_cache is None:
+            return
+        parsed_settings = {name: getattr(self.settings, name) for name in PARSED_SETTINGS}
+        if self.settings.brim_auto:
+            # brim is read from slicer settings
+            parsed_settings["brim"] = self.settings.brim
+        attributes = {name: value for name, value in vars(self).items() if name not in NOT_CACHED}
         try:
-            coasting = self.settings.get_hw_config_float_value("post.tower.coast")
-            if coasting:
-                for e in self.extruders:
-                    self.extruders[e].coasting += coasting
-        except TypeError:
-            pass
+            self.parse_cache.store(self.cache_key, (parsed_settings, attributes))
+        except Exception as e:
+            self.log.warning("Could not store parse results to cache: %s" % e)
 
     def open_file(self, gcode_file):
-        """ Read given g-code file into list """
+        """ Read given g-code file into layers """
         self.gcode_file = gcode_file
-        # open file
+        # lines are read from memory mapped file without extra EOL and empty lines. In streaming mode
+        # only a summary of the layers is kept in memory, lines are read again when saving
         try:
-            gf = open(gcode_file, 'rb')
+            lines = GCodeReader(gcode_file)
+            # file is mapped on iteration, read first line to catch open and mmap errors here
+            next(iter(lines), None)
         except Exception as e:
             self.log.exception("Cannot open file %s" % gcode_file)
             return 1
 
-        # remove extra EOL and empty lines
-        lines = [l.strip() for l in gf.readlines() if l.strip()]
-        gf.close()
         self.parse_version(lines)
+        if self.stream and self.settings.optimize_tool_order:
+            self.log.info("Tool order optimization needs the whole file, reading it to memory")
+            self.stream = False
+        elif self.stream and not self.can_stream(lines):
+            self.log.info("File cannot be processed in streaming mode, reading it to memory")
+            self.stream = False
         self.parse_layers(lines)
 
+    def can_stream(self, lines):
+        """
+        Check if file can be processed in streaming mode. Override in slicer specific code
+        :param lines: lines from gcode file
+        :return: true or false
+        """
+        return True
+
+    @staticmethod
+    def read_config_comments(lines):
+        """
+        Read comments of slicer config block. Block ends at first command line
+        :param lines: GCodeLine objects in reading order
+        :return: generator of comments
+        """
+        for line in lines:
+            if line.cmd:
+                return
+            if line.comment is not None:
+                yield line.comment
+
+    def new_layer(self, num, z, height):
+        """
+        Create layer object for parse_layers. In streaming mode only a summary of the layer is stored
+        :param num: layer number
+        :param z: layer z position
+        :param height: layer height
+        :return: Layer
+        """
+        layer = Layer(num, z, height)
+        layer.summary = self.stream
+        return layer
+
     def read_all_lines(self):
         """
         Read lines from all layers
-        :return: list of lines
+        :return: generator of byte strings
         """
-        lines = self.add_tool_change_gcode_post()
-        for line in lines:
-            yield gcode.format_to_string(*line)
+        for line in self.add_tool_change_gcode_post():
+            yield line.to_bytes()
 
     def save_new_file(self):
         """
         Save g-code lines into new file
         :return: new file path
         """
-        #self.remove_comments()
         _dir, f_name = os.path.split(self.gcode_file)
         name, ext = os.path.splitext(f_name)
         new_file = os.path.join(_dir,  name + "_fs" + ext)
+        if self.stream:
+            try:
+                with open(new_file, "wb") as nf:
+                    self.write_layers(nf)
+            except Exception:
+                # tool changes are added while writing, don't leave a partial file behind
+                if os.path.exists(new_file):
+                    os.remove(new_file)
+                raise
+            self.estimate_print_time(new_file)
+            return new_file
+
         try:
             with open(new_file, "wb") as nf:
-                result = b"\r\n".join(self.read_all_lines())
-                nf.write(result)
-                return new_file
+                writer = GCodeWriter(nf)
+                writer.write_lines(self.add_tool_change_gcode_post())
+                writer.close()
         except Exception as e:
             self.log.exception("Could not save file, error: %s" % e)
             return 1
+        self.estimate_print_time(new_file)
+        return new_file
+
+    def estimate_print_time(self, new_file):
+        """
+        Estimate print time of the new file and log the time used by the tower. Add M73 progress lines if
+        enabled
+        :param new_file: new file path
+        :return: none
+        """
+        if not self.settings.estimate_time and not self.settings.m73_progress:
+            return
+        estimator = TimeEstimator(self.settings.hw)
+        estimator.read_file(new_file)
+        self.print_time = estimator.total_time
+        for line in estimator.format_report():
+            self.log.info(line)
+        if self.settings.m73_progress:
+            add_progress(new_file, estimator.total_time, self.settings.hw)
+
+    def write_layers(self, output):
+        """
+        Streaming mode second pass: add tool change g-code to layers and write them to file
+        :param output: binary file object
+        :return: none
+        """
+        writer = GCodeWriter(output)
+        writer.write_lines(self.add_tool_change_gcode_post(self.stream_layer_lines()))
+        writer.close()
+
+    def stream_layer_lines(self):
+        """
+        Read full lines of each layer again and add tool change g-code. Only one layer is kept in memory
+        at a time.
+        :return: generator of GCodeLine objects
+        """
+        lines = iter(GCodeReader(self.gcode_file))
+        for layer in self.layers:
+            layer_lines = itertools.islice(lines, layer.source_line_count)
+            if layer.summary:
+                layer.load_lines(layer_lines)
+            else:
+                # already in memory
+                collections.deque(layer_lines, maxlen=0)
+            if self.tool_change_state:
+                self.add_layer_tool_change_gcode(layer)
+            for line in layer.lines:
+                yield line
+            layer.release_lines()
 
     def get_extruders(self):
         """ Implement this in slicer specific implementation"""
@@ -215,218 +439,270 @@ class GCodeFile:
         :return:
         """
         self.switch_tower = SwitchTower(self.log, self.settings, self.max_slots, self.min_layer_h)
-        x = []
-        y = []
-
+        bounds = []
         for layer in self.layers:
-            index = 0
-            for cmd, _ in layer.lines:
-                if not cmd or (isinstance(layer, FirstLayer) and index < layer.start_gcode_end):
-                    continue
-                if layer.z > self.last_switch_height:
-                    break
-                if gcode.is_extrusion_move(cmd):
-                    if gcode.last_match[0] is not None:
-                        x.append(gcode.last_match[0])
-                    if gcode.last_match[1] is not None:
-                        y.append(gcode.last_match[1])
-                index += 1
+            if layer.z > self.last_switch_height:
+                continue
+            if isinstance(layer, FirstLayer) and layer.start_gcode_end:
+                # start g-code and skirt are left out of the print area
+                continue
+            bounds.append(layer.extrusion_bounds())
 
-        x_max = max(x)
-        y_max = max(y)
-        x_min = min(x)
-        y_min = min(y)
+        x_max = max(b[0] for b in bounds if b[0] is not None)
+        x_min = min(b[1] for b in bounds if b[1] is not None)
+        y_max = max(b[2] for b in bounds if b[2] is not None)
+        y_min = min(b[3] for b in bounds if b[3] is not None)
         self.log.debug("Xmax: %s, Ymax: %s, Xmin: %s, Ymin: %s" % (x_max, y_max, x_min, y_min))
 
-        self.switch_tower.find_tower_position(x_max, x_min, y_max, y_min)
+        self.switch_tower.find_tower_position(x_max, x_min, y_max, y_min, self.fill_occupancy_grid)
+
+    def tower_area_layers(self):
+        """
+        Get lines of the layers that are under the tower top. In streaming mode the lines are read
+        again from the file
+        :return: generator of layer, lines tuples
+        """
+        reader = iter(GCodeReader(self.gcode_file)) if self.stream else None
+        for layer in self.layers:
+            if reader is not None:
+                source_lines = itertools.islice(reader, layer.source_line_count)
+            if layer.z > self.last_switch_height:
+                if reader is not None:
+                    collections.deque(source_lines, maxlen=0)
+                continue
+            if layer.summary:
+                yield layer, (GCodeLine(*gcode.read_gcode_line(line)) for line in source_lines)
+            else:
+                if reader is not None:
+                    collections.deque(source_lines, maxlen=0)
+                yield layer, layer.lines
+
+    def fill_occupancy_grid(self, grid):
+        """
+        Add extrusion moves under the tower top to occupancy grid. Start g-code of the first layer is left
+        out, its skirt and brim are included
+        :param grid: OccupancyGrid object
+        :return: list of x, y positions before and after tool changes
+        """
+        positions = []
+        x = y = None
+        tool_change = False
+        for layer, lines in self.tower_area_layers():
+            # position is followed through the start g-code, its purge lines are outside of the print area
+            start = layer.start_gcode_end + 1 if isinstance(layer, FirstLayer) and layer.start_gcode_end else 0
+            for index, line in enumerate(lines):
+                if line.opcode == b"T":
+                    if x is not None and y is not None and index >= start:
+                        positions.append((x, y))
+                        tool_change = True
+                    continue
+                if line.opcode not in GCode.MOVE_OPCODES:
+                    continue
+                new_x = x if line.x is None else line.x
+                new_y = y if line.y is None else line.y
+                if line.e and line.e > 0 and x is not None and y is not None and index >= start:
+                    grid.add_segment(x, y, new_x, new_y)
+                if tool_change and (line.x is not None or line.y is not None):
+                    # print resumes here
+                    positions.append((new_x, new_y))
+                    tool_change = False
+                x, y = new_x, new_y
+        return positions
 
     def add_tool_change_gcode(self):
         """
         Go through the g-code and add tool change g-code where needed.
         For layers that don't have tool change, add g-code for sparse infill.
+        Each command is classified once by its opcode and routed to a handler
+        from the dispatch table, other commands are skipped.
         :return:
         """
-        e_pos = 0
-        is_tool_change = False
-
-        # flag to indicate if z-move is needed after tower g-code
-        z_move_needed = False
-        # flag to indicate if prime is needed after purge tower g-code
-        prime_needed = False
-        # flag for post-tower prime
-        prime_ok = False
-
-        # Keep track of last X, Y position
-        last_pos = None
-        fan_speed = 0
-
-        def update_retract_position(pos, new_pos):
-            """
-            Update E position value. In case of negative value we want to have
-            cumulative status to understand how much retraction is done. In case of positive
-            value we don't care, so 0 is ok.
-            :param pos: current position
-            :param new_pos: new position
-            :return: updated position
-            """
-            pos += new_pos
-            if pos > -0.00001:
-                pos = 0
-            return pos
-            
+        self.tool_change_state = ToolChangeState()
+        if self.stream:
+            # layers are processed while the new file is written
+            return
         for layer in self.filtered_layers:
-            if isinstance(layer, FirstLayer):
-                index = layer.start_gcode_end
-            else:
-                index = 0
-            self.log.debug("layer {}, e-pos {}, line-index {}".format(layer.num, e_pos, index))
-
-            while True:
-                try:
-                    # TODO: refactor this whole thing...
-                    cmd, comment = layer.lines[index]
-
-                    if comment and comment.strip() == b"TOOL CHANGE":
-                        is_tool_change = True
-                    if not cmd:
-                        # need command
-                        index += 1
-                        continue
-                    if gcode.is_z_move(cmd):
-                        z_move_needed = False
-                    elif gcode.is_fan_speed(cmd):
-                        fan_speed = gcode.last_match
-                    elif is_tool_change and layer.action == ACT_SWITCH and gcode.is_tool_change(cmd) is not None:
-
-                        layer.delete_line(index)
-
-                        new_tool = gcode.last_match
-
-                        # check if tool change is needed
-                        if self.active_e is not None and self.active_e.tool == new_tool:
-                            self.log.debug("Redundant tool change {}, skipping...".format(new_tool))
-                        else:
-                            # disable fan
-                            if fan_speed and self.settings.tower_fan_off:
-                                index += layer.insert_line(index, gcode.gen_fan_off_gcode(), b"disable fan")
-                            # add tool change g-code
-                            # first check if retract is needed
-                            retract = self.active_e.get_retract_gcode(change=e_pos, comment=b" pre-tower retract")
-                            if retract:
-                                index += layer.insert_line(index, *retract)
-                                e_pos = -self.active_e.retract
-
-                            new_e = self.extruders[new_tool]
-                            for line in self.switch_tower.get_tower_lines(layer, e_pos, self.active_e, new_e):
-                                if line:
-                                    index += layer.insert_line(index, line[0], line[1])
-                            prime_needed = True
-                            prime_ok = False
-                            self.active_e = new_e
-                            # always full retract after purge tower
-                            e_pos = -new_e.retract
-                            z_move_needed = True
-
-                            if fan_speed and self.settings.tower_fan_off:
-                                index += layer.insert_line(index, gcode.gen_fan_speed_gcode(fan_speed), b"restore fan")
-
-                        is_tool_change = False
-                        continue
-                    elif gcode.is_extruder_move(cmd):
-                        if prime_needed and gcode.last_match[0] < 0:
-                            # remove retracts after adding tower
-                            layer.delete_line(index)
-                            index -= 1
-                        elif prime_needed and not prime_ok:
-                            # no prime allowed before moving to position
-                            layer.delete_line(index)
-                            index -= 1
-                        else:
-                            # store extruder position
-                            e_pos = update_retract_position(e_pos, gcode.last_match[0])
-                    elif gcode.is_extrusion_move(cmd):
-                        # add prime if needed
-                        if prime_needed:
-                            if not prime_ok:
-                                # if not in position, add move before prime
-                                x = last_pos[0]
-                                y = last_pos[1]
-                                index += layer.insert_line(index, gcode.gen_head_move(x, y,
-                                                                                      self.settings.travel_xy_speed),
-                                                            b' update position')
-                            # reset prime flag when printing starts after tower
-                            prime_needed = False
-                            if e_pos < -self.active_e.minimum_extrusion:
-                                prime_change_len = -(e_pos + self.active_e.retract)
-                                index += layer.insert_line(index,
-                                                           *self.active_e.get_prime_gcode(change=prime_change_len))
-                                e_pos = 0
-
-                        # store extruder position
-                        e_pos = update_retract_position(e_pos, gcode.last_match[3])
-
-                        # add z move if needed
-                        if z_move_needed:
-                            index += layer.insert_line(index, gcode.gen_z_move(layer.z, self.settings.travel_z_speed))
-                            z_move_needed = False
-
-                        last_pos = gcode.last_match
-
-                    elif gcode.is_head_move(cmd):
-                        if prime_needed:
-                            prime_ok = True
-                        last_pos = gcode.last_match
-                        if last_pos[2]:
-                            z_move_needed = False
-
-                except IndexError:
-                    # if last layer for z, check infill
-                    if layer.last_z_layer and layer.z < self.last_switch_height and not layer.support_layer:
-                        added = False
-                        for line in self.switch_tower.check_infill(layer, e_pos, self.active_e):
-                            if line:
-                                added = True
-                                index += layer.insert_line(index, line[0], line[1])
-                        if added:
-                            e_pos = -self.active_e.retract
-                        prime_needed = True
-                        prime_ok = False
-                    break
-                index += 1
+            self.add_layer_tool_change_gcode(layer)
 
-    def add_tool_change_gcode_post(self):
+    def add_layer_tool_change_gcode(self, layer):
         """
-        Run post steps for the layers, without the layer-object structuring. This should be run before saving
-        to file, after adding tool changes
-        :return: processed lines
+        Add tool change g-code to one layer. Layers must be processed in order
+        :param layer: layer to process
+        :return: none
         """
+        state = self.tool_change_state
+        handlers = self._handlers
+        if isinstance(layer, FirstLayer):
+            index = layer.start_gcode_end
+        else:
+            index = 0
+        self.log.debug("layer {}, e-pos {}, line-index {}".format(layer.num, state.e_pos, index))
 
-        lines = []
-        for layer in self.layers:
-            for cmd, comment in layer.lines:
-                lines.append((cmd, comment))
-
-        # tower retractions to proper place. This is hard to do in main tool change add loop as it's cumbersome to
-        # modify previous layer objects...
-        index = 0
-        last_pos_index = -1
         while True:
             try:
-                cmd, comment = lines[index]
-                if cmd:
-                    if gcode.is_head_move(cmd) or gcode.is_extrusion_move(cmd):
-                        last_pos_index = index
-                if comment == b" pre-tower retract":
-                    if last_pos_index != -1:
-                        new_pos = last_pos_index+1
-                        if index != new_pos:
-                            lines.pop(index)
-                            lines.insert(last_pos_index+1, (cmd, comment))
+                line = layer.lines[index]
             except IndexError:
+                # if last layer for z, check infill
+                if layer.last_z_layer and layer.z < self.last_switch_height and not layer.support_layer:
+                    added = layer.insert_lines(index, self.switch_tower.check_infill(layer, state.e_pos,
+                                                                                     self.active_e))
+                    index += added
+                    if added:
+                        state.e_pos = -self.active_e.retract
+                    state.prime_needed = True
+                    state.prime_ok = False
                 break
-            index += 1
 
-        return lines
+            if line.comment and line.comment.strip() == b"TOOL CHANGE":
+                state.is_tool_change = True
+            handler = handlers.get(line.opcode) if line.cmd else None
+            if handler:
+                index = handler(layer, index, line, state)
+            else:
+                index += 1
+
+    def _handle_fan_speed(self, layer, index, line, state):
+        """
+        Store fan speed so that it can be restored after the tower
+        :param layer: layer being processed
+        :param index: line index
+        :param line: M106 line
+        :param state: tool change state
+        :return: index of next line to process
+        """
+        fan_speed = gcode.is_fan_speed(line.cmd)
+        if fan_speed:
+            state.fan_speed = fan_speed
+        return index + 1
+
+    def _handle_tool_change(self, layer, index, line, state):
+        """
+        Replace tool change command with switch tower g-code
+        :param layer: layer being processed
+        :param index: line index
+        :param line: T<n> line
+        :param state: tool change state
+        :return: index of next line to process
+        """
+        if not state.is_tool_change or layer.action != ACT_SWITCH:
+            return index + 1
+
+        layer.delete_line(index)
+
+        new_tool = line.tool
+
+        # check if tool change is needed
+        if self.active_e is not None and self.active_e.tool == new_tool:
+            self.log.debug("Redundant tool change {}, skipping...".format(new_tool))
+        else:
+            # disable fan
+            if state.fan_speed and self.settings.tower_fan_off:
+                index += layer.insert_line(index, gcode.gen_fan_off_gcode(), b"disable fan")
+            # add tool change g-code
+            # first check if retract is needed
+            retract = self.active_e.get_retract_gcode(change=state.e_pos, comment=b" pre-tower retract")
+            if retract:
+                index += layer.insert_line(index, *retract)
+                state.e_pos = -self.active_e.retract
+
+            new_e = self.extruders[new_tool]
+            index += layer.insert_lines(index, self.switch_tower.get_tower_lines(layer, state.e_pos, self.active_e,
+                                                                                 new_e))
+            state.prime_needed = True
+            state.prime_ok = False
+            self.active_e = new_e
+            # always full retract after purge tower
+            state.e_pos = -new_e.retract
+            state.z_move_needed = True
+
+            if state.fan_speed and self.settings.tower_fan_off:
+                index += layer.insert_line(index, gcode.gen_fan_speed_gcode(state.fan_speed), b"restore fan")
+
+        state.is_tool_change = False
+        return index
+
+    def _handle_move(self, layer, index, line, state):
+        """
+        Track position and retraction state of G0/G1 moves, and add the prime,
+        position and z moves needed after the tower
+        :param layer: layer being processed
+        :param index: line index
+        :param line: G0/G1 line
+        :param state: tool change state
+        :return: index of next line to process
+        """
+        if line.z_move():
+            state.z_move_needed = False
+        elif line.extruder_move():
+            if state.prime_needed and line.e < 0:
+                # remove retracts after adding tower
+                layer.delete_line(index)
+                return index
+            elif state.prime_needed and not state.prime_ok:
+                # no prime allowed before moving to position
+                layer.delete_line(index)
+                return index
+            # store extruder position
+            state.update_retract_position(line.e)
+        elif line.extrusion_move():
+            # add prime if needed
+            if state.prime_needed:
+                if not state.prime_ok:
+                    # if not in position, add move before prime
+                    x, y = state.last_pos
+                    index += layer.insert_line(index, gcode.gen_head_move(x, y, self.settings.travel_xy_speed),
+                                               b' update position')
+                # reset prime flag when printing starts after tower
+                state.prime_needed = False
+                if state.e_pos < -self.active_e.minimum_extrusion:
+                    prime_change_len = -(state.e_pos + self.active_e.retract)
+                    index += layer.insert_line(index, *self.active_e.get_prime_gcode(change=prime_change_len))
+                    state.e_pos = 0
+
+            # store extruder position
+            state.update_retract_position(line.e)
+
+            # add z move if needed
+            if state.z_move_needed:
+                index += layer.insert_line(index, gcode.gen_z_move(layer.z, self.settings.travel_z_speed))
+                state.z_move_needed = False
+
+            state.last_pos = line.x, line.y
+        elif line.head_move():
+            if state.prime_needed:
+                state.prime_ok = True
+            state.last_pos = line.x, line.y
+            if line.z:
+                state.z_move_needed = False
+        return index + 1
+
+    def add_tool_change_gcode_post(self, lines=None):
+        """
+        Run post steps for the lines, without the layer-object structuring. This should be run before saving
+        to file, after adding tool changes
+        :param lines: GCodeLine objects, lines of all layers by default
+        :return: generator of processed lines
+        """
+        if lines is None:
+            lines = itertools.chain.from_iterable(layer.lines for layer in self.layers)
+
+        # tower retractions to proper place. This is hard to do in main tool change add loop as it's cumbersome to
+        # modify previous layer objects... Lines after the latest head or extrusion move are held back, retract is
+        # put in front of them.
+        pending = collections.deque()
+        position_seen = False
+        for line in lines:
+            if line.head_move() or line.extrusion_move():
+                while pending:
+                    yield pending.popleft()
+                yield line
+                position_seen = True
+            elif line.comment == b" pre-tower retract" and position_seen:
+                pending.appendleft(line)
+            else:
+                pending.append(line)
+        while pending:
+            yield pending.popleft()
 
     def parse_layers(self, lines):
         """
@@ -507,7 +783,7 @@ class GCodeFile:
         :return:
         """
         self.log.info("Gcode succesfully processed.")
-        if self.settings.get_hw_config_value("prerun.prime") == "True":
+        if self.settings.hw.prerun_prime:
             self.log.info("Before print: make sure all extruders are UNLOADED")
         else:
             self.log.info("Before print: make sure T0 has filament LOADED")
@@ -0,0 +1,80 @@
+import mmap
+import re
+
+
+class GCodeReader:
+    """
+    Re-iterable g-code file reader. Each iteration maps the file to memory and yields lines stripped
+    from whitespace, empty lines are skipped. Lines are sliced straight from the mapped file, so
+    each line is copied once and only one line is kept in memory at a time.
+    """
+
+    # non-whitespace run within one line: same as strip() on each line, empty lines never match
+    LINE_RE = re.compile(rb"\S(?:[^\n]*\S)?")
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, "rb") as gf:
+            try:
+                mapped = mmap.mmap(gf.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file cannot be mapped
+                return
+            with mapped:
+                for m in self.LINE_RE.finditer(mapped):
+                    yield m.group()
+
+
+class GCodeWriter:
+    """
+    Writes processed g-code lines to file in chunks. Lines are separated with CR LF, no line end is
+    written after the last line.
+    """
+
+    EOL = b"\r\n"
+    CHUNK_LINES = 4096
+
+    def __init__(self, output):
+        """
+        :param output: binary file object
+        """
+        self.output = output
+        self.lines_written = 0
+        self._buffer = []
+
+    def write(self, line):
+        """
+        Write line
+        :param line: GCodeLine object
+        :return: none
+        """
+        self._buffer.append(line.to_bytes())
+        if len(self._buffer) >= self.CHUNK_LINES:
+            self._flush_buffer()
+
+    def write_lines(self, lines):
+        """
+        Write lines
+        :param lines: iterable of GCodeLine objects
+        :return: none
+        """
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        """
+        Write remaining lines. Output file is not closed
+        :return: none
+        """
+        self._flush_buffer()
+
+    def _flush_buffer(self):
+        if not self._buffer:
+            return
+        if self.lines_written:
+            self.output.write(self.EOL)
+        self.output.write(self.EOL.join(self._buffer))
+        self.lines_written += len(self._buffer)
+        self._buffer = []
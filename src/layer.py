@@ -1,6 +1,8 @@
+import bisect
 import types
 
-from gcode import GCode
+from gcode import GCode, GCodeLine
+from move_table import MoveTable
 
 gcode = GCode()
 
@@ -10,12 +12,260 @@ ACT_PASS = 2
 ACTIONS = [ACT_SWITCH, ACT_INFILL, ACT_PASS]
 
 
+def iter_gcode_lines(lines, comment=None):
+    """
+    Normalise g-code generator output to GCodeLine objects. Generators yield (cmd, comment) tuples,
+    bare commands, nested generators, (generator, comment) tuples or None
+    :param lines: iterable of lines
+    :param comment: comment for bare commands
+    :return: GCodeLine generator
+    """
+    for line in lines:
+        if line is None:
+            continue
+        elif isinstance(line, GCodeLine):
+            yield line
+        elif isinstance(line, tuple):
+            if isinstance(line[0], types.GeneratorType):
+                # (generator, comment) pair, comment applies to bare commands of the generator
+                yield from iter_gcode_lines(*line)
+            else:
+                yield GCodeLine(*line)
+        elif isinstance(line, bytes):
+            yield GCodeLine(line, comment)
+        else:
+            yield from iter_gcode_lines(line, comment)
+
+
+class LineBuffer:
+    """
+    Gap buffer for layer lines. Lines before the gap are kept in one list and lines after it
+    in another one in reverse order. Edits happen at the gap, so inserting and deleting
+    while walking through the layer doesn't shift the rest of the lines.
+    Indexing, slicing, iteration and len() work like with a list, also when lines are edited during iteration.
+    """
+    __slots__ = ("_before", "_after")
+
+    def __init__(self, lines=None):
+        self._before = list(lines) if lines else []
+        self._after = []
+
+    def _move_gap(self, index):
+        """
+        Move gap to given position
+        :param index: position, clamped to buffer size like list.insert
+        :return: position of the gap
+        """
+        size = len(self._before) + len(self._after)
+        if index < 0:
+            index = max(index + size, 0)
+        elif index > size:
+            index = size
+
+        before = self._before
+        after = self._after
+        gap = len(before)
+        if index < gap:
+            moved = before[index:]
+            del before[index:]
+            moved.reverse()
+            after.extend(moved)
+        elif index > gap:
+            count = index - gap
+            moved = after[-count:]
+            del after[-count:]
+            moved.reverse()
+            before.extend(moved)
+        return index
+
+    def _position(self, index):
+        """
+        Validate index
+        :param index: index
+        :return: non-negative index
+        """
+        size = len(self._before) + len(self._after)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("line index out of range")
+        return index
+
+    def __len__(self):
+        return len(self._before) + len(self._after)
+
+    def __iter__(self):
+        # index based like a list iterator, so lines can be inserted and replaced while iterating
+        index = 0
+        while True:
+            before = self._before
+            if index < len(before):
+                yield before[index]
+            else:
+                position = len(self._after) - 1 - (index - len(before))
+                if position < 0:
+                    return
+                yield self._after[position]
+            index += 1
+
+    def __reversed__(self):
+        yield from self._after
+        yield from reversed(self._before)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        index = self._position(index)
+        gap = len(self._before)
+        if index < gap:
+            return self._before[index]
+        return self._after[len(self._after) - 1 - (index - gap)]
+
+    def __setitem__(self, index, line):
+        index = self._position(index)
+        gap = len(self._before)
+        if index < gap:
+            self._before[index] = line
+        else:
+            self._after[len(self._after) - 1 - (index - gap)] = line
+
+    def insert(self, index, line):
+        """
+        Insert line before given index
+        :param index: index
+        :param line: line to insert
+        :return: position of the inserted line
+        """
+        index = self._move_gap(index)
+        self._before.append(line)
+        return index
+
+    def insert_many(self, index, lines):
+        """
+        Insert lines before given index in one splice
+        :param index: index
+        :param lines: list of lines
+        :return: position of the first inserted line
+        """
+        index = self._move_gap(index)
+        self._before.extend(lines)
+        return index
+
+    def append(self, line):
+        """
+        Add line to the end
+        :param line: line to add
+        :return: none
+        """
+        if self._after:
+            self._move_gap(len(self))
+        self._before.append(line)
+
+    def pop(self, index=-1):
+        """
+        Remove and return line from given index
+        :param index: index
+        :return: removed line
+        """
+        self._move_gap(self._position(index))
+        return self._after.pop()
+
+    def position(self, index):
+        """
+        Get non-negative position of existing line
+        :param index: index, can be negative
+        :return: position
+        """
+        return self._position(index)
+
+
+# stands for a run of moves in a summary mode layer
+MOVES_PLACEHOLDER = GCodeLine(b"G1")
+
+
+class LineIndex:
+    """
+    Offsets of the tool changes, linear/pressure advance commands and start/end script markers
+    of a layer. Offsets are recorded as lines are added and shifted on inserts and deletes.
+    """
+    OPCODES = (b"T", b"M900", b"M572")
+    START_SCRIPT_END = b"START SCRIPT END"
+    END_SCRIPT_START = b"END SCRIPT START"
+
+    def __init__(self):
+        self.offsets = {key: [] for key in self.OPCODES + (self.START_SCRIPT_END, self.END_SCRIPT_START)}
+
+    def _keys(self, line):
+        """
+        Get index keys matching the line
+        :param line: GCodeLine
+        :return: list of keys
+        """
+        keys = []
+        if line.opcode in self.offsets:
+            keys.append(line.opcode)
+        if line.comment:
+            if line.comment.strip() == self.START_SCRIPT_END:
+                keys.append(self.START_SCRIPT_END)
+            if self.END_SCRIPT_START in line.comment:
+                keys.append(self.END_SCRIPT_START)
+        return keys
+
+    def add(self, index, line):
+        """
+        Record line at given offset. Lines after it must already be shifted
+        :param index: line offset
+        :param line: GCodeLine
+        :return: none
+        """
+        for key in self._keys(line):
+            bisect.insort(self.offsets[key], index)
+
+    def shift(self, index, count):
+        """
+        Shift offsets starting from given index
+        :param index: first offset to shift
+        :param count: amount to shift, negative for deletes
+        :return: none
+        """
+        for key, offsets in self.offsets.items():
+            if offsets and offsets[-1] >= index:
+                self.offsets[key] = [o + count if o >= index else o for o in offsets]
+
+    def remove(self, index):
+        """
+        Remove line at given offset and shift the offsets after it
+        :param index: line offset
+        :return: none
+        """
+        for key, offsets in self.offsets.items():
+            if offsets and offsets[-1] >= index:
+                self.offsets[key] = [o - 1 if o > index else o for o in offsets if o != index]
+
+    def get(self, key):
+        """
+        Get offsets of given opcode or marker
+        :param key: opcode or marker
+        :return: sorted list of offsets
+        """
+        return self.offsets[key]
+
+    def first(self, key):
+        """
+        Get first offset of given opcode or marker
+        :param key: opcode or marker
+        :return: offset or None
+        """
+        offsets = self.offsets[key]
+        return offsets[0] if offsets else None
+
+
 class Layer:
 
     def __init__(self, num, z, height):
         self.num = num
         self.z = z
-        self.lines = []
+        self.lines = LineBuffer()
         self.height = height
 
         self.line_index = 0
@@ -28,6 +278,102 @@ class Layer:
         self.last_z_layer = False
         self.support_layer = False  #  Slic3r PE specific
 
+        # columnar move table, filled while lines are added and rebuilt after edits
+        self._moves = MoveTable()
+        # offsets of tool changes and script markers
+        self.offsets = LineIndex()
+
+        # in summary mode G0/G1 moves are not stored. Full lines are loaded later with load_lines
+        # (streaming mode)
+        self.summary = False
+        self.source_line_count = 0
+        # extrusion bounds collected while the layer is parsed, reset on edits
+        self._move_bounds = [None, None, None, None]
+
+    @property
+    def moves(self):
+        """
+        Get move table of the layer
+        :return: MoveTable
+        """
+        if self._moves is None:
+            self._moves = MoveTable.from_lines(self.lines)
+        return self._moves
+
+    def _append(self, line):
+        """
+        Append line record and update move table and line index
+        :param line: GCodeLine
+        :return: none
+        """
+        if line.opcode in GCode.MOVE_OPCODES:
+            if self._move_bounds is not None and line.extrusion_move():
+                self._update_bounds(line)
+            if self.summary:
+                # store a placeholder for a run of moves
+                if not len(self.lines) or self.lines[-1] is not MOVES_PLACEHOLDER:
+                    self.lines.append(MOVES_PLACEHOLDER)
+                return
+        index = len(self.lines)
+        self.lines.append(line)
+        self.offsets.add(index, line)
+        if self._moves is not None:
+            self._moves.append(index, line)
+
+    def _update_bounds(self, line):
+        """
+        Update extrusion bounds with extrusion move
+        :param line: GCodeLine
+        :return: none
+        """
+        bounds = self._move_bounds
+        if line.x is not None:
+            bounds[0] = line.x if bounds[0] is None else max(bounds[0], line.x)
+            bounds[1] = line.x if bounds[1] is None else min(bounds[1], line.x)
+        if line.y is not None:
+            bounds[2] = line.y if bounds[2] is None else max(bounds[2], line.y)
+            bounds[3] = line.y if bounds[3] is None else min(bounds[3], line.y)
+
+    def _lines_changed(self):
+        """
+        Drop data collected while parsing that edits make invalid
+        :return: none
+        """
+        self._moves = None
+        self._move_bounds = None
+
+    def extrusion_bounds(self):
+        """
+        Get bounding box of extrusion moves
+        :return: x_max, x_min, y_max, y_min or None for each axis without values
+        """
+        if self._move_bounds is not None:
+            return tuple(self._move_bounds)
+        return self.moves.extrusion_bounds()
+
+    def load_lines(self, lines):
+        """
+        Replace summary lines with full lines
+        :param lines: g-code lines read from file
+        :return: none
+        """
+        self.summary = False
+        self.lines = LineBuffer()
+        self.offsets = LineIndex()
+        self._moves = None
+        self._move_bounds = [None, None, None, None]
+        for line in lines:
+            self._append(GCodeLine(*gcode.read_gcode_line(line)))
+
+    def release_lines(self):
+        """
+        Drop lines of a layer that has been written to file
+        :return: none
+        """
+        self.lines = LineBuffer()
+        self.offsets = LineIndex()
+        self._moves = None
+
     def add_line(self, cmd, comment=None):
         """
         Adds lines to line list
@@ -37,24 +383,22 @@ class Layer:
         """
         if isinstance(cmd, types.GeneratorType):
             lines = 0
-            for c in cmd:
-                if isinstance(c, tuple):
-                    self.lines.append(c)
-                else:
-                    self.lines.append((c, comment))
+            for line in iter_gcode_lines(cmd, comment):
+                self._append(line)
                 lines += 1
-            return lines
         else:
-            self.lines.append((cmd, comment))
-            return 1
+            self._append(GCodeLine(cmd, comment))
+            lines = 1
+        self.source_line_count += lines
+        return lines
 
     def is_empty_layer(self):
         """
         Check if layer is empty, i.e. no commands
         :return: true or false
         """
-        for cmd, _ in self.lines:
-            if cmd:
+        for line in self.lines:
+            if line.cmd:
                 return False
         return True
 
@@ -67,19 +411,42 @@ class Layer:
         :return: number of lines inserted
         """
         if isinstance(cmd, types.GeneratorType):
-            i = index
-            lines = 0
-            for c in cmd:
-                if isinstance(c, tuple):
-                    self.lines.insert(i, c)
-                else:
-                    self.lines.insert(i, (c, comment))
-                i += 1
-                lines += 1
-            return lines
-        else:
-            self.lines.insert(index, (cmd, comment))
-            return 1
+            return self.insert_lines(index, cmd, comment)
+        self._lines_changed()
+        line = GCodeLine(cmd, comment)
+        index = self.lines.insert(index, line)
+        self.offsets.shift(index, 1)
+        self.offsets.add(index, line)
+        return 1
+
+    def insert_lines(self, index, lines, comment=None):
+        """
+        Drain g-code generator and splice the lines to given index position in one operation
+        :param index: index
+        :param lines: generator or list of (cmd, comment) tuples, commands, nested generators or None
+        :param comment: comment for bare commands
+        :return: number of lines inserted
+        """
+        records = list(iter_gcode_lines(lines, comment))
+        if records:
+            self._lines_changed()
+            index = self.lines.insert_many(index, records)
+            self.offsets.shift(index, len(records))
+            for offset, line in enumerate(records, index):
+                self.offsets.add(offset, line)
+        return len(records)
+
+    def set_lines(self, lines):
+        """
+        Replace all lines of the layer, e.g. after reordering them
+        :param lines: list of GCodeLine objects
+        :return: none
+        """
+        self._lines_changed()
+        self.lines = LineBuffer(lines)
+        self.offsets = LineIndex()
+        for index, line in enumerate(lines):
+            self.offsets.add(index, line)
 
     def replace_line(self, index, cmd, comment):
         """
@@ -89,18 +456,24 @@ class Layer:
         :param comment: g-code comment
         :return: none
         """
-        self.lines[index] = (cmd, comment)
+        self._lines_changed()
+        index = self.lines.position(index)
+        line = GCodeLine(cmd, comment)
+        self.offsets.remove(index)
+        self.offsets.shift(index, 1)
+        self.offsets.add(index, line)
+        self.lines[index] = line
 
     def has_tool_changes(self):
         """
         Check if layer has tool changes
-        :return: true or false
+        :return: number of tool changes
         """
-        for cmd, comment in self.lines:
-            if comment and b"END SCRIPT START" in comment:
-                break
-            elif cmd and gcode.is_tool_change(cmd) is not None:
-                self.tool_change_count += 1
+        tool_changes = self.offsets.get(b"T")
+        end_script = self.offsets.first(LineIndex.END_SCRIPT_START)
+        if end_script is not None:
+            tool_changes = tool_changes[:bisect.bisect_left(tool_changes, end_script)]
+        self.tool_change_count = len(tool_changes)
         return self.tool_change_count
 
     def delete_line(self, index=None):
@@ -113,20 +486,10 @@ class Layer:
             l_index = self.line_index
         else:
             l_index = index
+        self._lines_changed()
+        l_index = self.lines.position(l_index)
         self.lines.pop(l_index)
-
-    def remove_comments(self):
-        """ Removes comment lines """
-        self.line_index = 0
-        while True:
-            try:
-                if self.lines[self.line_index].startswith(b";"):
-                    self.lines.pop(self.line_index)
-                    continue
-                self.lines[self.line_index] = self.lines[self.line_index].split(b";")[0].strip()
-                self.line_index += 1
-            except IndexError:
-                return
+        self.offsets.remove(l_index)
 
     def read_lines(self):
         """
@@ -135,7 +498,7 @@ class Layer:
         """
         index = 0
         for line in self.lines:
-            yield line[0], line[1], index
+            yield line.cmd, line.comment, index
             index += 1
 
     def get_outer_perimeter_rates(self, search_comment=b"outer perimeter"):
@@ -145,36 +508,11 @@ class Layer:
         """
 
         if not self.outer_perimeter_speed:
-            speeds = []
-            feed_rates = []
-            is_outer = False
-            prev_position = None
-            for cmd, comment in self.lines:
-                if comment:
-                    if search_comment in comment:
-                        is_outer = True
-                    else:
-                        is_outer = False
-                if cmd:
-                    if is_outer:
-                        position = None
-                        if gcode.is_extrusion_move(cmd):
-                            if gcode.last_match[3] > 0:
-                                speeds.append(gcode.last_match[3])
-                            position = gcode.last_match[0], gcode.last_match[1]
-                        if prev_position and position:
-                            length = gcode.calculate_path_length(prev_position, position)
-                            _e_pos = gcode.last_match[3]
-                            if _e_pos > 0 and length > 0.05:
-                                feed_rate = gcode.calculate_feed_rate(length, _e_pos)
-                                feed_rates.append(feed_rate)
-                        if position:
-                            prev_position = position
-                    if gcode.is_head_move(cmd):
-                        prev_position = (gcode.last_match[0], gcode.last_match[1])
-            if speeds:
-                self.outer_perimeter_speed = sum(speeds)/len(speeds)
-                self.outer_perimeter_feedrate = sum(feed_rates)/len(feed_rates)
+            sections = {index for index, line in enumerate(self.lines)
+                        if line.comment and search_comment in line.comment}
+            rates = self.moves.perimeter_rates(sections)
+            if rates:
+                self.outer_perimeter_speed, self.outer_perimeter_feedrate = rates
 
         return self.outer_perimeter_speed
 
@@ -196,10 +534,9 @@ class FirstLayer(Layer):
 
     def has_tool_changes(self):
         """
-        Check if layer has tool changes
-        :return: true or false
+        Check if layer has tool changes after start g-code
+        :return: number of tool changes
         """
-        for cmd, _ in self.lines[self.start_gcode_end:]:
-            if cmd and gcode.is_tool_change(cmd) is not None:
-                self.tool_change_count += 1
+        tool_changes = self.offsets.get(b"T")
+        self.tool_change_count = len(tool_changes) - bisect.bisect_left(tool_changes, self.start_gcode_end)
         return self.tool_change_count
@@ -0,0 +1,218 @@
+import array
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from gcode import GCode
+
+gcode = GCode()
+
+# opcode column values
+OP_G0 = 0
+OP_G1 = 1
+MOVE_OPCODES = {b"G0": OP_G0, b"G1": OP_G1}
+
+NAN = float("nan")
+
+
+class MoveTable:
+    """
+    Columnar table of the G0/G1 moves of a layer: x, y, z, e, f, opcode, line index and the index of the
+    latest line with a comment. Axis words not given in the move are stored as NaN.
+
+    Rows are collected into arrays while the layer is parsed. Queries use NumPy when it's installed,
+    otherwise the same reductions are done in plain Python.
+    """
+
+    def __init__(self):
+        self.x = array.array("d")
+        self.y = array.array("d")
+        self.z = array.array("d")
+        self.e = array.array("d")
+        self.f = array.array("d")
+        self.opcode = array.array("b")
+        self.index = array.array("l")
+        self.comment_index = array.array("l")
+        # index of latest line with a comment, -1 if none
+        self.last_comment_index = -1
+        self._np = None
+
+    @classmethod
+    def from_lines(cls, lines):
+        """
+        Build table from layer lines
+        :param lines: GCodeLine objects
+        :return: MoveTable
+        """
+        table = cls()
+        for index, line in enumerate(lines):
+            table.append(index, line)
+        return table
+
+    def append(self, index, line):
+        """
+        Add line to table if it's a G0/G1 move
+        :param index: line index in layer
+        :param line: GCodeLine
+        :return: none
+        """
+        if line.comment:
+            self.last_comment_index = index
+        opcode = MOVE_OPCODES.get(line.opcode)
+        if opcode is None:
+            return
+        self.x.append(NAN if line.x is None else line.x)
+        self.y.append(NAN if line.y is None else line.y)
+        self.z.append(NAN if line.z is None else line.z)
+        self.e.append(NAN if line.e is None else line.e)
+        self.f.append(NAN if line.f is None else line.f)
+        self.opcode.append(opcode)
+        self.index.append(index)
+        self.comment_index.append(self.last_comment_index)
+        self._np = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def _numpy_columns(self):
+        """
+        Get NumPy copies of the columns. Copies are cached until next append.
+        :return: dictionary of column arrays
+        """
+        if self._np is None:
+            self._np = {
+                "x": numpy.array(self.x, dtype=numpy.float64),
+                "y": numpy.array(self.y, dtype=numpy.float64),
+                "e": numpy.array(self.e, dtype=numpy.float64),
+                "f": numpy.array(self.f, dtype=numpy.float64),
+                "comment_index": numpy.array(self.comment_index, dtype=numpy.int64),
+            }
+        return self._np
+
+    def extrusion_bounds(self):
+        """
+        Get bounding box of extrusion moves
+        :return: x_max, x_min, y_max, y_min or None for each axis without values
+        """
+        if numpy is not None and len(self):
+            c = self._numpy_columns()
+            x, y, e = c["x"], c["y"], c["e"]
+            has_x = ~numpy.isnan(x)
+            has_y = ~numpy.isnan(y)
+            mask = (has_x | has_y) & ~numpy.isnan(e) & (e != 0)
+            x = x[mask & has_x]
+            y = y[mask & has_y]
+            x_max, x_min = (float(x.max()), float(x.min())) if x.size else (None, None)
+            y_max, y_min = (float(y.max()), float(y.min())) if y.size else (None, None)
+            return x_max, x_min, y_max, y_min
+
+        xs = []
+        ys = []
+        for x, y, e in zip(self.x, self.y, self.e):
+            if e != e or not e:
+                continue
+            if x == x:
+                xs.append(x)
+            if y == y:
+                ys.append(y)
+        x_max, x_min = (max(xs), min(xs)) if xs else (None, None)
+        y_max, y_min = (max(ys), min(ys)) if ys else (None, None)
+        return x_max, x_min, y_max, y_min
+
+    def perimeter_rates(self, comment_indices, min_length=0.05):
+        """
+        Calculate average print speed and feed rate of extrusion moves in given sections. Head moves
+        anywhere in the layer update the start position of the next segment.
+        :param comment_indices: indices of the comment lines starting the sections
+        :param min_length: minimum segment length to include in feed rate
+        :return: average speed and average feed rate, or None if no moves found
+        """
+        if numpy is not None and len(self):
+            c = self._numpy_columns()
+            x, y, e, f = c["x"], c["y"], c["e"], c["f"]
+            has_xy = ~(numpy.isnan(x) & numpy.isnan(y))
+            extrusion = has_xy & ~numpy.isnan(e) & (e != 0)
+            head = has_xy & ~extrusion
+            section = extrusion & numpy.isin(c["comment_index"], list(comment_indices))
+
+            # only these rows update the previous position
+            positioned = numpy.flatnonzero(section | head)
+            lengths = numpy.hypot(numpy.diff(x[positioned]), numpy.diff(y[positioned]))
+            rows = positioned[1:]
+            measured = section[rows] & (e[rows] > 0)
+            with numpy.errstate(invalid="ignore"):
+                measured &= lengths > min_length
+            feed_rates = e[rows][measured] / lengths[measured]
+
+            speed_rows = section & (e > 0) & ~numpy.isnan(f)
+            if not speed_rows.any():
+                return None
+            feed_rate = float(feed_rates.mean()) if feed_rates.size else None
+            return float(f[speed_rows].mean()), feed_rate
+
+        speeds = []
+        feed_rates = []
+        prev_position = None
+        for x, y, e, f, comment_index in zip(self.x, self.y, self.e, self.f, self.comment_index):
+            if x != x and y != y:
+                continue
+            if e == e and e:
+                if comment_index not in comment_indices:
+                    continue
+                position = x, y
+                if e > 0 and f == f:
+                    speeds.append(f)
+                if prev_position:
+                    length = gcode.calculate_path_length(prev_position, position)
+                    if e > 0 and length > min_length:
+                        feed_rates.append(gcode.calculate_feed_rate(length, e))
+                prev_position = position
+            else:
+                prev_position = x, y
+        if not speeds:
+            return None
+        feed_rate = sum(feed_rates) / len(feed_rates) if feed_rates else None
+        return sum(speeds) / len(speeds), feed_rate
+
+    def path_length(self):
+        """
+        Calculate total XY path length of the moves. Missing axis keeps the previous value.
+        :return: path length
+        """
+        if numpy is not None and len(self):
+            c = self._numpy_columns()
+            x = self._fill_forward(c["x"])
+            y = self._fill_forward(c["y"])
+            valid = ~(numpy.isnan(x) | numpy.isnan(y))
+            x, y = x[valid], y[valid]
+            return float(numpy.hypot(numpy.diff(x), numpy.diff(y)).sum())
+
+        length = 0
+        prev = None
+        last_x = last_y = NAN
+        for x, y in zip(self.x, self.y):
+            if x == x:
+                last_x = x
+            if y == y:
+                last_y = y
+            if last_x != last_x or last_y != last_y:
+                continue
+            if prev:
+                length += math.hypot(last_x - prev[0], last_y - prev[1])
+            prev = last_x, last_y
+        return length
+
+    @staticmethod
+    def _fill_forward(values):
+        """
+        Replace NaN values with the previous non-NaN value
+        :param values: NumPy array
+        :return: filled array
+        """
+        idx = numpy.where(numpy.isnan(values), 0, numpy.arange(values.size))
+        numpy.maximum.accumulate(idx, out=idx)
+        # leading NaN values stay NaN
+        return values[idx]
@@ -0,0 +1,186 @@
+import array
+import collections
+import math
+
+# grid cell size in mm
+CELL_SIZE = 1.0
+
+# value of a used cell
+ONE = b"\x01"
+
+
+class OccupancyGrid:
+    """
+    Bitmap of the bed area used by the print. Extrusion moves are rasterised to cells, the used cells
+    are grown by the needed clearance and free rectangles are found with an integral image (summed
+    area table) query.
+    """
+
+    def __init__(self, x_min, y_min, x_max, y_max, cell_size=CELL_SIZE):
+        self.x_min = x_min
+        self.y_min = y_min
+        self.cell_size = cell_size
+        self.cols = max(int((x_max - x_min) / cell_size), 0)
+        self.rows = max(int((y_max - y_min) / cell_size), 0)
+        # row major, 1 for used cells
+        self.cells = bytearray(self.cols * self.rows)
+        self._integral = None
+
+    def _cell(self, x, y):
+        """
+        Get cell of a coordinate
+        :param x: x coordinate
+        :param y: y coordinate
+        :return: column and row, may be outside the grid
+        """
+        return int(math.floor((x - self.x_min) / self.cell_size)), int(math.floor((y - self.y_min) / self.cell_size))
+
+    def add_segment(self, x1, y1, x2, y2):
+        """
+        Mark cells under an extrusion segment used. The segment is walked one cell line of the minor axis
+        at a time and the crossed cells of each line are marked at once
+        :param x1: start x
+        :param y1: start y
+        :param x2: end x
+        :param y2: end y
+        :return: none
+        """
+        u1 = (x1 - self.x_min) / self.cell_size
+        v1 = (y1 - self.y_min) / self.cell_size
+        u2 = (x2 - self.x_min) / self.cell_size
+        v2 = (y2 - self.y_min) / self.cell_size
+        if abs(u2 - u1) >= abs(v2 - v1):
+            # mostly horizontal, lines are rows
+            a1, b1, a2, b2 = u1, v1, u2, v2
+            lines, line_cells, line_step, cell_step = self.rows, self.cols, self.cols, 1
+        else:
+            a1, b1, a2, b2 = v1, u1, v2, u2
+            lines, line_cells, line_step, cell_step = self.cols, self.rows, 1, self.cols
+        if b1 > b2:
+            a1, b1, a2, b2 = a2, b2, a1, b1
+        slope = (a2 - a1) / (b2 - b1) if b2 != b1 else 0
+
+        cells = self.cells
+        last_line = math.floor(b2)
+        a_start = a1
+        for line in range(math.floor(b1), last_line + 1):
+            a_end = a2 if line == last_line else a1 + (line + 1 - b1) * slope
+            if a_start <= a_end:
+                first, last = math.floor(a_start), math.floor(a_end)
+            else:
+                first, last = math.floor(a_end), math.floor(a_start)
+            a_start = a_end
+            if line < 0 or line >= lines:
+                continue
+            if first < 0:
+                first = 0
+            if last >= line_cells:
+                last = line_cells - 1
+            if first <= last:
+                start = line * line_step + first * cell_step
+                cells[start:start + (last - first) * cell_step + 1:cell_step] = ONE * (last - first + 1)
+        self._integral = None
+
+    def block_outside_circle(self, radius):
+        """
+        Mark cells that are not completely inside a circle centered at the origin used, e.g. round
+        delta bed
+        :param radius: circle radius
+        :return: none
+        """
+        for row in range(self.rows):
+            y1 = self.y_min + row * self.cell_size
+            y = max(abs(y1), abs(y1 + self.cell_size))
+            for col in range(self.cols):
+                x1 = self.x_min + col * self.cell_size
+                x = max(abs(x1), abs(x1 + self.cell_size))
+                if math.hypot(x, y) > radius:
+                    self.cells[row * self.cols + col] = 1
+        self._integral = None
+
+    def dilate(self, distance):
+        """
+        Grow used cells by given distance, so cells within a square of the distance are marked
+        :param distance: distance in mm
+        :return: none
+        """
+        radius = int(math.ceil(distance / self.cell_size))
+        if radius <= 0 or not self.cells:
+            return
+        cols, rows = self.cols, self.rows
+        size = len(self.cells)
+        # cells are 0 or 1 bytes, so the grid read as one integer can be shifted and or'ed a cell at a time
+        used = int.from_bytes(self.cells, "little")
+        grown = used
+        for shift in range(1, min(radius, cols - 1) + 1):
+            # masks drop cells that were shifted to the next or previous row
+            to_right = int.from_bytes((bytes(shift) + ONE * (cols - shift)) * rows, "little")
+            to_left = int.from_bytes((ONE * (cols - shift) + bytes(shift)) * rows, "little")
+            grown |= (used << 8 * shift) & to_right | (used >> 8 * shift) & to_left
+        used = grown
+        for shift in range(1, min(radius, rows - 1) + 1):
+            grown |= used << 8 * shift * cols | used >> 8 * shift * cols
+        grown &= (1 << 8 * size) - 1
+        self.cells = bytearray(grown.to_bytes(size, "little"))
+        self._integral = None
+
+    def integral(self):
+        """
+        Get integral image of the grid. Value at [row][col] is the count of used cells below and left of it
+        :return: list of row arrays
+        """
+        if self._integral is None:
+            cols = self.cols
+            table = [array.array("l", [0]) * (cols + 1)]
+            for row in range(self.rows):
+                prev = table[-1]
+                line = array.array("l", [0]) * (cols + 1)
+                row_sum = 0
+                for col in range(cols):
+                    row_sum += self.cells[row * cols + col]
+                    line[col + 1] = prev[col + 1] + row_sum
+                table.append(line)
+            self._integral = table
+        return self._integral
+
+    def free_rectangles(self, width, height, area=None):
+        """
+        Find free positions for a rectangle
+        :param width: rectangle width in mm
+        :param height: rectangle height in mm
+        :param area: optional x min, y min, x max, y max limits for the lower left corner
+        :return: generator of lower left x, y coordinates of free rectangles
+        """
+        width_cells = int(math.ceil(width / self.cell_size))
+        height_cells = int(math.ceil(height / self.cell_size))
+        first_col, first_row = 0, 0
+        last_col, last_row = self.cols - width_cells, self.rows - height_cells
+        if area is not None:
+            col, row = self._cell(area[0], area[1])
+            first_col, first_row = max(col, 0), max(row, 0)
+            col, row = self._cell(area[2], area[3])
+            last_col, last_row = min(col, last_col), min(row, last_row)
+        table = self.integral()
+        for row in range(first_row, last_row + 1):
+            bottom = table[row]
+            top = table[row + height_cells]
+            for col in range(first_col, last_col + 1):
+                if top[col + width_cells] - bottom[col + width_cells] - top[col] + bottom[col] == 0:
+                    yield self.x_min + col * self.cell_size, self.y_min + row * self.cell_size
+
+
+def cluster_points(points, distance):
+    """
+    Combine points that are in the same square of given size
+    :param points: x, y tuples
+    :param distance: square size
+    :return: list of x, y, count tuples. x and y are the mean of the combined points
+    """
+    clusters = collections.OrderedDict()
+    for x, y in points:
+        cluster = clusters.setdefault((int(x // distance), int(y // distance)), [0, 0, 0])
+        cluster[0] += x
+        cluster[1] += y
+        cluster[2] += 1
+    return [(x / count, y / count, count) for x, y, count in clusters.values()]
+
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import pickle
+import zlib
+
+# bump when the cached state changes
+CACHE_VERSION = 1
+CACHE_EXT = ".fscache"
+
+
+def file_hash(path):
+    """
+    Calculate SHA-256 hash of file content
+    :param path: file path
+    :return: hex digest
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ParseCache:
+    """
+    On-disk cache of parsed g-code files. Each entry is a zlib compressed pickle in its own file
+    named by the cache key. Reading an entry marks it used, least recently used entries are removed
+    when the total size of the cache goes over the limit.
+    """
+
+    def __init__(self, path, max_size):
+        """
+        :param path: cache directory
+        :param max_size: maximum total size of cache files in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Create cache key from given values
+        :param parts: values that affect the cached state
+        :return: key string
+        """
+        return hashlib.sha256(repr((CACHE_VERSION,) + parts).encode()).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + CACHE_EXT)
+
+    def _entries(self):
+        """
+        Get cache entry files
+        :return: list of (last use time, size, path)
+        """
+        if not os.path.isdir(self.path):
+            return []
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(CACHE_EXT):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def load(self, key):
+        """
+        Load cached state
+        :param key: cache key
+        :return: cached object or None if not found
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            state = pickle.loads(zlib.decompress(data))
+        except Exception:
+            # broken or from an incompatible version
+            self.invalidate(key)
+            return None
+        os.utime(path)
+        return state
+
+    def store(self, key, state):
+        """
+        Store state to cache and remove least recently used entries if cache is full
+        :param key: cache key
+        :param state: picklable object
+        :return: none
+        """
+        os.makedirs(self.path, exist_ok=True)
+        path = self._entry_path(key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL)))
+        os.replace(tmp_path, path)
+        self.trim()
+
+    def trim(self):
+        """
+        Remove least recently used entries until cache size is within the limit
+        :return: none
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def invalidate(self, key=None):
+        """
+        Remove cache entry, or all entries if key is not given
+        :param key: cache key
+        :return: none
+        """
+        if key is not None:
+            paths = [self._entry_path(key)]
+        else:
+            paths = [path for _, _, path in self._entries()]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -24,13 +24,14 @@ class PrePrime:
         self.start_pos_x = None
         self.start_pos_y = None
 
-        self.width =settings.get_hw_config_float_value("prerun.prime.length")
-        self.elength = settings.get_hw_config_float_value("prerun.prime.extrusion.length")
-        self.speed = settings.get_hw_config_int_value("prerun.prime.speed")
-        self.gap = settings.get_hw_config_float_value("prerun.prime.gap")
-        self.purgecount = settings.get_hw_config_int_value("prerun.prime.purge.count")
-        self.xstart = settings.get_hw_config_float_value("prerun.prime.xstart")
-        self.ystart = settings.get_hw_config_float_value("prerun.prime.ystart")
+        hw = settings.hw
+        self.width = hw.prerun_prime_length
+        self.elength = hw.prerun_prime_extrusion_length
+        self.speed = hw.prerun_prime_speed
+        self.gap = hw.prerun_prime_gap
+        self.purgecount = hw.prerun_prime_purge_count
+        self.xstart = hw.prerun_prime_xstart
+        self.ystart = hw.prerun_prime_ystart
         self.warnings_shown = False
 
         # index of the extruder that's primed last
@@ -40,86 +41,59 @@ class PrePrime:
         """
 
         """
-        e_length = self.settings.get_hw_config_float_value("prerun.prime.extrusion.length")
+        e_length = self.elength
 
-        sweep_speed = self.settings.get_hw_config_float_value("prerun.prime.speed")
-        sweep_gap = self.settings.get_hw_config_float_value("prerun.prime.gap")
-        sweep_gap_speed = self.settings.get_hw_config_float_value("prepurge.sweep.gap.speed")
+        sweep_speed = self.speed
+        sweep_gap = self.gap
+        sweep_gap_speed = self.settings.hw.prepurge_sweep_gap_speed
 
-        for _ in range(self.settings.get_hw_config_int_value("prerun.prime.purge.count")):
+        for _ in range(self.purgecount):
             yield gcode.gen_direction_move(self.horizontal_dir, self.width, sweep_speed, 0.2, extruder=extruder,
                                            e_length=e_length), b" purge trail"
             yield gcode.gen_direction_move(self.vertical_dir, sweep_gap, sweep_gap_speed, 0.2), b" Y shift"
             self.horizontal_dir = gcode.opposite_dir(self.horizontal_dir)
 
     def get_retract_gcode(self, extruder):
-        i = 0
-        while True:
-            try:
-                rr_len = self.settings.get_hw_config_float_value("rapid.retract.initial[{}].length".format(i))
-                rr_speed = self.settings.get_hw_config_float_value("rapid.retract.initial[{}].speed".format(i))
-                yield gcode.gen_extruder_move(-rr_len, rr_speed), b" rapid retract"
-                i += 1
-            except TypeError:
-                if i == 0 and not self.warnings_shown:
-                    self.log.warning("No rapid.retract.initial[N].length or .speed found. Please check the HW-config")
-                break
-        i = 0
-
-        pause = self.settings.get_hw_config_float_value("rapid.retract.pause")
+        hw = self.settings.hw
+        if not hw.rapid_retract_initial and not self.warnings_shown:
+            self.log.warning("No rapid.retract.initial[N].length or .speed found. Please check the HW-config")
+        for rr_len, rr_speed in hw.rapid_retract_initial:
+            yield gcode.gen_extruder_move(-rr_len, rr_speed), b" rapid retract"
+
+        pause = hw.rapid_retract_pause
         if pause:
             yield gcode.gen_pause(pause), b" cooling period"
 
-        while True:
-            try:
-                rr_long_len = self.settings.get_hw_config_float_value("rapid.retract.long[{}].length".format(i))
-                rr_long_speed = self.settings.get_hw_config_float_value("rapid.retract.long[{}].speed".format(i))
-                yield gcode.gen_extruder_move(-rr_long_len, rr_long_speed), b" long retract"
-                i += 1
-            except TypeError:
-                if i == 0 and not self.warnings_shown:
-                    self.log.warning("No rapid.retract.long[N].length or .speed found. Please check the HW-config")
-                break
+        if not hw.rapid_retract_long and not self.warnings_shown:
+            self.log.warning("No rapid.retract.long[N].length or .speed found. Please check the HW-config")
+        for rr_long_len, rr_long_speed in hw.rapid_retract_long:
+            yield gcode.gen_extruder_move(-rr_long_len, rr_long_speed), b" long retract"
 
         #cooling retracts, also serves as wipe
 
-        i = 0
-        while True:
-            try:
-                rr_cool_len = self.settings.get_hw_config_float_value("rapid.retract.cool[{}].length".format(i))
-                rr_cool_speed = self.settings.get_hw_config_float_value("rapid.retract.cool[{}].speed".format(i))
-                yield gcode.gen_direction_move(self.horizontal_dir, self.width, rr_cool_speed, 0.2, extruder=extruder,
-                                               e_length=rr_cool_len), b" cooling"
-                self.horizontal_dir = gcode.opposite_dir(self.horizontal_dir)
-                i += 1
-            except TypeError:
-                if i == 0 and not self.warnings_shown:
-                    self.log.warning("No cooling steps. That's OK.")
-                break
+        if not hw.rapid_retract_cool and not self.warnings_shown:
+            self.log.warning("No cooling steps. That's OK.")
+        for rr_cool_len, rr_cool_speed in hw.rapid_retract_cool:
+            yield gcode.gen_direction_move(self.horizontal_dir, self.width, rr_cool_speed, 0.2, extruder=extruder,
+                                           e_length=rr_cool_len), b" cooling"
+            self.horizontal_dir = gcode.opposite_dir(self.horizontal_dir)
 
         # account for retract mismatch in preprime, caused by slower initial purge
-        finetune = self.settings.get_hw_config_value("prerun.finetune.length")
-        if finetune:
-            yield gcode.gen_extruder_move(float(finetune), 500), b" preprime finetune"
+        finetune = hw.prerun_finetune_length
+        if finetune is not None:
+            yield gcode.gen_extruder_move(finetune, 500), b" preprime finetune"
 
         self.horizontal_dir = E
 
     def get_feed_gcode(self, extruder):
         
-        i = 0
         #initial load using standard feed length and speed
-        while True:
-            try:
-                feed_len = self.settings.get_hw_config_float_value("feed[{}].length".format(i))
-                feed_speed = self.settings.get_hw_config_float_value("feed[{}].speed".format(i))
-                yield gcode.gen_direction_move(self.horizontal_dir, self.width, feed_speed, 0.2, extruder=extruder,
-                                               e_length=feed_len, e_speed=True), b" prime move"
-                self.horizontal_dir = gcode.opposite_dir(self.horizontal_dir)
-                i += 1
-            except TypeError:
-                if i == 0 and not self.warnings_shown:
-                    self.log.warning("No prime move steps. That's OK.")
-                break
+        if not self.settings.hw.feed and not self.warnings_shown:
+            self.log.warning("No prime move steps. That's OK.")
+        for feed_len, feed_speed in self.settings.hw.feed:
+            yield gcode.gen_direction_move(self.horizontal_dir, self.width, feed_speed, 0.2, extruder=extruder,
+                                           e_length=feed_len, e_speed=True), b" prime move"
+            self.horizontal_dir = gcode.opposite_dir(self.horizontal_dir)
 
     def get_prime_lines(self):
         """
@@ -0,0 +1,201 @@
+import concurrent.futures
+import copy
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import time
+import urllib.parse
+
+import batch
+from settings import TOWER_POSITIONS, INFILL_STYLES
+
+PROCESS_PATH = "/process"
+STATUS_PATH = "/status"
+
+# query parameter: (settings attribute, conversion)
+QUERY_OPTIONS = {
+    "hw_config": ("hw_config", str),
+    "lines": ("purge_lines", int),
+    "position": ("tower_position", str),
+    "tower_force": ("tower_force", str),
+    "force_raft": ("force_raft", lambda value: value.lower() in ("1", "true")),
+    "brim_count": ("brim", int),
+    "raft_multi": ("raft_multi", int),
+    "purge_multi": ("purge_multi", int),
+    "purge_speed": ("purge_speed", int),
+    "tower_fan_off": ("tower_fan_off", lambda value: value.lower() in ("1", "true")),
+    "infill_style": ("infill_style", str),
+    "optimize_tool_order": ("optimize_tool_order", lambda value: value.lower() in ("1", "true")),
+    "estimate_time": ("estimate_time", lambda value: value.lower() in ("1", "true")),
+    "m73_progress": ("m73_progress", lambda value: value.lower() in ("1", "true")),
+}
+
+
+def request_settings(base, query):
+    """
+    Create settings for one request. Query parameters override the server defaults
+    :param base: server Settings object
+    :param query: parsed query string, {name: [values]}
+    :return: Settings object
+    """
+    settings = copy.copy(base)
+    for name, values in query.items():
+        if name not in QUERY_OPTIONS:
+            raise ValueError("Unknown option: %s" % name)
+        attr, convert = QUERY_OPTIONS[name]
+        setattr(settings, attr, convert(values[-1]))
+
+    if settings.hw_config not in settings.get_hw_config_names():
+        raise ValueError("Unknown hw_config: %s" % settings.hw_config)
+    if settings.tower_position not in TOWER_POSITIONS:
+        raise ValueError("Unknown position: %s" % settings.tower_position)
+    if settings.infill_style not in INFILL_STYLES:
+        raise ValueError("Unknown infill_style: %s" % settings.infill_style)
+    return settings
+
+
+def process_gcode(data, settings):
+    """
+    Process g-code data in a temporary directory. Run in worker process
+    :param data: g-code file content
+    :param settings: Settings object
+    :return: (FileResult, processed file content or None on error)
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="filaswitch")
+    try:
+        path = os.path.join(tmp_dir, "job.gcode")
+        with open(path, "wb") as f:
+            f.write(data)
+        result = batch.process_file(path, settings)
+        if result.error:
+            return result, None
+        with open(result.new_file, "rb") as f:
+            return result, f.read()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    POST /process with g-code as request body and settings in query string returns the processed g-code.
+    GET /status returns server status as JSON
+    """
+
+    def address_string(self):
+        # unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        self.server.log.debug("%s - %s" % (self.address_string(), format % args))
+
+    def _send(self, code, body, content_type="text/plain", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != STATUS_PATH:
+            self._send(404, b"Not found\n")
+            return
+        status = {
+            "hw_configs": sorted(self.server.settings.get_hw_config_names()),
+            "jobs": self.server.jobs,
+            "requests": self.server.requests,
+            "failed": self.server.failed,
+        }
+        self._send(200, json.dumps(status).encode(), "application/json")
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != PROCESS_PATH:
+            self._send(404, b"Not found\n")
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self._send(411, b"Content-Length required\n")
+            return
+        data = self.rfile.read(int(length))
+
+        try:
+            settings = request_settings(self.server.settings, urllib.parse.parse_qs(url.query))
+        except ValueError as e:
+            self._send(400, ("%s\n" % e).encode())
+            return
+
+        result, output = self.server.executor.submit(process_gcode, data, settings).result()
+        total_time = time.perf_counter() - start
+        self.server.requests += 1
+        timing = "process;dur={:.1f}, total;dur={:.1f}".format(result.wall_time * 1000, total_time * 1000)
+        if result.error:
+            self.server.failed += 1
+            self.server.log.error("Request failed in {:.2f} s: {}".format(total_time, result.error))
+            self._send(422, ("%s\n" % result.error).encode(), headers={"Server-Timing": timing})
+            return
+
+        self.server.log.info("Processed {} lines, {} tool changes in {:.2f} s (total {:.2f} s)".format(
+            result.lines, result.tool_changes, result.wall_time, total_time))
+        headers = {
+            "Server-Timing": timing,
+            "X-Filaswitch-Lines": str(result.lines),
+            "X-Filaswitch-Tool-Changes": str(result.tool_changes),
+        }
+        self._send(200, output, "text/x.gcode", headers)
+
+
+class ServerMixIn(socketserver.ThreadingMixIn):
+    """
+    Handles requests in threads, processing is done in a shared process pool
+    """
+    daemon_threads = True
+
+    def setup_processing(self, settings, log, jobs):
+        self.settings = settings
+        self.log = log
+        self.jobs = jobs or os.cpu_count()
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+        self.requests = 0
+        self.failed = 0
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+
+class ProcessingHTTPServer(ServerMixIn, http.server.HTTPServer):
+    pass
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class ProcessingUnixServer(ServerMixIn, socketserver.UnixStreamServer):
+        pass
+
+
+def create_server(settings, log, jobs=None, host="127.0.0.1", port=8080, socket_path=None):
+    """
+    Create processing server
+    :param settings: default settings for requests
+    :param log: logger
+    :param jobs: number of worker processes, CPU count by default
+    :param host: address to listen
+    :param port: port to listen, 0 picks a free port
+    :param socket_path: listen Unix socket instead of TCP port
+    :return: server
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ProcessingUnixServer(socket_path, RequestHandler)
+    else:
+        server = ProcessingHTTPServer((host, port), RequestHandler)
+    server.setup_processing(settings, log, jobs)
+    return server
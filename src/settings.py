@@ -21,6 +21,177 @@ INFILL_ZIGZAG = "ZigZag"
 INFILL_BLOCKY = "Blocky"
 INFILL_STYLES = [INFILL_ZIGZAG, INFILL_BLOCKY]
 
+# parse cache size limit in bytes
+CACHE_SIZE_DEFAULT = 512 * 1024 * 1024
+
+
+# purge matrix units, filament volume or post purge lines
+PURGE_MM3 = "mm3"
+PURGE_LINES = "lines"
+
+
+def _to_bool(value):
+    return value.lower() == "true"
+
+
+class HwConfig:
+    """
+    Hw configuration compiled to typed attributes. Values are converted and checked once when the config is
+    selected, tower generation reads the attributes instead of looking up and converting keys.
+    Length/speed arrays are lists of (length, speed) tuples.
+    """
+
+    # attribute: (key, type, required)
+    VALUES = (
+        ("temperature_command", "tool.temperature.command", str, False),
+        ("temperature_use_id", "tool.temperature.use_id", _to_bool, False),
+        ("wait_on_change", "tool.wait_on_change", _to_bool, False),
+        ("reset_feed", "tool.reset_feed", _to_bool, False),
+        ("motor_current_load", "motor.current.load", int, True),
+        ("motor_current_run", "motor.current.run", int, True),
+        ("prepurge_initial_retract", "prepurge.initial.retract", int, False),
+        ("prepurge_initial_retract_speed", "prepurge.initial.retract.speed", int, False),
+        ("prepurge_initial_pause", "prepurge.initial.pause", int, False),
+        ("prepurge_temperature_change", "prepurge.temperature.change", float, True),
+        ("prepurge_sweep_length", "prepurge.sweep.length", float, True),
+        ("prepurge_sweep_extrusion_length", "prepurge.sweep.extrusion.length", float, True),
+        ("prepurge_sweep_speed", "prepurge.sweep.speed", float, True),
+        ("prepurge_sweep_count", "prepurge.sweep.count", int, True),
+        ("prepurge_sweep_gap", "prepurge.sweep.gap", float, True),
+        ("prepurge_sweep_gap_speed", "prepurge.sweep.gap.speed", float, True),
+        ("prerun_prime", "prerun.prime", _to_bool, False),
+        ("prerun_prime_length", "prerun.prime.length", float, False),
+        ("prerun_prime_extrusion_length", "prerun.prime.extrusion.length", float, False),
+        ("prerun_prime_gap", "prerun.prime.gap", float, False),
+        ("prerun_prime_speed", "prerun.prime.speed", int, False),
+        ("prerun_prime_xstart", "prerun.prime.xstart", float, False),
+        ("prerun_prime_ystart", "prerun.prime.ystart", float, False),
+        ("prerun_prime_purge_count", "prerun.prime.purge.count", int, False),
+        ("prerun_finetune_length", "prerun.finetune.length", float, False),
+        ("rapid_retract_wipe", "rapid.retract.wipe", _to_bool, False),
+        ("rapid_retract_pause", "rapid.retract.pause", float, True),
+        ("feed_trail", "feed.trail", _to_bool, False),
+        ("prime_trail_extrusion_length", "prime.trail.extrusion.length", float, True),
+        ("prime_trail_speed", "prime.trail.speed", float, True),
+        ("post_tower_coast", "post.tower.coast", float, False),
+        ("purge_matrix_unit", "purge.matrix.unit", str, False),
+        ("acceleration", "machine.acceleration", float, False),
+        ("retract_acceleration", "machine.acceleration.retract", float, False),
+        ("junction_deviation", "machine.junction_deviation", float, False),
+        ("jerk_xy", "machine.jerk.xy", float, False),
+        ("jerk_z", "machine.jerk.z", float, False),
+        ("jerk_e", "machine.jerk.e", float, False),
+    )
+
+    # attribute: key prefix of [N].length and [N].speed arrays
+    ARRAYS = (
+        ("rapid_retract_initial", "rapid.retract.initial"),
+        ("rapid_retract_long", "rapid.retract.long"),
+        ("rapid_retract_cool", "rapid.retract.cool"),
+        ("feed", "feed"),
+    )
+
+    PURGE_MATRIX_UNITS = (PURGE_MM3, PURGE_LINES)
+
+    __slots__ = ("name", "purge_matrix") + tuple(v[0] for v in VALUES) + tuple(a[0] for a in ARRAYS)
+
+    def __init__(self, name, values):
+        """
+        :param name: hw config name
+        :param values: {key: value string} of the hw config file
+        """
+        self.name = name
+        for attr, key, _type, required in self.VALUES:
+            value = values.get(key) or None
+            if value is None:
+                if required:
+                    raise ValueError("Missing '{}' in hw config {}".format(key, name))
+                # missing flags are off
+                if _type is _to_bool:
+                    value = False
+            else:
+                try:
+                    value = _type(value)
+                except ValueError:
+                    raise ValueError("Cannot parse {} value for key '{}' in hw config {}".format(_type.__name__, key,
+                                                                                               name))
+            setattr(self, attr, value)
+
+        for attr, prefix in self.ARRAYS:
+            setattr(self, attr, self._parse_array(name, values, prefix))
+
+        # initial retract is used only if all the values are given
+        if None in (self.prepurge_initial_retract, self.prepurge_initial_retract_speed, self.prepurge_initial_pause):
+            self.prepurge_initial_retract = None
+            self.prepurge_initial_retract_speed = None
+            self.prepurge_initial_pause = None
+
+        if self.prerun_prime:
+            for attr, key, _, _ in self.VALUES:
+                if attr.startswith("prerun_prime_") and getattr(self, attr) is None:
+                    raise ValueError("Missing '{}' in hw config {}, needed by prerun.prime".format(key, name))
+
+        self.purge_matrix = self._parse_purge_matrix(name, values)
+        if self.purge_matrix_unit is None:
+            self.purge_matrix_unit = PURGE_MM3
+        elif self.purge_matrix_unit not in self.PURGE_MATRIX_UNITS:
+            raise ValueError("Unknown purge.matrix.unit '{}' in hw config {}".format(self.purge_matrix_unit, name))
+
+    @staticmethod
+    def _parse_purge_matrix(name, values):
+        """
+        Parse purge.matrix[N] rows. Row N has the purge amounts when switching from tool N to each tool
+        :param name: hw config name
+        :param values: hw config values
+        :return: {(old tool, new tool): amount}
+        """
+        rows = []
+        while True:
+            row = values.get("purge.matrix[{}]".format(len(rows)))
+            if not row:
+                break
+            try:
+                rows.append([float(v) for v in row.split(",")])
+            except ValueError:
+                raise ValueError("Cannot parse purge.matrix[{}] in hw config {}".format(len(rows), name))
+
+        matrix = {}
+        for old, row in enumerate(rows):
+            if len(row) != len(rows):
+                raise ValueError("purge.matrix[{}] in hw config {} should have {} values".format(old, name,
+                                                                                                  len(rows)))
+            for new, amount in enumerate(row):
+                if amount < 0:
+                    raise ValueError("Negative purge.matrix[{}] value in hw config {}".format(old, name))
+                matrix[(old, new)] = amount
+        return matrix
+
+    @staticmethod
+    def _parse_array(name, values, prefix):
+        """
+        Parse prefix[N].length and prefix[N].speed values, N starting from 0
+        :param name: hw config name
+        :param values: hw config values
+        :param prefix: array key prefix
+        :return: list of (length, speed)
+        """
+        lengths = []
+        speeds = []
+        for items, field in ((lengths, "length"), (speeds, "speed")):
+            while True:
+                key = "{}[{}].{}".format(prefix, len(items), field)
+                value = values.get(key)
+                if not value:
+                    break
+                try:
+                    items.append(float(value))
+                except ValueError:
+                    raise ValueError("Cannot parse float value for key '{}' in hw config {}".format(key, name))
+        if len(lengths) != len(speeds):
+            raise ValueError("Not equal amount of {} length and speed parameters in hw config {}. Check hwcfg".format(
+                prefix, name))
+        return list(zip(lengths, speeds))
+
 
 class Settings:
 
@@ -60,8 +231,17 @@ class Settings:
         self._tower_fan_off = None
         self._infill_style = INFILL_ZIGZAG
 
+        # processing options
+        self._stream = False
+        self._optimize_tool_order = False
+        self._estimate_time = False
+        self._m73_progress = False
+        self._cache_dir = None
+        self._cache_size = CACHE_SIZE_DEFAULT
+
+        # parsed hw configs, loaded when selected
         self.hw_configurations = {}
-        self.read_hw_configs()
+        self._hw = None
 
     @property
     def hw_config(self):
@@ -69,8 +249,24 @@ class Settings:
 
     @hw_config.setter
     def hw_config(self, value):
+        if value and value not in self.hw_configurations:
+            path = os.path.join(self.hw_config_dir(), value + ".hwcfg")
+            if os.path.exists(path):
+                self.parse_hw_cfg(value, path)
+        hw_config = self.hw_configurations.get(value)
+        self._hw = HwConfig(value, hw_config) if hw_config is not None else None
         self._hw_config = value
 
+    @property
+    def hw(self):
+        """
+        Compiled active hw config
+        :return: HwConfig
+        """
+        if self._hw is None:
+            raise ValueError("Active HW configuration not defined")
+        return self._hw
+
     @property
     def purge_lines(self):
         return self._purge_lines
@@ -231,6 +427,54 @@ class Settings:
             raise ValueError("Unknown infill style {}".format(value))
         self._infill_style = value
 
+    @property
+    def stream(self):
+        return self._stream
+
+    @stream.setter
+    def stream(self, value: bool):
+        self._stream = value
+
+    @property
+    def optimize_tool_order(self):
+        return self._optimize_tool_order
+
+    @optimize_tool_order.setter
+    def optimize_tool_order(self, value: bool):
+        self._optimize_tool_order = value
+
+    @property
+    def estimate_time(self):
+        return self._estimate_time
+
+    @estimate_time.setter
+    def estimate_time(self, value: bool):
+        self._estimate_time = value
+
+    @property
+    def m73_progress(self):
+        return self._m73_progress
+
+    @m73_progress.setter
+    def m73_progress(self, value: bool):
+        self._m73_progress = value
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @cache_dir.setter
+    def cache_dir(self, value: str):
+        self._cache_dir = value
+
+    @property
+    def cache_size(self):
+        return self._cache_size
+
+    @cache_size.setter
+    def cache_size(self, value: int):
+        self._cache_size = value
+
     @property
     def extrusion_width(self):
         return self._extrusion_width
@@ -281,26 +525,28 @@ class Settings:
     def purge_speed(self, value: int):
         self._purge_speed = value
 
-    def read_hw_configs(self):
+    def hw_config_dir(self):
         _dir = os.path.dirname(os.path.realpath(__file__))
         root_dir = os.path.realpath(os.path.join(_dir, ".."))
-        hw_dir = os.path.join(root_dir, self.HW_CFG_DIR)
-        for f in os.listdir(hw_dir):
-            path = os.path.join(hw_dir, f)
-            if f.endswith(".hwcfg"):
-                cfg_name = os.path.splitext(f)[0]
-                self.parse_hw_cfg(cfg_name, path)
+        return os.path.join(root_dir, self.HW_CFG_DIR)
 
-    def parse_hw_cfg(self, cfg_name, cfg_path):
-        self.hw_configurations[cfg_name] = {}
-        self.hw_configurations[cfg_name]["path"] = cfg_path
+    def read_hw_configs(self):
+        hw_dir = self.hw_config_dir()
+        for cfg_name in self.get_hw_config_names():
+            self.parse_hw_cfg(cfg_name, os.path.join(hw_dir, cfg_name + ".hwcfg"))
 
-        cfg = utils.load_status(cfg_path)
-        for k, v in cfg.items():
-            self.hw_configurations[cfg_name][k] = v
+    def parse_hw_cfg(self, cfg_name, cfg_path):
+        hw_config = {"path": cfg_path}
+        hw_config.update(utils.load_status(cfg_path))
+        # assign only when complete, settings may be shared between threads
+        self.hw_configurations[cfg_name] = hw_config
 
     def get_hw_config_names(self):
-        return list(self.hw_configurations.keys())
+        """
+        Get names of available hw configs without parsing them
+        :return: list of names
+        """
+        return [os.path.splitext(f)[0] for f in os.listdir(self.hw_config_dir()) if f.endswith(".hwcfg")]
 
     def get_hw_config_value(self, key):
         if not self.hw_config:
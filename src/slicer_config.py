@@ -0,0 +1,109 @@
+class SlicerConfig:
+    """
+    Slicer configuration block as {key: raw value} dictionary. Values are kept as byte strings and
+    converted only when they are read.
+    Lines after a section marker are also stored to the config of that section, keys outside
+    sections are in the main config only. Later values override earlier ones.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.sections = {}
+
+    @classmethod
+    def from_comments(cls, comments, separator, section_re=None):
+        """
+        Split config comments to key/value pairs
+        :param comments: comment lines of the config block
+        :param separator: key/value separator
+        :param section_re: compiled regex matching section marker comments, group 1 is the section name
+        :return: SlicerConfig
+        """
+        config = cls()
+        section = None
+        for comment in comments:
+            if section_re is not None:
+                m = section_re.match(comment)
+                if m:
+                    section = config.sections[m.group(1)] = cls()
+                    continue
+            key, sep, value = comment.partition(separator)
+            if not sep:
+                continue
+            key = key.strip()
+            value = value.strip()
+            config.values[key] = value
+            if section is not None:
+                section.values[key] = value
+        return config
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def keys(self):
+        """
+        Get config keys
+        :return: keys
+        """
+        return self.values.keys()
+
+    def get(self, key, default=None):
+        """
+        Get raw value
+        :param key: config key
+        :param default: value returned if key is not found
+        :return: byte string or default
+        """
+        return self.values.get(key, default)
+
+    def get_float(self, key, default=None):
+        """
+        Get value as float
+        :param key: config key
+        :param default: value returned if key is not found
+        :return: float or default
+        """
+        value = self.values.get(key)
+        if value is None:
+            return default
+        return float(value)
+
+    def get_int(self, key, default=None):
+        """
+        Get value as int
+        :param key: config key
+        :param default: value returned if key is not found
+        :return: int or default
+        """
+        value = self.values.get(key)
+        if value is None:
+            return default
+        return int(value)
+
+    def get_list(self, key, convert=None, separator=b","):
+        """
+        Get value split to list, e.g. per extruder values
+        :param key: config key
+        :param convert: function to convert each item, items are byte strings if not given
+        :param separator: item separator
+        :return: list, empty if key is not found
+        """
+        value = self.values.get(key)
+        if value is None:
+            return []
+        items = value.split(separator)
+        if convert is None:
+            return items
+        return [convert(item) for item in items]
+
+
+def to_bool(value):
+    """
+    Convert config flag to boolean
+    :param value: byte string
+    :return: true if value is 1
+    """
+    return value == b"1"
@@ -3,6 +3,7 @@ import re
 from extruder import Extruder
 from gcode import GCode
 from layer import FirstLayer, ACT_INFILL, ACT_PASS, ACT_SWITCH, Layer
+from slicer_config import SlicerConfig
 
 import utils
 from gcode_file import SLICER_KISSLICER, GCodeFile
@@ -20,14 +21,17 @@ class KISSlicerGCodeFile(GCodeFile):
     LAYER_START_RE = re.compile(b" BEGIN_LAYER_OBJECT z=(\d+\.*\d*) z_thickness=(\d+\.*\d*)")
     VERSION_RE = re.compile(b"version (\d+)\.(\d+).*")
     VERSION_2_RE = re.compile(b"version 2 a (\d+)\.(\d+).*")
+    MATERIAL_SECTION_RE = re.compile(b".*Material Settings for Extruder (\d+)")
 
     def __init__(self, logger, settings: Settings):
         super().__init__(logger, settings)
 
     def process(self, gcode_file):
-        self.open_file(gcode_file)
-        self.parse_header()
-        self.parse_print_settings()
+        if not self.load_parsed(gcode_file):
+            self.open_file(gcode_file)
+            self.parse_header()
+            self.parse_print_settings()
+            self.store_parsed()
         self.filter_layers()
         self.parse_perimeter_rates()
         if len(self.tools) > 1:
@@ -76,117 +80,72 @@ class KISSlicerGCodeFile(GCodeFile):
         :return: none
         """
 
-        current_tool = None
-
-        ext_re = re.compile(b".*Material Settings for Extruder (\d+)")
-
-        for layer in self.layers:
-            for cmd, comment in layer.lines:
-                if cmd:
-                    continue
-
-                elif b" bed_size_x_mm =" in comment:
-                    #; bed_size_x_mm = 145
-                    self.settings.stroke_x = float(comment.split(b' = ')[1])
-                elif b" bed_size_y_mm =" in comment:
-                    #; bed_size_y_mm = 145
-                    self.settings.stroke_y = float(comment.split(b' = ')[1])
-                elif b" bed_offset_x_mm =" in comment:
-                    #; bed_offset_x_mm = 72.5
-                    self.settings.origin_offset_x = float(comment.split(b' = ')[1])
-                elif b" bed_offset_y_mm =" in comment:
-                    #; bed_offset_y_mm = 72.5
-                    self.settings.origin_offset_y = float(comment.split(b' = ')[1])
-                elif b" bed_offset_z_mm =" in comment:
-                    #; bed_offset_z_mm = 0
-                    self.settings.z_offset = float(comment.split(b' = ')[1])
-                elif b" round_bed =" in comment:
-                    # ; round_bed = 0
-                    self.settings.machine_type = int(comment.split(b' = ')[1])
-                elif b" travel_speed_mm_per_s =" in comment:
-                    # ; travel_speed_mm_per_s = 100
-                    speed = float(comment.split(b' = ')[1]) * 60
-                    self.settings.travel_xy_speed = speed
-                    self.settings.travel_z_speed = speed
-
-                elif b" num_extruders = " in comment:
-                    # ; num_extruders = 4
-                    for t in range(int(comment.split(b' = ')[1])):
-                        if t not in self.extruders:
-                            self.extruders[t] = Extruder(t)
-                            self.extruders[t].temperature_nr = t
-
-                elif b" nozzle_dia" in comment:
-                    # ; nozzle_dia_1 = 0.4
-                    parts = comment.split(b" = ")
-                    dia = float(parts[1])
-                    t_num = int(parts[0].split(b"_")[2]) - 1
-                    if t_num not in self.extruders:
-                        self.extruders[t_num] = Extruder(t_num)
-                    self.extruders[t_num].nozzle = dia
-
-                elif b" first_layer_speed_mm_per_s =" in comment:
-                    # ; first_layer_speed_mm_per_s = 25
-                    self.settings.first_layer_speed = float(comment.split(b' = ')[1]) * 60
-
-                elif b" Perimeter Speed =" in comment:
-                    # ; Perimeter Speed = 32.50
-                    self.settings.outer_perimeter_speed = float(comment.split(b' = ')[1]) * 60
-
-                elif b" Loops Speed =" in comment:
-                    # ; Loops Speed = 45.50
-                    self.settings.default_speed = float(comment.split(b' = ')[1]) * 60
-
-                elif b" extrusion_width =" in comment:
-                    # ; extrusion_width = 0.45
-                    self.settings.extrusion_width = float(comment.split(b' = ')[1])
-
-                elif b" *** Material Settings for Extruder" in comment:
-                    # ; *** Material Settings for Extruder 2 ***
-                    m = ext_re.match(comment)
-                    current_tool = int(m.groups()[0]) - 1
-
-                elif current_tool is not None and b" destring_length =" in comment:
-                    # ; destring_length = 3
-                    self.extruders[current_tool].retract = float(comment.split(b' = ')[1])
-
-                elif current_tool is not None and b" destring_speed_mm_per_s =" in comment:
-                    # ; destring_speed_mm_per_s = 80
-                    self.extruders[current_tool].retract_speed = float(comment.split(b' = ')[1]) * 60
-
-                elif current_tool is not None and b" Z_lift_mm =" in comment:
-                    # ; Z_lift_mm = 0
-                    self.extruders[current_tool].z_hop = float(comment.split(b' = ')[1])
-
-                elif current_tool is not None and b" wipe_mm =" in comment:
-                    # ; wipe_mm = 5
-                    self.extruders[current_tool].wipe = float(comment.split(b' = ')[1])
-
-                elif current_tool is not None and b" flowrate_tweak =" in comment:
-                    # ; flowrate_tweak = 1
-                    self.extruders[current_tool].feed_rate_multiplier = float(comment.split(b' = ')[1])
-
-                elif current_tool is not None and b" g_code_matl =" in comment:
-                    # ; g_code_matl = NULL
-                    self.extruders[current_tool].filament_type = comment.split(b' = ')[1]
-
-                elif current_tool is not None and b" first_layer_C =" in comment:
-                    # ; first_layer_C = 235
-                    self.extruders[current_tool].temperature_setpoints[1] = int(comment.split(b' = ')[1])
-
-                elif current_tool is not None and b" temperature_C =" in comment:
-                    # ; temperature_C = 242
-                    self.extruders[current_tool].temperature_setpoints[2] = int(comment.split(b' = ')[1])
-
-                elif b" firmware_type =" in comment:
-                    # ; firmware_type = 1
-                    if comment.split(b' = ')[1] != b"1":
-                        raise ValueError("Relative E distances not enabled! Filaswitch won't work without relative E distances")
-
-                elif b"; force_joint_layers =" in comment:
-                    # ; force_joint_layers = 0
-                    if comment.split(b' = ')[1] != b"1":
-                        self.log.warning("KISS joint layer division is not enabled. This might cause unexpected behaviour with tower size")
+        self.config = config = SlicerConfig.from_comments(self.read_config_comments(self.layers[0].lines), b"=",
+                                                          self.MATERIAL_SECTION_RE)
+
+        #; bed_size_x_mm = 145
+        self.settings.stroke_x = config.get_float(b"bed_size_x_mm", self.settings.stroke_x)
+        self.settings.stroke_y = config.get_float(b"bed_size_y_mm", self.settings.stroke_y)
+        #; bed_offset_x_mm = 72.5
+        self.settings.origin_offset_x = config.get_float(b"bed_offset_x_mm", self.settings.origin_offset_x)
+        self.settings.origin_offset_y = config.get_float(b"bed_offset_y_mm", self.settings.origin_offset_y)
+        self.settings.z_offset = config.get_float(b"bed_offset_z_mm", self.settings.z_offset)
+        # ; round_bed = 0
+        self.settings.machine_type = config.get_int(b"round_bed", self.settings.machine_type)
+        if b"travel_speed_mm_per_s" in config:
+            # ; travel_speed_mm_per_s = 100
+            speed = config.get_float(b"travel_speed_mm_per_s") * 60
+            self.settings.travel_xy_speed = speed
+            self.settings.travel_z_speed = speed
+
+        # ; num_extruders = 4
+        for t in range(config.get_int(b"num_extruders", 0)):
+            if t not in self.extruders:
+                self.extruders[t] = Extruder(t)
+                self.extruders[t].temperature_nr = t
+
+        for key in config.keys():
+            if key.startswith(b"nozzle_dia"):
+                # ; nozzle_dia_1 = 0.4
+                t_num = int(key.split(b"_")[2]) - 1
+                if t_num not in self.extruders:
+                    self.extruders[t_num] = Extruder(t_num)
+                self.extruders[t_num].nozzle = config.get_float(key)
+
+        # ; first_layer_speed_mm_per_s = 25
+        if b"first_layer_speed_mm_per_s" in config:
+            self.settings.first_layer_speed = config.get_float(b"first_layer_speed_mm_per_s") * 60
+        if b"Perimeter Speed" in config:
+            self.settings.outer_perimeter_speed = config.get_float(b"Perimeter Speed") * 60
+        if b"Loops Speed" in config:
+            self.settings.default_speed = config.get_float(b"Loops Speed") * 60
+        # ; extrusion_width = 0.45
+        self.settings.extrusion_width = config.get_float(b"extrusion_width", self.settings.extrusion_width)
+
+        # ; *** Material Settings for Extruder 2 ***
+        for number, material in config.sections.items():
+            extruder = self.extruders[int(number) - 1]
+            extruder.retract = material.get_float(b"destring_length", extruder.retract)
+            if b"destring_speed_mm_per_s" in material:
+                extruder.retract_speed = material.get_float(b"destring_speed_mm_per_s") * 60
+            extruder.z_hop = material.get_float(b"Z_lift_mm", extruder.z_hop)
+            extruder.wipe = material.get_float(b"wipe_mm", extruder.wipe)
+            extruder.feed_rate_multiplier = material.get_float(b"flowrate_tweak", extruder.feed_rate_multiplier)
+            # ; g_code_matl = NULL
+            extruder.filament_type = material.get(b"g_code_matl", extruder.filament_type)
+            # ; first_layer_C = 235
+            if b"first_layer_C" in material:
+                extruder.temperature_setpoints[1] = material.get_int(b"first_layer_C")
+            if b"temperature_C" in material:
+                extruder.temperature_setpoints[2] = material.get_int(b"temperature_C")
+
+        value = config.get(b"firmware_type")
+        if value is not None and value != b"1":
+            raise ValueError("Relative E distances not enabled! Filaswitch won't work without relative E distances")
+
+        value = config.get(b"force_joint_layers")
+        if value is not None and value != b"1":
+            self.log.warning("KISS joint layer division is not enabled. This might cause unexpected behaviour with tower size")
 
         if not self.version:
             self.log.warning("Could not detect KISSlicer version. Use at your own risk!")
@@ -212,10 +171,10 @@ class KISSlicerGCodeFile(GCodeFile):
 
         super().parse_print_settings()
 
-        for cmd, comment, line_index in self.layers[0].read_lines():
+        for line_index in self.layers[0].offsets.get(b"T"):
             # find first tool change and remove it if it's T0. No need to
             # do tool change as e already have T0 active
-            if line_index > self.layers[0].start_gcode_end and cmd and gcode.is_tool_change(cmd) == 0:
+            if line_index > self.layers[0].start_gcode_end and self.layers[0].lines[line_index].tool == 0:
                 self.layers[0].delete_line(line_index)
                 break
 
@@ -244,7 +203,7 @@ class KISSlicerGCodeFile(GCodeFile):
                     else:
                         self.layers.append(current_layer)
                         layer_num += 1
-                        current_layer = Layer(layer_num, layer_z, layer_height)
+                        current_layer = self.new_layer(layer_num, layer_z, layer_height)
             current_layer.add_line(cmd, comment)
 
             if current_layer.height < min_layer_height:
@@ -3,6 +3,7 @@ import re
 from extruder import Extruder
 from gcode import GCode, TYPE_CARTESIAN, TYPE_DELTA
 from layer import FirstLayer, ACT_INFILL, ACT_PASS, ACT_SWITCH, Layer
+from slicer_config import SlicerConfig, to_bool
 
 import utils
 from gcode_file import SLICER_PRUSA_SLIC3R, GCodeFile
@@ -23,9 +24,11 @@ class PrusaSlic3rCodeFile(GCodeFile):
         super().__init__(logger, settings)
 
     def process(self, gcode_file):
-        self.open_file(gcode_file)
-        self.parse_header()
-        self.parse_print_settings()
+        if not self.load_parsed(gcode_file):
+            self.open_file(gcode_file)
+            self.parse_header()
+            self.parse_print_settings()
+            self.store_parsed()
         self.filter_layers()
         self.parse_perimeter_rates()
         if len(self.tools) > 1:
@@ -38,22 +41,14 @@ class PrusaSlic3rCodeFile(GCodeFile):
 
     def open_file(self, gcode_file):
         super().open_file(gcode_file)
-        prev_comment = None
-        index = 0
-        while True:
-            try:
-                cmd, comment = self.layers[0].lines[index]
-                if cmd and gcode.is_tool_change(cmd) is not None:
-                    # fix Prusa slicer first tool change with comment
-                    if prev_comment and prev_comment.strip() == b"TOOL CHANGE":
-                        index += 1
-                        continue
-                    self.layers[0].insert_line(index, None, b"TOOL CHANGE")
-                    index += 1
-                prev_comment = comment
-                index += 1
-            except IndexError:
-                break
+        # fix Prusa slicer first tool change with comment. Insert from the end so that
+        # the indexed offsets before the insert position stay valid
+        layer = self.layers[0]
+        for index in reversed(list(layer.offsets.get(b"T"))):
+            prev_comment = layer.lines[index - 1].comment if index else None
+            if prev_comment and prev_comment.strip() == b"TOOL CHANGE":
+                continue
+            layer.insert_line(index, None, b"TOOL CHANGE")
 
     def parse_version(self, lines):
         """
@@ -73,18 +68,37 @@ class PrusaSlic3rCodeFile(GCodeFile):
             raise ValueError("Slic3r PE version cannot be parsed")
 
     @staticmethod
-    def _parse_float_or_percentage(text, base_value):
+    def _parse_float_or_percentage(value, base_value):
         """
-        Parse Prusa PE comment value that can be either float or percentage
-        :param text: text to parse
+        Parse Prusa PE config value that can be either float or percentage
+        :param value: value to parse
         :param base_value: if percentage, calculate final value based on this
         :return:
         """
-        if b"%" in text:
-            percentage = float(text.split(b' = ')[1].strip(b"%"))
+        if b"%" in value:
+            percentage = float(value.strip(b"%"))
             return base_value / 100 * percentage
         else:
-            return float(text.split(b' = ')[1])
+            return float(value)
+
+    def _get_extruder(self, tool):
+        """
+        Get extruder, create it if needed
+        :param tool: tool number
+        :return: Extruder
+        """
+        if tool not in self.extruders:
+            self.extruders[tool] = Extruder(tool)
+        return self.extruders[tool]
+
+    def read_config(self):
+        """
+        Read Slic3r config block from the end of the file
+        :return: SlicerConfig
+        """
+        comments = list(self.read_config_comments(reversed(self.layers[-1].lines)))
+        comments.reverse()
+        return SlicerConfig.from_comments(comments, b"=")
 
     def parse_header(self):
         """
@@ -94,174 +108,80 @@ class PrusaSlic3rCodeFile(GCodeFile):
 
         z_offset = 0
         brim = -1
-        for layer in self.layers:
-            for cmd, comment in layer.lines:
-                if cmd:
-                    continue
-                if b" bed_shape =" in comment:
-                    #; bed_shape = 0x0,145x0,145x148,0x148
-                    values = comment.split(b' = ')[1].split(b",")
-                    if len(values) == 4:
-                        self.settings.machine_type = TYPE_CARTESIAN
-                        self.settings.origin_offset_x = -float(values[0].split(b"x")[0])
-                        self.settings.origin_offset_y = -float(values[0].split(b"x")[1])
-                        self.settings.stroke_x = float(values[2].split(b"x")[0]) + self.settings.origin_offset_x
-                        self.settings.stroke_y = float(values[2].split(b"x")[1]) + self.settings.origin_offset_y
-                    else:
-                        self.settings.machine_type = TYPE_DELTA
-                        x = []
-                        y = []
-                        for v in values:
-                            vals = v.split(b"x")
-                            x.append(float(vals[0]))
-                            y.append(float(vals[1]))
-                        self.settings.stroke_x = max(x) - min(x)
-                        self.settings.stroke_y = max(y) - min(y)
-                        self.settings.origin_offset_x = self.settings.stroke_x / 2
-                        self.settings.origin_offset_y = self.settings.stroke_y / 2
-
-                elif b" extrusion_multiplier =" in comment:
-                    values = comment.split(b' = ')[1]
-                    tool = 0
-                    for d in values.split(b","):
-                        if tool not in self.extruders:
-                            self.extruders[tool] = Extruder(tool)
-                        self.extruders[tool].feed_rate_multiplier = float(d)
-                        tool += 1
-
-                elif b" external_perimeter_extrusion_width" in comment:
-                    # ; external_perimeter_extrusion_width = 0.45
-                    try:
-                        self.settings.extrusion_width = float(comment.split(b" = ")[1])
-                    except:
-                        # don't fail if value is percentage
-                        self.settings.extrusion_width = self.extruders[0].nozzle
-
-                # elif b"perimeters extrusion width" in comment:
-                #     self.perimeter_widths.append(float(comment.split(b"=")[1:].strip()))
-                # elif b"infill extrusion width" in comment:
-                #     self.infill_widths.append(float(comment.split(b"=")[1:].strip()))
-                # elif b"solid infill extrusion width" in comment:
-                #     self.solid_infill_widths.append(float(comment.split(b"=")[1:].strip()))
-                # elif b"top infill extrusion width" in comment:
-                #     self.top_infill_widths.append(float(comment.split(b"=")[1:].strip()))
-
-                elif b" filament_type =" in comment:
-                    # ; filament_type = PLA;PLA;PLA;PLA
-                    values = comment.split(b' = ')[1]
-                    tool = 0
-                    for d in values.split(b";"):
-                        if tool not in self.extruders:
-                            self.extruders[tool] = Extruder(tool)
-                        self.extruders[tool].filament_type = d
-                        tool += 1
-
-                elif b" retract_length =" in comment:
-                    # ; retract_length = 3,3,3,3
-                    values = comment.split(b' = ')[1]
-                    tool = 0
-                    for d in values.split(b","):
-                        if tool not in self.extruders:
-                            self.extruders[tool] = Extruder(tool)
-                        self.extruders[tool].retract = float(d)
-                        tool += 1
-
-                elif b" retract_lift =" in comment:
-                    # ; retract_lift = 0.5,0.5,0.5,0.5
-                    values = comment.split(b' = ')[1]
-                    tool = 0
-                    for d in values.split(b","):
-                        if tool not in self.extruders:
-                            self.extruders[tool] = Extruder(tool)
-                        self.extruders[tool].z_hop = float(d)
-                        tool += 1
-
-                elif b" retract_speed =" in comment:
-                    # ; retract_speed = 80,80,80,80
-                    values = comment.split(b' = ')[1]
-                    tool = 0
-                    for d in values.split(b","):
-                        if tool not in self.extruders:
-                            self.extruders[tool] = Extruder(tool)
-                        self.extruders[tool].retract_speed = 60*float(d)
-                        tool += 1
-
-                elif b" use_relative_e_distances =" in comment:
-                    # ; use_relative_e_distances = 1
-                    if comment.split(b' = ')[1] != b"1":
-                        raise ValueError("Relative E distances not enabled! Filaswitch won't work without relative E distances")
-
-                elif b" wipe = " in comment:
-                    # ; wipe = 1,1,1,1
-                    values = comment.split(b' = ')[1]
-                    tool = 0
-                    for d in values.split(b","):
-                        if tool not in self.extruders:
-                            self.extruders[tool] = Extruder(tool)
-                        if d == b"1":
-                            self.extruders[tool].wipe = 4  # TODO: figure a way to read wipe length
-                        tool += 1
-
-                elif b" perimeter_speed =" in comment:
-                    # ; perimeter_speed = 40
-                    self.settings.default_speed = float(comment.split(b' = ')[1])
-
-                elif b" external_perimeter_speed =" in comment:
-                    # ; external_perimeter_speed = 30
-                    self.settings.outer_perimeter_speed = self._parse_float_or_percentage(comment,
-                                                                                          self.settings.default_speed)
-
-                elif b" z_offset =" in comment:
-                    # ; z_offset = 0
-                    self.settings.z_offset = float(comment.split(b' = ')[1])
-
-                elif b" first_layer_speed =" in comment:
-                    # ; first_layer_speed = 70%
-                    self.settings.first_layer_speed = self._parse_float_or_percentage(comment,
-                                                                                      self.settings.default_speed)
-
-                elif b" nozzle_diameter = " in comment:
-                    # ; nozzle_diameter = 0.4,0.4,0.4,0.4
-                    values = comment.split(b' = ')[1]
-                    tool = 0
-                    for d in values.split(b","):
-                        if tool not in self.extruders:
-                            self.extruders[tool] = Extruder(tool)
-                        self.extruders[tool].nozzle = float(d)
-                        tool += 1
-
-                elif b" travel_speed =" in comment:
-                    # ; travel_speed = 120
-                    self.settings.travel_xy_speed = float(comment.split(b' = ')[1])
-
-                elif b" layer_height =" in comment:
-                    # ; layer_height = 0.2
-                    self.layer_height = float(comment.split(b' = ')[1])
-
-                elif b" first_layer_temperature =" in comment:
-                    # ; first_layer_temperature = 215,195,215,215
-                    values = comment.split(b' = ')[1]
-                    tool = 0
-                    for d in values.split(b","):
-                        if tool not in self.extruders:
-                            self.extruders[tool] = Extruder(tool)
-                        self.extruders[tool].temperature_nr = tool
-                        self.extruders[tool].temperature_setpoints[1] = int(d)
-                        tool += 1
-
-                elif b" temperature =" in comment:
-                    # ; temperature = 215,195,215,215
-                    values = comment.split(b' = ')[1]
-                    tool = 0
-                    for d in values.split(b","):
-                        if tool not in self.extruders:
-                            self.extruders[tool] = Extruder(tool)
-                        self.extruders[tool].temperature_setpoints[2] = int(d)
-                        tool += 1
-
-                elif b" brim_width =" in comment:
-                    # ; brim_width = 3
-                    brim = int(comment.split(b" = ")[1])
+        self.config = config = self.read_config()
+
+        # ; bed_shape = 0x0,145x0,145x148,0x148
+        values = config.get_list(b"bed_shape")
+        if len(values) == 4:
+            self.settings.machine_type = TYPE_CARTESIAN
+            self.settings.origin_offset_x = -float(values[0].split(b"x")[0])
+            self.settings.origin_offset_y = -float(values[0].split(b"x")[1])
+            self.settings.stroke_x = float(values[2].split(b"x")[0]) + self.settings.origin_offset_x
+            self.settings.stroke_y = float(values[2].split(b"x")[1]) + self.settings.origin_offset_y
+        elif values:
+            self.settings.machine_type = TYPE_DELTA
+            x = []
+            y = []
+            for v in values:
+                vals = v.split(b"x")
+                x.append(float(vals[0]))
+                y.append(float(vals[1]))
+            self.settings.stroke_x = max(x) - min(x)
+            self.settings.stroke_y = max(y) - min(y)
+            self.settings.origin_offset_x = self.settings.stroke_x / 2
+            self.settings.origin_offset_y = self.settings.stroke_y / 2
+
+        # per extruder values, e.g. ; retract_length = 3,3,3,3
+        for tool, value in enumerate(config.get_list(b"nozzle_diameter", float)):
+            self._get_extruder(tool).nozzle = value
+        for tool, value in enumerate(config.get_list(b"extrusion_multiplier", float)):
+            self._get_extruder(tool).feed_rate_multiplier = value
+        for tool, value in enumerate(config.get_list(b"filament_type", separator=b";")):
+            self._get_extruder(tool).filament_type = value
+        for tool, value in enumerate(config.get_list(b"retract_length", float)):
+            self._get_extruder(tool).retract = value
+        for tool, value in enumerate(config.get_list(b"retract_lift", float)):
+            self._get_extruder(tool).z_hop = value
+        for tool, value in enumerate(config.get_list(b"retract_speed", float)):
+            self._get_extruder(tool).retract_speed = 60*value
+        for tool, value in enumerate(config.get_list(b"wipe", to_bool)):
+            extruder = self._get_extruder(tool)
+            if value:
+                extruder.wipe = 4  # TODO: figure a way to read wipe length
+        for tool, value in enumerate(config.get_list(b"first_layer_temperature", int)):
+            extruder = self._get_extruder(tool)
+            extruder.temperature_nr = tool
+            extruder.temperature_setpoints[1] = value
+        for tool, value in enumerate(config.get_list(b"temperature", int)):
+            self._get_extruder(tool).temperature_setpoints[2] = value
+
+        value = config.get(b"external_perimeter_extrusion_width")
+        if value is not None:
+            # ; external_perimeter_extrusion_width = 0.45
+            try:
+                self.settings.extrusion_width = float(value)
+            except ValueError:
+                # don't fail if value is percentage
+                self.settings.extrusion_width = self.extruders[0].nozzle
+
+        value = config.get(b"use_relative_e_distances")
+        if value is not None and value != b"1":
+            raise ValueError("Relative E distances not enabled! Filaswitch won't work without relative E distances")
+
+        self.settings.default_speed = config.get_float(b"perimeter_speed", self.settings.default_speed)
+        value = config.get(b"external_perimeter_speed")
+        if value is not None:
+            # ; external_perimeter_speed = 30
+            self.settings.outer_perimeter_speed = self._parse_float_or_percentage(value,
+                                                                                  self.settings.default_speed)
+        value = config.get(b"first_layer_speed")
+        if value is not None:
+            # ; first_layer_speed = 70%
+            self.settings.first_layer_speed = self._parse_float_or_percentage(value, self.settings.default_speed)
+        self.settings.z_offset = config.get_float(b"z_offset", self.settings.z_offset)
+        self.settings.travel_xy_speed = config.get_float(b"travel_speed", self.settings.travel_xy_speed)
+        self.layer_height = config.get_float(b"layer_height", self.layer_height)
+        brim = config.get_int(b"brim_width", brim)
 
         if not self.version:
             self.log.warning("Could not detect Slic3r version. Use at your own risk!")
@@ -318,7 +238,7 @@ class PrusaSlic3rCodeFile(GCodeFile):
                             height = round(layer_z - current_layer.z, 5)
                             prev_z = current_layer.z
                         self.layers.append(current_layer)
-                        current_layer = Layer(layer_num, layer_z, height)
+                        current_layer = self.new_layer(layer_num, layer_z, height)
                         current_layer.support_layer = support_layer_checking
 
                 # check if support layer
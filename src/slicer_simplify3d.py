@@ -3,6 +3,7 @@ import re
 from extruder import Extruder
 from gcode import GCode
 from layer import FirstLayer, ACT_INFILL, ACT_PASS, ACT_SWITCH, Layer
+from slicer_config import SlicerConfig, to_bool
 
 import utils
 from gcode_file import SLICER_SIMPLIFY3D, GCodeFile
@@ -36,6 +37,8 @@ class Simplify3dGCodeFile(GCodeFile):
         self.extruder_widths = []
         self.relative_e = False
         self.retract_while_wiping = False
+        self.infill_speed = None
+        self.support_speed = None
 
         self.temperature_names = []
         self.temperature_numbers = []
@@ -45,10 +48,12 @@ class Simplify3dGCodeFile(GCodeFile):
         self.temperature_heated_bed = []
 
     def process(self, gcode_file):
-        self.open_file(gcode_file)
-        self.parse_header()
-        self.get_extruders()
-        self.parse_print_settings()
+        if not self.load_parsed(gcode_file):
+            self.open_file(gcode_file)
+            self.parse_header()
+            self.get_extruders()
+            self.parse_print_settings()
+            self.store_parsed()
         self.filter_layers()
         self.fix_retract_during_wipe()
         self.parse_perimeter_rates()
@@ -152,117 +157,56 @@ class Simplify3dGCodeFile(GCodeFile):
         :return: none
         """
 
-        skirt = False
-        brim = False
-        brim_lines = 0
-        for cmd, comment in self.layers[0].lines:
-
-            if not comment:
-                pass
-            elif b"extruderName" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_name.append(d)
-            elif b"extruderToolheadNumber" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_tool.append(int(d))
-            elif b"printMaterial" in comment:
-                self.material = comment.split(b",")[-1]
-            elif b"extruderDiameter" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_diameter.append(float(d))
-            elif b"extruderWidth" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_widths.append(float(d))
-            elif b"extrusionMultiplier" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_multiplier.append(float(d))
-            elif b"extruderUseRetract" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_use_retract.append(d == b"1")
-            elif b"extruderRetractionDistance" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_retract_dist.append(float(d))
-            elif b"extruderRetractionZLift" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_zhop.append(float(d))
-            elif b"extruderUseCoasting" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_use_coasting.append(d == b"1")
-            elif b"extruderCoastingDistance" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_coasting.append(float(d))
-            elif b"extruderUseWipe" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_use_wipe.append(d == b"1")
-            elif b"extruderWipeDistance" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_wipe.append(float(d))
-            elif b"layerHeight" in comment:
-                self.layer_height = float(comment.split(b",")[1])
-            elif b"extruderRetractionSpeed" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.extruder_retract_speed.append(float(d))
-            elif b"relativeEdistances" in comment:
-                self.relative_e = comment.split(b",")[-1] == b"1"
-            elif b"retractWhileWiping" in comment:
-                self.retract_while_wiping = comment.split(b",")[-1] == b"1"
-            elif b"defaultSpeed" in comment:
-                self.settings.default_speed = int(comment.split(b",")[-1])
-            elif b"rapidXYspeed" in comment:
-                self.settings.travel_xy_speed = int(comment.split(b",")[-1])
-            elif b"rapidZspeed" in comment:
-                self.settings.travel_z_speed = int(comment.split(b",")[-1])
-            elif b"outlineUnderspeed" in comment:
-                self.settings.outer_perimeter_speed = float(comment.split(b",")[-1])
-            elif b"solidInfillUnderspeed" in comment:
-                self.infill_speed = float(comment.split(b",")[-1])
-            elif b"supportUnderspeed" in comment:
-                self.support_speed = float(comment.split(b",")[-1])
-            elif b"firstLayerUnderspeed" in comment:
-                self.settings.first_layer_speed = float(comment.split(b",")[-1])
-            elif b"machineTypeOverride" in comment:
-                self.settings.machine_type = int(comment.split(b",")[-1])
-            elif b"strokeXoverride" in comment:
-                self.settings.stroke_x = float(comment.split(b",")[-1])
-            elif b"strokeYoverride" in comment:
-                self.settings.stroke_y = float(comment.split(b",")[-1])
-            elif b"originOffsetXoverride" in comment:
-                self.settings.origin_offset_x = float(comment.split(b",")[-1])
-            elif b"originOffsetYoverride" in comment:
-                self.settings.origin_offset_y = float(comment.split(b",")[-1])
-            elif b"gcodeZoffset" in comment:
-                self.settings.z_offset = float(comment.split(b",")[-1])
-            elif b"temperatureName" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.temperature_names.append(d)
-            elif b"temperatureNumber" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.temperature_numbers.append(int(d))
-            elif b"temperatureSetpointCount" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.temperature_setpoints.append(int(d))
-            elif b"temperatureSetpointLayers" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.temperature_setpoint_layers.append(int(d))
-            elif b"temperatureSetpointTemperatures" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.temperature_setpoint_temps.append(int(d))
-            elif b"temperatureHeatedBed" in comment:
-                for d in comment.split(b",")[1:]:
-                    self.temperature_heated_bed.append(int(d))
-            elif b"useSkirt,1" in comment:
-                skirt = True
-            elif b"skirtOffset,0" in comment:
-                brim = True
-            elif b"skirtOutlines" in comment:
-                brim_lines = int(comment.split(b",")[-1])
-
-            elif b"toolChangeRetractionDistance" in comment:
-                if comment.split(b",")[1] != b"0":
-                    self.log.warning("'toolChangeRetractionDistance' is not 0. This might cause quality problems. Check 'Other'-tab in S3D.")
-            elif b"toolChangeExtraRestartDistance" in comment:
-                if comment.split(b",")[1] != b"0":
-                    self.log.warning("'toolChangeExtraRestartDistance' is not 0. This might cause quality problems. Check 'Other'-tab in S3D.")
+        self.config = config = SlicerConfig.from_comments(self.read_config_comments(self.layers[0].lines), b",")
+
+        self.extruder_name.extend(config.get_list(b"extruderName"))
+        self.extruder_tool.extend(config.get_list(b"extruderToolheadNumber", int))
+        self.material = config.get(b"printMaterial", self.material)
+        self.extruder_diameter.extend(config.get_list(b"extruderDiameter", float))
+        self.extruder_widths.extend(config.get_list(b"extruderWidth", float))
+        self.extruder_multiplier.extend(config.get_list(b"extrusionMultiplier", float))
+        self.extruder_use_retract.extend(config.get_list(b"extruderUseRetract", to_bool))
+        self.extruder_retract_dist.extend(config.get_list(b"extruderRetractionDistance", float))
+        self.extruder_zhop.extend(config.get_list(b"extruderRetractionZLift", float))
+        self.extruder_use_coasting.extend(config.get_list(b"extruderUseCoasting", to_bool))
+        self.extruder_coasting.extend(config.get_list(b"extruderCoastingDistance", float))
+        self.extruder_use_wipe.extend(config.get_list(b"extruderUseWipe", to_bool))
+        self.extruder_wipe.extend(config.get_list(b"extruderWipeDistance", float))
+        self.extruder_retract_speed.extend(config.get_list(b"extruderRetractionSpeed", float))
+        self.layer_height = config.get_float(b"layerHeight", self.layer_height)
+        self.relative_e = to_bool(config.get(b"relativeEdistances"))
+        self.retract_while_wiping = to_bool(config.get(b"retractWhileWiping"))
+
+        self.settings.default_speed = config.get_int(b"defaultSpeed", self.settings.default_speed)
+        self.settings.travel_xy_speed = config.get_int(b"rapidXYspeed", self.settings.travel_xy_speed)
+        self.settings.travel_z_speed = config.get_int(b"rapidZspeed", self.settings.travel_z_speed)
+        self.settings.outer_perimeter_speed = config.get_float(b"outlineUnderspeed",
+                                                               self.settings.outer_perimeter_speed)
+        self.infill_speed = config.get_float(b"solidInfillUnderspeed", self.infill_speed)
+        self.support_speed = config.get_float(b"supportUnderspeed", self.support_speed)
+        self.settings.first_layer_speed = config.get_float(b"firstLayerUnderspeed", self.settings.first_layer_speed)
+        self.settings.machine_type = config.get_int(b"machineTypeOverride", self.settings.machine_type)
+        self.settings.stroke_x = config.get_float(b"strokeXoverride", self.settings.stroke_x)
+        self.settings.stroke_y = config.get_float(b"strokeYoverride", self.settings.stroke_y)
+        self.settings.origin_offset_x = config.get_float(b"originOffsetXoverride", self.settings.origin_offset_x)
+        self.settings.origin_offset_y = config.get_float(b"originOffsetYoverride", self.settings.origin_offset_y)
+        self.settings.z_offset = config.get_float(b"gcodeZoffset", self.settings.z_offset)
+
+        self.temperature_names.extend(config.get_list(b"temperatureName"))
+        self.temperature_numbers.extend(config.get_list(b"temperatureNumber", int))
+        self.temperature_setpoints.extend(config.get_list(b"temperatureSetpointCount", int))
+        self.temperature_setpoint_layers.extend(config.get_list(b"temperatureSetpointLayers", int))
+        self.temperature_setpoint_temps.extend(config.get_list(b"temperatureSetpointTemperatures", int))
+        self.temperature_heated_bed.extend(config.get_list(b"temperatureHeatedBed", int))
+
+        skirt = to_bool(config.get(b"useSkirt"))
+        brim = config.get_float(b"skirtOffset") == 0
+        brim_lines = config.get_int(b"skirtOutlines", 0)
+
+        if config.get_float(b"toolChangeRetractionDistance", 0) != 0:
+            self.log.warning("'toolChangeRetractionDistance' is not 0. This might cause quality problems. Check 'Other'-tab in S3D.")
+        if config.get_float(b"toolChangeExtraRestartDistance", 0) != 0:
+            self.log.warning("'toolChangeExtraRestartDistance' is not 0. This might cause quality problems. Check 'Other'-tab in S3D.")
 
         if not self.relative_e:
             raise ValueError("Relative E distances not enabled! Filaswitch won't work without relative E distances")
@@ -279,6 +223,22 @@ class Simplify3dGCodeFile(GCodeFile):
         if self.settings.brim_auto and skirt and brim:
             self.settings.brim = brim_lines
 
+    def can_stream(self, lines):
+        """
+        S3D 3.1.1 'Retract during wipe' fix edits lines across layers, so it needs the whole file in memory
+        :param lines: lines from gcode file
+        :return: true or false
+        """
+        if self.version != (3, 1, 1):
+            return True
+        for line in lines:
+            if not line.startswith(b";"):
+                # end of header
+                break
+            if b"retractWhileWiping" in line:
+                return line.split(b",")[-1] != b"1"
+        return True
+
     def parse_layers(self, lines):
         """
         Go through the g-code and find layer start points.
@@ -313,7 +273,7 @@ class Simplify3dGCodeFile(GCodeFile):
 
                         self.layers.append(current_layer)
                         prev_layer = current_layer
-                        current_layer = Layer(round(ret[0], 5), round(ret[1], 5), height)
+                        current_layer = self.new_layer(round(ret[0], 5), round(ret[1], 5), height)
 
                         if current_layer.height < min_layer_height:
                             min_layer_height = current_layer.height
@@ -372,31 +332,31 @@ class Simplify3dGCodeFile(GCodeFile):
 
         for layer in self.layers:
 
-            for cmd, comment, index in layer.read_lines():
-                if not cmd:
+            for index, line in enumerate(layer.lines):
+                if not line.cmd:
                     continue
-                if gcode.is_extrusion_move(cmd):
+                if line.extrusion_move():
                     # detect retract/wipe
-                    if gcode.last_match[3] < 0:
+                    if line.e < 0:
                         wipe_on = True
-                        if gcode.last_match[4] is not None:
-                            wipe_speed = gcode.last_match[4]
+                        if line.f is not None:
+                            wipe_speed = line.f
                         else:
                             wipe_speed = last_move_speed or self.settings.default_speed
-                        wipe_indexes.append((index, gcode.last_match[0], gcode.last_match[1], wipe_speed))
+                        wipe_indexes.append((index, line.x, line.y, wipe_speed))
                         wipe_layer = layer
-                elif gcode.is_head_move(cmd) and wipe_on:
+                elif line.head_move() and wipe_on:
                     # retract/wipe ended
-                    last_move_speed = gcode.last_match[2]
+                    last_move_speed = line.f
                     wipe_on = False
                     for index, x, y, speed in wipe_indexes:
                         wipe_layer.replace_line(index, gcode.gen_head_move(x, y, speed), b"fixed wipe")
                     first_wipe = wipe_indexes[0][0]
                     wipe_layer.insert_line(first_wipe, *extruder.get_retract_gcode())
                     wipe_indexes = []
-                elif gcode.is_tool_change(cmd) is not None:
+                elif line.tool is not None:
                     # tool change, set active extruder
-                    extruder = self.extruders[gcode.last_match]
+                    extruder = self.extruders[line.tool]
 
     def parse_perimeter_rates(self):
         """
@@ -0,0 +1,28 @@
+def detect_file_type(gcode_file, log):
+    """
+    Detect slicer from the first line of g-code file
+    :param gcode_file: g-code file path
+    :param log: logger
+    :return: slicer specific GCodeFile class or None if not supported
+    """
+    # only the detected slicer module is imported
+    with open(gcode_file, 'r') as gf:
+        line1 = gf.readline()
+        if line1.startswith('; G-Code generated by Simplify3D(R)'):
+            log.info("Detected Simplify3D format")
+            from slicer_simplify3d import Simplify3dGCodeFile
+            return Simplify3dGCodeFile
+        elif line1.startswith('; KISSlicer'):
+            log.info("Detected KISSlicer format")
+            from slicer_kisslicer import KISSlicerGCodeFile
+            return KISSlicerGCodeFile
+        #elif line1.startswith('; CURA'):
+        #    log.info("Detected Cura format")
+        #    return CuraPrintFile
+        elif line1.startswith('; generated by Slic3r') and ('prusa3d' in line1 or 'Prusa Edition' in line1):
+            log.info("Detected Prusa Slic3r format")
+            from slicer_prusa_slic3r import PrusaSlic3rCodeFile
+            return PrusaSlic3rCodeFile
+        else:
+            log.error("No supported gcode file detected.")
+            return None
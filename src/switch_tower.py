@@ -1,13 +1,24 @@
+import collections
 import math
 
-from gcode import GCode, E, S, W, N, NE, NW, SE, SW, TYPE_CARTESIAN, TYPE_DELTA
-from layer import Layer, ACT_SWITCH
-from settings import Settings, AUTO, RIGHT, LEFT, TOP, BOTTOM, INFILL_ZIGZAG, INFILL_BLOCKY
+from gcode import GCode, E, S, W, N, NE, NW, SE, SW, TYPE_CARTESIAN
+from layer import Layer, iter_gcode_lines
+from settings import Settings, AUTO, RIGHT, LEFT, TOP, BOTTOM, INFILL_ZIGZAG, INFILL_BLOCKY, PURGE_LINES
 
 import utils
+from occupancy import OccupancyGrid, cluster_points
 
 gcode = GCode()
 
+# minimum distance of the tower from bed edges
+BED_MARGIN = 4
+# tower position found from the occupancy grid
+FREE_AREA = "Free area"
+# size of the blocks free positions are grouped to when searching the tower position
+SEARCH_BLOCK = 10
+# tool change positions closer than this are combined when calculating travel
+TRAVEL_CLUSTER = 2
+
 
 class SwitchTower:
 
@@ -42,11 +53,12 @@ class SwitchTower:
         # Tower needs more space with smaller layer heights...
         scale_factor = 0.2 / min_layer_h
 
-        self.width = self.settings.get_hw_config_float_value("prepurge.sweep.length")
-        pre_purge_lines = self.settings.get_hw_config_float_value("prepurge.sweep.count")
+        hw = self.settings.hw
+        self.width = hw.prepurge_sweep_length
+        pre_purge_lines = hw.prepurge_sweep_count
 
-        self.pre_purge_sweep_gap = self.settings.get_hw_config_float_value("prepurge.sweep.gap") * scale_factor * 1.1
-        self.pre_purge_jitter = self.pre_purge_sweep_gap - self.settings.get_hw_config_float_value("prepurge.sweep.gap")
+        self.pre_purge_sweep_gap = hw.prepurge_sweep_gap * scale_factor * 1.1
+        self.pre_purge_jitter = self.pre_purge_sweep_gap - hw.prepurge_sweep_gap
         if self.pre_purge_jitter < 0:
             self.pre_purge_jitter = 0
 
@@ -79,6 +91,8 @@ class SwitchTower:
 
         extrusion_speed = (extrusion_rate * self.purge_length) / (self.purge_length / self.settings.purge_speed)
         self.log.info("Purge extrusion speed is {} mm/s".format(extrusion_speed))
+        if hw.purge_matrix:
+            self.log.info("Using purge matrix, unit {}".format(hw.purge_matrix_unit))
 
         self.brim_width = self.settings.brim * self.settings.extrusion_width
 
@@ -118,11 +132,14 @@ class SwitchTower:
         self.temperatures = {}
         self.warnings_shown = False
 
+        # generated relative move blocks of tool changes, see get_template_lines
+        self.templates = {}
+
         self.e_pos = 0
 
         # temp settings
-        self.g10 = self.settings.get_hw_config_value("tool.temperature.command") == "G10"
-        self.tool_use_id = self.settings.get_hw_config_bool_value("tool.temperature.use_id")
+        self.g10 = hw.temperature_command == "G10"
+        self.tool_use_id = hw.temperature_use_id
 
         # infill slot count
         self.infill_slots = 0
@@ -167,14 +184,14 @@ class SwitchTower:
         self.SE = gcode.rotate(self.SE, direction)
         self.SW = gcode.rotate(self.SW, direction)
 
-    def _cartesian_position(self, x_max, x_min, y_max, y_min):
+    def _cartesian_positions(self, x_max, x_min, y_max, y_min):
         """
-        Find position for purge tower using cartesian limits
+        Find positions for purge tower next to the print objects using cartesian limits
         :param x_max: print objects x max
         :param x_min: print objects x min
         :param y_max: print objects y max
         :param y_min: print objects y min
-        :return:
+        :return: generator of position name, start x, start y and rotation tuples
         """
         # expect origin offset to be positive always
         bed_x_max = self.settings.stroke_x - self.settings.origin_offset_x
@@ -183,7 +200,7 @@ class SwitchTower:
         bed_x_min = -self.settings.origin_offset_x
         bed_y_min = -self.settings.origin_offset_y
 
-        # find a place that can accommodate the tower height
+        # find places that can accommodate the tower height
         if self.settings.tower_position == AUTO:
             positions = [TOP, RIGHT, BOTTOM, LEFT]
         else:
@@ -192,74 +209,65 @@ class SwitchTower:
         for position in positions:
             # generate tower start positions and adjust tower position if it is out of the bed
             if position == LEFT:
-                self.start_pos_x = x_min - self.tower_offset
-                self.start_pos_y = self.y_mid - self.width / 2
+                start_x = x_min - self.tower_offset
+                start_y = self.y_mid - self.width / 2
 
-                if self.start_pos_y < bed_y_min + 4:
-                    self.start_pos_y = bed_y_min + 4
+                if start_y < bed_y_min + 4:
+                    start_y = bed_y_min + 4
 
-                elif self.start_pos_y > bed_y_max - self.total_width:
-                    self.start_pos_y = bed_y_max - self.total_width
+                elif start_y > bed_y_max - self.total_width:
+                    start_y = bed_y_max - self.total_width
 
-                if self.start_pos_x > bed_x_min + self.total_height:
-                    self.rotate_tower(90)
-                    return position
+                if start_x > bed_x_min + self.total_height:
+                    yield position, start_x, start_y, 90
 
             elif position == RIGHT:
-                self.start_pos_x = x_max + self.tower_offset
-                self.start_pos_y = self.y_mid + self.width / 2
+                start_x = x_max + self.tower_offset
+                start_y = self.y_mid + self.width / 2
 
-                if self.start_pos_y < bed_y_min + self.total_width:
-                    self.start_pos_y = bed_y_min + self.total_width
+                if start_y < bed_y_min + self.total_width:
+                    start_y = bed_y_min + self.total_width
 
-                elif self.start_pos_y > bed_y_max - 4:
-                    self.start_pos_y = bed_y_max - 4
+                elif start_y > bed_y_max - 4:
+                    start_y = bed_y_max - 4
 
-                if self.start_pos_x < bed_x_max - self.total_height:
-                    self.rotate_tower(270)
-                    return position
+                if start_x < bed_x_max - self.total_height:
+                    yield position, start_x, start_y, 270
 
             elif position == TOP:
-                self.start_pos_x = self.x_mid - self.width / 2
-                self.start_pos_y = y_max + self.tower_offset
+                start_x = self.x_mid - self.width / 2
+                start_y = y_max + self.tower_offset
 
-                if self.start_pos_x < bed_x_min + 4:
-                    self.start_pos_x = bed_x_min + 4
+                if start_x < bed_x_min + 4:
+                    start_x = bed_x_min + 4
 
-                elif self.start_pos_x > bed_x_max - self.total_width:
-                    self.start_pos_x = bed_x_max - self.total_width
+                elif start_x > bed_x_max - self.total_width:
+                    start_x = bed_x_max - self.total_width
 
-                if self.start_pos_y < bed_x_max - self.total_height:
-                    self.rotate_tower(0)
-                    return position
+                if start_y < bed_x_max - self.total_height:
+                    yield position, start_x, start_y, 0
 
             elif position == BOTTOM:
-                self.start_pos_x = self.x_mid + self.width / 2
-                self.start_pos_y = y_min - self.tower_offset
+                start_x = self.x_mid + self.width / 2
+                start_y = y_min - self.tower_offset
 
-                if self.start_pos_x < bed_x_min + self.total_width:
-                    self.start_pos_x = bed_x_min + self.total_width
+                if start_x < bed_x_min + self.total_width:
+                    start_x = bed_x_min + self.total_width
 
-                elif self.start_pos_x > bed_x_max - 4:
-                    self.start_pos_x = bed_x_max - 4
+                elif start_x > bed_x_max - 4:
+                    start_x = bed_x_max - 4
 
-                if self.start_pos_y > bed_y_min + self.total_height:
-                    self.rotate_tower(180)
-                    return position
+                if start_y > bed_y_min + self.total_height:
+                    yield position, start_x, start_y, 180
 
-        if not self.settings.tower_force or not self.settings.tower_force[0]:
-            if self.settings.tower_position == AUTO:
-                raise ValueError("Not enough space for the tower inside the bed!")
-            raise ValueError("Not enough room for tower using selected position %s" % self.settings.tower_position)
-
-    def _delta_position(self, x_max, x_min, y_max, y_min):
+    def _delta_positions(self, x_max, x_min, y_max, y_min):
         """
-        Find position for purge tower using delta limits
+        Find positions for purge tower next to the print objects using delta limits
         :param x_max: print objects x max
         :param x_min: print objects x min
         :param y_max: print objects y max
         :param y_min: print objects y min
-        :return:
+        :return: generator of position name, start x, start y and rotation tuples
         """
 
         # assume that bed is round and origin is at the center
@@ -270,7 +278,7 @@ class SwitchTower:
             length = y / math.sin(angle)
             return abs(length) < bed_r
 
-        # find a place that can accommodate the tower height
+        # find places that can accommodate the tower height
         if self.settings.tower_position == AUTO:
             positions = [TOP, RIGHT, BOTTOM, LEFT]
         else:
@@ -286,9 +294,9 @@ class SwitchTower:
                 x2 = self.x_mid + self.total_width/2
 
                 if check_coordinate(x1, y) and check_coordinate(x2, y):
-                    self.start_pos_y = y_max + self.tower_offset
-                    self.start_pos_x = x1 + self.extra_width/2
-                    return position
+                    start_y = y_max + self.tower_offset
+                    start_x = x1 + self.extra_width/2
+                    yield position, start_x, start_y, 0
 
                 # x3 = -self.total_width/2
                 # x4 = self.total_width/2
@@ -302,10 +310,9 @@ class SwitchTower:
                 y1 = self.y_mid + self.total_width/2
                 y2 = self.y_mid - self.total_width/2
                 if check_coordinate(x, y1) and check_coordinate(x, y2):
-                    self.start_pos_y = y1 - self.extra_width/2
-                    self.start_pos_x = x_max + self.tower_offset
-                    self.rotate_tower(270)
-                    return position
+                    start_y = y1 - self.extra_width/2
+                    start_x = x_max + self.tower_offset
+                    yield position, start_x, start_y, 270
 
                 # y3 = self.total_width/2
                 # y4 = -self.total_width/2
@@ -320,10 +327,9 @@ class SwitchTower:
                 x1 = self.x_mid - self.total_width / 2
                 x2 = self.x_mid + self.total_width / 2
                 if check_coordinate(x1, y) and check_coordinate(x2, y):
-                    self.start_pos_y = y_min - self.tower_offset
-                    self.start_pos_x = x2 - self.extra_width/2
-                    self.rotate_tower(180)
-                    return position
+                    start_y = y_min - self.tower_offset
+                    start_x = x2 - self.extra_width/2
+                    yield position, start_x, start_y, 180
 
                 # x3 = -self.total_width / 2
                 # x4 = self.total_width / 2
@@ -336,12 +342,11 @@ class SwitchTower:
             elif position == LEFT:
                 x = x_min - self.total_height
                 y1 = self.y_mid - self.total_width / 2
-                y2 = self.y_mid = self.total_width / 2
+                y2 = self.y_mid + self.total_width / 2
                 if check_coordinate(x, y1) and check_coordinate(x, y2):
-                    self.start_pos_y = y1 + self.extra_width/2
-                    self.start_pos_x = x_min - self.tower_offset
-                    self.rotate_tower(90)
-                    return position
+                    start_y = y1 + self.extra_width/2
+                    start_x = x_min - self.tower_offset
+                    yield position, start_x, start_y, 90
 
                 # y3 = -self.total_width / 2
                 # y4 = self.total_width / 2
@@ -350,19 +355,114 @@ class SwitchTower:
                 #     self.start_pos_x = x_min - self.tower_offset
                 #     self.rotate_tower(90)
                 #     return position
-                
-        if not self.settings.tower_force[0]:
-            if self.settings.tower_position == AUTO:
-                raise ValueError("Not enough space for the tower inside the bed!")
-            raise ValueError("Not enough room for tower using selected position %s" % self.settings.tower_position)
 
-    def find_tower_position(self, x_max, x_min, y_max, y_min):
+
+    def _tower_footprint(self, direction):
+        """
+        Get area taken by the tower brim and raft relative to the start position
+        :param direction: tower rotation angle
+        :return: x min, y min, x max, y max
+        """
+        # brim starts from the lower left corner of the raft, see find_tower_position
+        u0 = -self.brim_width - self.wall_gap/2 - 0.5
+        v0 = -self.brim_width - 0.5
+        angle = math.radians(direction)
+        xs = []
+        ys = []
+        for u in (u0, u0 + self.raft_width):
+            for v in (v0, v0 + self.raft_height):
+                xs.append(u * math.cos(angle) - v * math.sin(angle))
+                ys.append(u * math.sin(angle) + v * math.cos(angle))
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def _create_grid(self):
+        """
+        Create occupancy grid of the bed area usable for the tower
+        :return: OccupancyGrid
+        """
+        if self.settings.machine_type == TYPE_CARTESIAN:
+            return OccupancyGrid(-self.settings.origin_offset_x + BED_MARGIN,
+                                 -self.settings.origin_offset_y + BED_MARGIN,
+                                 self.settings.stroke_x - self.settings.origin_offset_x - BED_MARGIN,
+                                 self.settings.stroke_y - self.settings.origin_offset_y - BED_MARGIN)
+        # round bed with origin at the center
+        bed_r = self.settings.stroke_x/2 - BED_MARGIN
+        return OccupancyGrid(-bed_r, -bed_r, bed_r, bed_r)
+
+    def _travel_distance(self, candidate, points):
+        """
+        Calculate travel between the points and the tower center
+        :param candidate: position name, start x, start y and rotation tuple
+        :param points: x, y, weight tuples
+        :return: travel distance
+        """
+        _, start_x, start_y, direction = candidate
+        x_min, y_min, x_max, y_max = self._tower_footprint(direction)
+        x = start_x + (x_min + x_max)/2
+        y = start_y + (y_min + y_max)/2
+        return sum(weight * math.hypot(px - x, py - y) for px, py, weight in points)
+
+    def _travel_position(self, side_positions, fill_grid):
+        """
+        Find the tower position with the least travel from the tool change positions to the tower
+        and back. Positions next to the print objects and free areas of the bed are compared
+        :param side_positions: position name, start x, start y and rotation tuples next to the print objects
+        :param fill_grid: function that adds the print to an OccupancyGrid and returns the positions before and
+        after tool changes
+        :return: position name, start x, start y and rotation tuple or None if there's no room
         """
-        Find position for purge tower
+        grid = self._create_grid()
+        tool_change_positions = fill_grid(grid)
+        grid.dilate(self.tower_offset)
+        if self.settings.machine_type != TYPE_CARTESIAN:
+            grid.block_outside_circle(self.settings.stroke_x/2 - BED_MARGIN)
+
+        # free positions are grouped to blocks. Travel is calculated for one position of each block, and then
+        # for all positions around the best block
+        blocks = collections.OrderedDict()
+        # 180 and 270 degree rotations take the same area
+        for direction in (0, 90):
+            x_min, y_min, x_max, y_max = self._tower_footprint(direction)
+            for x, y in grid.free_rectangles(x_max - x_min, y_max - y_min):
+                key = direction, int(x // SEARCH_BLOCK), int(y // SEARCH_BLOCK)
+                if key not in blocks:
+                    blocks[key] = FREE_AREA, x - x_min, y - y_min, direction
+
+        points = cluster_points(tool_change_positions, TRAVEL_CLUSTER)
+        candidates = list(side_positions)
+        if blocks:
+            direction, col, row = min(blocks, key=lambda k: self._travel_distance(blocks[k], points))
+            x_min, y_min, x_max, y_max = self._tower_footprint(direction)
+            area = ((col - 1) * SEARCH_BLOCK, (row - 1) * SEARCH_BLOCK,
+                    (col + 2) * SEARCH_BLOCK - grid.cell_size, (row + 2) * SEARCH_BLOCK - grid.cell_size)
+            for x, y in grid.free_rectangles(x_max - x_min, y_max - y_min, area):
+                candidates.append((FREE_AREA, x - x_min, y - y_min, direction))
+        if not candidates:
+            return None
+
+        # first one wins ties, so a position next to the print is preferred
+        best = min(candidates, key=lambda c: self._travel_distance(c, points))
+
+        points = [(x, y, 1) for x, y in tool_change_positions]
+        travel = self._travel_distance(best, points)
+        self.log.info("Tower travel {:.0f} mm".format(travel))
+        if side_positions and best is not side_positions[0]:
+            saved = self._travel_distance(side_positions[0], points) - travel
+            saved_time = saved / self.settings.travel_xy_speed * 60 if self.settings.travel_xy_speed else 0
+            self.log.info("Tower position saves {:.0f} mm, {:.1f} s of travel compared to position {}".format(
+                saved, saved_time, side_positions[0][0]))
+        return best
+
+    def find_tower_position(self, x_max, x_min, y_max, y_min, fill_grid=None):
+        """
+        Find position for purge tower. In auto mode the position with the least travel from the tool
+        changes is used, also free areas of the bed are searched
         :param x_max: print objects x max
         :param x_min: print objects x min
         :param y_max: print objects y max
         :param y_min: print objects y min
+        :param fill_grid: function that adds the print to an OccupancyGrid and returns the positions before and
+        after tool changes
         :return:
         """
 
@@ -373,11 +473,26 @@ class SwitchTower:
         #print("mids", self.x_mid, self.y_mid)
 
         if self.settings.machine_type == TYPE_CARTESIAN:
-            position = self._cartesian_position(x_max, x_min, y_max, y_min)
+            side_positions = self._cartesian_positions(x_max, x_min, y_max, y_min)
         else:
-            position = self._delta_position(x_max, x_min, y_max, y_min)
-            
-        if self.settings.tower_force and self.settings.tower_force[0]:
+            side_positions = self._delta_positions(x_max, x_min, y_max, y_min)
+
+        forced = self.settings.tower_force and self.settings.tower_force[0]
+        if self.settings.tower_position == AUTO and fill_grid is not None and not forced:
+            candidate = self._travel_position(list(side_positions), fill_grid)
+        else:
+            candidate = next(side_positions, None)
+
+        position = None
+        if candidate is not None:
+            position, self.start_pos_x, self.start_pos_y, direction = candidate
+            self.rotate_tower(direction)
+        elif not forced:
+            if self.settings.tower_position == AUTO:
+                raise ValueError("Not enough space for the tower inside the bed!")
+            raise ValueError("Not enough room for tower using selected position %s" % self.settings.tower_position)
+
+        if forced:
             self.start_pos_x = self.settings.tower_force[0]
             self.start_pos_y = self.settings.tower_force[1]
             position = "FORCED"
@@ -446,20 +561,16 @@ class SwitchTower:
         :return:
         """
 
-        e_length = self.settings.get_hw_config_float_value("prepurge.sweep.extrusion.length")
+        hw = self.settings.hw
+        e_length = hw.prepurge_sweep_extrusion_length
 
-        sweep_speed = self.settings.get_hw_config_float_value("prepurge.sweep.speed")
-        sweep_gap_speed = self.settings.get_hw_config_float_value("prepurge.sweep.gap.speed")
-        motor_current = self.settings.get_hw_config_int_value("motor.current.load")
+        sweep_speed = hw.prepurge_sweep_speed
+        sweep_gap_speed = hw.prepurge_sweep_gap_speed
+        motor_current = hw.motor_current_load
 
-        try:
-            pre_retract = self.settings.get_hw_config_int_value("prepurge.initial.retract")
-            pre_retract_speed = self.settings.get_hw_config_int_value("prepurge.initial.retract.speed")
-            pre_retract_pause = self.settings.get_hw_config_int_value("prepurge.initial.pause")
-        except TypeError:
-            pre_retract = None
-            pre_retract_speed = None
-            pre_retract_pause = None
+        pre_retract = hw.prepurge_initial_retract
+        pre_retract_speed = hw.prepurge_initial_retract_speed
+        pre_retract_pause = hw.prepurge_initial_pause
 
         horizontal_dir = self.slots[self.slot]['horizontal_dir']
         vertical_dir = self.slots[self.slot]['vertical_dir']
@@ -473,7 +584,7 @@ class SwitchTower:
                                            layer_h), b" pre-purge jitter"
 
         # pre-purge section
-        rr_wipe = self.settings.get_hw_config_bool_value("rapid.retract.wipe")
+        rr_wipe = hw.rapid_retract_wipe
         pre_retract_wipe_length = 10
 
         if pre_retract:
@@ -503,7 +614,7 @@ class SwitchTower:
             speed = e_length / (self.width / (sweep_speed/60)) * 60
             yield gcode.gen_extruder_move(pre_retract, speed), b" prepurge initial prime"
 
-        for _ in range(self.settings.get_hw_config_int_value("prepurge.sweep.count")):
+        for _ in range(hw.prepurge_sweep_count):
             yield gcode.gen_direction_move(horizontal_dir, self.width, sweep_speed, layer_h,
                                            extruder=old_e, e_length=e_length), b" purge trail"
             yield gcode.gen_direction_move(vertical_dir, self.pre_purge_sweep_gap, sweep_gap_speed,
@@ -511,19 +622,14 @@ class SwitchTower:
             horizontal_dir = gcode.opposite_dir(horizontal_dir)
 
         # rapid retract section
-        rr_lengths = self.settings.get_hw_config_array("rapid.retract.initial[].length", float)
-        rr_speeds = self.settings.get_hw_config_array("rapid.retract.initial[].speed", float)
         rr_wipe_length = 8
         rr_total_wipe = 0
 
-        # sanity check
-        if len(rr_lengths) != len(rr_speeds):
-            raise ValueError("not equal amount of rapid.retract.initial length and speed parameters. Check hwcfg")
-        if len(rr_lengths) == 0:
+        if not hw.rapid_retract_initial:
             if not self.warnings_shown:
                 self.log.warning("No rapid.retract.initial[N].length or .speed found. Please check the HW-config")
 
-        for length, speed in zip(rr_lengths, rr_speeds):
+        for length, speed in hw.rapid_retract_initial:
             if rr_wipe:
                 if rr_total_wipe + rr_wipe_length < self.width:
                     yield gcode.gen_direction_move(horizontal_dir, rr_wipe_length, speed, layer_h, extruder=old_e,
@@ -550,7 +656,7 @@ class SwitchTower:
             yield gcode.gen_direction_move(gcode.opposite_dir(horizontal_dir), self.purge_length_diff / 2,
                                            self.settings.travel_xy_speed, layer_h), b" pre-purge x adjust"
 
-        pause = self.settings.get_hw_config_float_value("rapid.retract.pause")
+        pause = hw.rapid_retract_pause
         if pause:
             if rr_wipe:
                 speed = self.purge_length*2/pause*1000*60
@@ -561,17 +667,12 @@ class SwitchTower:
             else:
                 yield gcode.gen_pause(pause), b" cooling period"
 
-        rr_long_lengths = self.settings.get_hw_config_array("rapid.retract.long[].length", float)
-        rr_long_speeds = self.settings.get_hw_config_array("rapid.retract.long[].speed", float)
-
-        if len(rr_long_lengths) != len(rr_long_speeds):
-            raise ValueError("Not equal amount of rapid.retract.long length and speed parameters. Check hwcfg")
-        if len(rr_long_lengths) == 0:
+        if not hw.rapid_retract_long:
             if not self.warnings_shown:
                 self.log.warning("No rapid.retract.long[N].length or .speed found. Please check the HW-config")
 
-        rr_wipe_length = self.width/len(rr_long_lengths)
-        for length, speed in zip(rr_long_lengths, rr_long_speeds):
+        rr_wipe_length = self.width/len(hw.rapid_retract_long)
+        for length, speed in hw.rapid_retract_long:
             if rr_wipe:
                 yield gcode.gen_direction_move(gcode.opposite_dir(horizontal_dir), rr_wipe_length, speed,
                                                layer_h, extruder=old_e, e_length=-length, e_speed=True), b" long retract with wipe"
@@ -579,18 +680,13 @@ class SwitchTower:
                 yield gcode.gen_extruder_move(-length, speed), b" long retract"
                 
         # Cooling movements, as seen in Slic3r gcode, need to override length values from extruder, modified in gcode.py
-        rr_cool_lengths = self.settings.get_hw_config_array("rapid.retract.cool[].length", float)
-        rr_cool_speeds = self.settings.get_hw_config_array("rapid.retract.cool[].speed", float)
-
-        if len(rr_cool_lengths) != len(rr_cool_speeds):
-            raise ValueError("not equal amount of rapid.retract.cool length and speed parameters. Check hwcfg")
-        if len(rr_cool_lengths) == 0:
+        if not hw.rapid_retract_cool:
             if not self.warnings_shown:
                 self.log.warning("No cooling steps. That's OK.")
         else:
             self.log.debug("Cooling movements enabled")
 
-        for length, speed in zip(rr_cool_lengths, rr_cool_speeds):
+        for length, speed in hw.rapid_retract_cool:
             yield gcode.gen_direction_move(horizontal_dir, self.width, speed, layer_h,
                                            extruder=old_e, e_length=length), b" cooling"
             horizontal_dir = gcode.opposite_dir(horizontal_dir)
@@ -605,47 +701,29 @@ class SwitchTower:
         :param layer_h: current layer height
         :return:
         """
-        # should we move head while feeding?
-        feedtrail = self.settings.get_hw_config_value("feed.trail")
-        # feed new filament
-        values = []
-        i = 0
-
-        if feedtrail == "True":
+        hw = self.settings.hw
+        # feed new filament, move head while feeding if feed trail is enabled
+        if hw.feed_trail:
             self.log.debug("Feedtrail enabled")
+            if not hw.feed and not self.warnings_shown:
+                self.log.warning("No prime move steps. That's OK.")
             horizontal_dir = self.slots[self.slot]['horizontal_dir']
-            while True:
-                try:
-                    feed_len = self.settings.get_hw_config_float_value("feed[{}].length".format(i))
-                    feed_speed = self.settings.get_hw_config_float_value("feed[{}].speed".format(i))
-                    yield gcode.gen_direction_move(horizontal_dir, self.width, feed_speed, layer_h,
-                                                   extruder=extruder, e_length=feed_len, e_speed=True), b" prime move"
-                    horizontal_dir = gcode.opposite_dir(horizontal_dir)
-                    i += 1
-                except TypeError:
-                    if i == 0 and not self.warnings_shown:
-                        self.log.warning("No prime move steps. That's OK.")
-                    break
+            for feed_len, feed_speed in hw.feed:
+                yield gcode.gen_direction_move(horizontal_dir, self.width, feed_speed, layer_h,
+                                               extruder=extruder, e_length=feed_len, e_speed=True), b" prime move"
+                horizontal_dir = gcode.opposite_dir(horizontal_dir)
 
             self.slots[self.slot]['horizontal_dir'] = horizontal_dir
         else:
-            while True:
-                try:
-                    feed_len = self.settings.get_hw_config_float_value("feed[{}].length".format(i))
-                    feed_speed = self.settings.get_hw_config_float_value("feed[{}].speed".format(i))
-                    values.append((feed_len, feed_speed))
-                    i += 1
-                except TypeError:
-                    if i == 0 and not self.warnings_shown:
-                        self.log.warning("No feed[N].length or .speed found. Please check the HW-config")
-                    break
-
-            for feed_len, feed_speed in values:
+            if not hw.feed and not self.warnings_shown:
+                self.log.warning("No feed[N].length or .speed found. Please check the HW-config")
+
+            for feed_len, feed_speed in hw.feed:
                 yield gcode.gen_extruder_move(feed_len, feed_speed), b" feed"
 
         # prime trail
-        prime_e_length = self.settings.get_hw_config_float_value("prime.trail.extrusion.length")
-        prime_trail_speed = self.settings.get_hw_config_float_value("prime.trail.speed")
+        prime_e_length = hw.prime_trail_extrusion_length
+        prime_trail_speed = hw.prime_trail_speed
         yield gcode.gen_direction_move(self.slots[self.slot]['horizontal_dir'],
                                        self.width,
                                        prime_trail_speed,
@@ -898,6 +976,36 @@ class SwitchTower:
         yield gcode.gen_direction_move(x_dir, self.wall_width, last_speed, layer_h, extruder=extruder), b" wall"
         yield gcode.gen_direction_move(y_dir, last_y, last_speed, layer_h, extruder=extruder, last_line=True), b" wall"
 
+    def _get_slot_state(self):
+        """
+        Get direction state of current slot
+        :return: tuple of horizontal dir, vertical dir and jitter flags
+        """
+        slot = self.slots[self.slot]
+        return slot['horizontal_dir'], slot['vertical_dir'], tuple(sorted(slot['jitter'].items()))
+
+    def get_template_lines(self, key, generator, *args):
+        """
+        Get tool change g-code block from template cache. Blocks contain only relative moves, so a block
+        generated once is valid for every tool change with the same tools, layer height and slot directions.
+        The slot directions the generator leaves behind are stored with the block and restored when it's
+        replayed. Replayed blocks share the GCodeLine objects, lines are never modified after they are created
+        :param key: tuple of block name and the values the block depends on besides slot directions
+        :param generator: block generator function
+        :param args: generator arguments
+        :return: tuple of GCodeLine objects
+        """
+        key += self._get_slot_state()
+        template = self.templates.get(key)
+        if template is None:
+            lines = tuple(iter_gcode_lines(generator(*args)))
+            template = self.templates[key] = (lines, self._get_slot_state())
+        else:
+            slot = self.slots[self.slot]
+            slot['horizontal_dir'], slot['vertical_dir'], jitter = template[1]
+            slot['jitter'].update(jitter)
+        return template[0]
+
     def get_slot(self, layer: Layer, tool_change):
         """
         Get next viable slot, based on lowest z. Start from back
@@ -918,11 +1026,34 @@ class SwitchTower:
             # fill infill slots from the first available slot
             self.slot = layer.slots - self.infill_slots
 
-    def _calculate_purge_values(self, layer_h, extruder):
+    def _get_transition_purge_length(self, old_extruder, extruder, purge_e, wall_e_length):
         """
-        Calculate purge line count, gap and purge feed multiplier for given layer.
+        Get post-switch purge length for the tool pair from the hw config purge matrix
+        :param old_extruder: previous extruder
+        :param extruder: new extruder
+        :param purge_e: default purge length without walls
+        :param wall_e_length: wall extrusion length
+        :return: purge length without walls or None if not set for the pair
+        """
+        hw = self.settings.hw
+        amount = hw.purge_matrix.get((old_extruder.tool, extruder.tool))
+        if amount is None:
+            return None
+        if hw.purge_matrix_unit == PURGE_LINES:
+            if not self.settings.purge_lines:
+                return None
+            return purge_e * amount / self.settings.purge_lines
+        # filament volume, walls included
+        return amount / (math.pi * (extruder.filament_d / 2) ** 2) - wall_e_length
+
+    def _calculate_purge_values(self, layer_h, extruder, old_extruder=None):
+        """
+        Calculate purge line count, gap and purge feed multiplier for given layer. Purge is shortened if the
+        purge matrix has a smaller amount for the tool pair. Fewer lines are spread over the same area so
+        the lines of the next layers have support.
         :param layer_h: layer height
         :param extruder: extruder object
+        :param old_extruder: previous extruder
         :return: gap, purge feed multi, purge lines
         """
         # calculate wall e length and subtract it from expected purge length
@@ -930,7 +1061,8 @@ class SwitchTower:
         purge_e = self.purge_e_length - wall_e_length
 
         # calculate new line counts (fractional, whole) based on layer height feed rate
-        lines = purge_e / (utils.extrusion_feed_rate(self.purge_line_width, layer_h, 1.75) * self.purge_length * 2)
+        line_e = utils.extrusion_feed_rate(self.purge_line_width, layer_h, 1.75) * self.purge_length * 2
+        lines = purge_e / line_e
         whole_lines = math.floor(lines)
 
         # calculate new purge line gap based on line count differences
@@ -939,11 +1071,49 @@ class SwitchTower:
         if line_diff and whole_lines > 1:
             purge_gap += line_diff/(whole_lines - 1) * purge_gap
 
+        if old_extruder is not None and whole_lines > 2:
+            transition_e = self._get_transition_purge_length(old_extruder, extruder, purge_e, wall_e_length)
+            if transition_e is not None and transition_e < purge_e:
+                # at least two lines, nozzle temperature is changed after them
+                span = purge_gap * (whole_lines - 1)
+                lines = max(transition_e / line_e, 2)
+                whole_lines = math.floor(lines)
+                purge_gap = span / (whole_lines - 1)
+
         # adjust purge feed multiplier
         purge_multi = self.settings.purge_multi/100 * lines / whole_lines
 
         return purge_gap, purge_multi, whole_lines
 
+    def _get_purge_gcode(self, old_extruder, extruder, layer_h, first, last):
+        """
+        Generate post-switch purge lines
+        :param old_extruder: previous extruder
+        :param extruder: new extruder
+        :param layer_h: current layer height
+        :param first: index of first purge line
+        :param last: index after the last purge line
+        :return: g-code lines
+        """
+        gap, purge_multiplier, lines = self._calculate_purge_values(layer_h, extruder, old_extruder)
+        # switch direction depending of prepurge orientation
+        gap_speed = self.settings.hw.prepurge_sweep_gap_speed
+
+        speeds = self.generate_purge_speeds(self.settings.outer_perimeter_speed, lines)
+        for i in range(first, min(last, len(speeds))):
+            for _ in range(2):
+                speed = speeds[i]
+                if i == 0:
+                    yield gcode.gen_direction_move(self.slots[self.slot]['horizontal_dir'], self.purge_line_width/2,
+                                                   self.settings.travel_xy_speed, layer_h), b" shift"
+                else:
+                    yield gcode.gen_direction_move(self.slots[self.slot]['vertical_dir'],
+                                                   gap, gap_speed, layer_h), b" Y shift"
+                yield gcode.gen_direction_move(self.slots[self.slot]['horizontal_dir'],
+                                               self.purge_length, speed, layer_h, extruder=extruder,
+                                               feed_multi=purge_multiplier), b" purge trail"
+                self.slots[self.slot]['horizontal_dir'] = gcode.opposite_dir(self.slots[self.slot]['horizontal_dir'])
+
     def get_tower_lines(self, layer: Layer, e_pos, old_e, new_e):
         """
         G-code for switch tower
@@ -1016,7 +1186,7 @@ class SwitchTower:
             new_temp = None
 
         # Pre-switch temp handling. Change temperature if defined in hwcfg
-        temp_diff = self.settings.get_hw_config_float_value("prepurge.temperature.change")
+        temp_diff = self.settings.hw.prepurge_temperature_change
         pre_temp = old_e.get_temperature(layer.num) + temp_diff
         for line in self.get_temperature_gcode(pre_temp, old_e):
             yield line
@@ -1029,69 +1199,59 @@ class SwitchTower:
         yield self._get_prime(old_e)
 
         # pre-switch purge
-        for line in self.get_pre_switch_gcode(old_e, new_e, layer_h):
+        for line in self.get_template_lines(("pre_switch", old_e.tool, layer_h), self.get_pre_switch_gcode, old_e,
+                                            new_e, layer_h):
             yield line
         
-        if self.settings.get_hw_config_bool_value("tool.wait_on_change"):
+        if self.settings.hw.wait_on_change:
             yield b"G4 S0", b" wait"
 
         yield gcode.gen_tool_change(new_e.tool), b" change tool"
         
-        if self.settings.get_hw_config_bool_value("tool.reset_feed"):
+        if self.settings.hw.reset_feed:
             yield b"M220 S100", b" reset feedrate"
 
-        if self.settings.get_hw_config_bool_value("tool.wait_on_change"):
+        if self.settings.hw.wait_on_change:
             yield b"G4 S0", b" wait"
 
         # feed new filament
-        for line in self.get_post_switch_gcode(new_e, layer_h):
+        for line in self.get_template_lines(("post_switch", new_e.tool, layer_h), self.get_post_switch_gcode, new_e,
+                                            layer_h):
             yield line
 
-        # post-switch purge
-        gap, purge_multiplier, lines = self._calculate_purge_values(layer_h, new_e)
-        # switch direction depending of prepurge orientation
-        gap_speed = self.settings.get_hw_config_float_value("prepurge.sweep.gap.speed")
-
-        # e_len = 0
-        speeds = self.generate_purge_speeds(self.settings.outer_perimeter_speed, lines)
-        for i in range(len(speeds)):
-            for _ in range(2):
-                speed = speeds[i]
-                if i == 0:
-                    yield gcode.gen_direction_move(self.slots[self.slot]['horizontal_dir'], self.purge_line_width/2,
-                                                   self.settings.travel_xy_speed, layer_h), b" shift"
-                else:
-                    yield gcode.gen_direction_move(self.slots[self.slot]['vertical_dir'],
-                                                   gap, gap_speed, layer_h), b" Y shift"
-                yield gcode.gen_direction_move(self.slots[self.slot]['horizontal_dir'],
-                                               self.purge_length, speed, layer_h, extruder=new_e,
-                                               feed_multi=purge_multiplier), b" purge trail"
-                self.slots[self.slot]['horizontal_dir'] = gcode.opposite_dir(self.slots[self.slot]['horizontal_dir'])
-
-            if i == 1:
-                if new_temp:
-                    target_temp = new_temp
-                else:
-                    target_temp = old_temp
-                # change nozzle temp after purging the old material.
-                temp_change = abs(target_temp - old_temp)
-                wait = temp_change > 15
-                if wait:
-                    # retract to minimize ooze during wait
-                    yield new_e.get_retract_gcode()
-                # change temp without wait
-                for line in self.get_temperature_gcode(target_temp, new_e, wait=False):
-                    yield line
-                if wait:
-                    # assume temp change of 1C per second and do some wipe movements during temp change
-                    wipe_speed = self.purge_length*2/temp_change * 60
-                    yield gcode.gen_direction_move(self.slots[self.slot]['horizontal_dir'], self.purge_length,
-                                                   wipe_speed, layer_h), b" ooze wipe"
-                    yield gcode.gen_direction_move(gcode.opposite_dir(self.slots[self.slot]['horizontal_dir']),
-                                                   self.purge_length, wipe_speed, layer_h), b" ooze wipe"
-                    yield new_e.get_prime_gcode()
+        # post-switch purge. Nozzle temperature is changed after the first two lines
+        _, _, lines = self._calculate_purge_values(layer_h, new_e, old_e)
+        gap_speed = self.settings.hw.prepurge_sweep_gap_speed
+        for line in self.get_template_lines(("purge", old_e.tool, new_e.tool, layer_h), self._get_purge_gcode, old_e,
+                                            new_e, layer_h, 0, 2):
+            yield line
 
-                # e_len += new_e.get_feed_length(self.purge_length, layer.height, feed_multi=purge_multiplier)
+        if lines > 1:
+            if new_temp:
+                target_temp = new_temp
+            else:
+                target_temp = old_temp
+            # change nozzle temp after purging the old material.
+            temp_change = abs(target_temp - old_temp)
+            wait = temp_change > 15
+            if wait:
+                # retract to minimize ooze during wait
+                yield new_e.get_retract_gcode()
+            # change temp without wait
+            for line in self.get_temperature_gcode(target_temp, new_e, wait=False):
+                yield line
+            if wait:
+                # assume temp change of 1C per second and do some wipe movements during temp change
+                wipe_speed = self.purge_length*2/temp_change * 60
+                yield gcode.gen_direction_move(self.slots[self.slot]['horizontal_dir'], self.purge_length,
+                                               wipe_speed, layer_h), b" ooze wipe"
+                yield gcode.gen_direction_move(gcode.opposite_dir(self.slots[self.slot]['horizontal_dir']),
+                                               self.purge_length, wipe_speed, layer_h), b" ooze wipe"
+                yield new_e.get_prime_gcode()
+
+        for line in self.get_template_lines(("purge_end", old_e.tool, new_e.tool, layer_h), self._get_purge_gcode,
+                                            old_e, new_e, layer_h, 2, lines):
+            yield line
 
         # DEBUG
         # wall_e = new_e.get_feed_length((self.wall_width + self.wall_height) * 2, layer.height)
@@ -1112,9 +1272,9 @@ class SwitchTower:
             yield gcode.gen_pressure_advance(*self.settings.pressure_advance), b" turn on pressure advance"
 
         # wall gcode
-        for line in self._get_wall_gcode(new_e, layer_h, self.settings.default_speed,
-                                         self.slots[self.slot]['horizontal_dir'],
-                                         self.slots[self.slot]['vertical_dir']):
+        for line in self.get_template_lines(("wall", new_e.tool, layer_h), self._get_wall_gcode, new_e, layer_h,
+                                            self.settings.default_speed, self.slots[self.slot]['horizontal_dir'],
+                                            self.slots[self.slot]['vertical_dir']):
             yield line
 
         yield new_e.get_retract_gcode()
@@ -1130,7 +1290,7 @@ class SwitchTower:
         yield None, b" TOWER END"
         
         #readjust motor current
-        motor_current = self.settings.get_hw_config_int_value("motor.current.run")
+        motor_current = self.settings.hw.motor_current_run
         if motor_current:
             yield gcode.gen_motor_current('E',motor_current), b" adjust current"
             
@@ -0,0 +1,399 @@
+import collections
+import math
+import os
+
+from gcode import GCode, GCodeLine
+from gcode_io import GCodeReader, GCodeWriter
+
+gcode = GCode()
+
+# machine limits used when the hw config doesn't have them, firmware defaults. mm/s and mm/s^2
+ACCELERATION_DEFAULT = 1000.0
+RETRACT_ACCELERATION_DEFAULT = 3000.0
+JERK_XY_DEFAULT = 10.0
+JERK_Z_DEFAULT = 0.3
+JERK_E_DEFAULT = 5.0
+
+# feed rate until the file sets one, mm/min
+FEED_RATE_DEFAULT = 1500.0
+
+# moves are planned with this many moves of lookahead, like the firmware block buffer
+PLANNER_BLOCKS = 16
+
+SECTION_PRINT = "Print"
+SECTION_TOWER = "Tower"
+SECTION_INFILL = "Tower infill"
+SECTION_BASE = "Tower brim and raft"
+SECTIONS = (SECTION_PRINT, SECTION_TOWER, SECTION_INFILL, SECTION_BASE)
+
+# tower marker comment: section that starts from it
+SECTION_MARKERS = {
+    b"TOWER START": SECTION_TOWER,
+    b"TOWER END": SECTION_PRINT,
+    b"TOWER INFILL START": SECTION_INFILL,
+    b"TOWER INFILL END": SECTION_PRINT,
+    b"TOWER BRIM START": SECTION_BASE,
+    b"TOWER BRIM END": SECTION_PRINT,
+    b"TOWER RAFT START": SECTION_BASE,
+    b"TOWER RAFT END": SECTION_PRINT,
+}
+
+# commands that wait until the planned moves are done
+SYNC_OPCODES = (b"M400", b"M109", b"M190", b"M116", b"G28")
+
+
+def format_duration(seconds):
+    """
+    Format duration as h:mm:ss
+    :param seconds: duration in seconds
+    :return: string
+    """
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class _Block:
+    """
+    Planned move. Axis factors are the move direction, speeds in mm/s
+    """
+    __slots__ = ("length", "speed", "acceleration", "axes", "max_entry", "entry", "entry_bound", "section",
+                 "tool_change")
+
+    def __init__(self, length, speed, acceleration, axes, section, tool_change):
+        self.length = length
+        self.speed = speed
+        self.acceleration = acceleration
+        self.axes = axes
+        self.max_entry = 0.0
+        self.entry = 0.0
+        self.entry_bound = 0.0
+        self.section = section
+        self.tool_change = tool_change
+
+    def get_time(self, entry, exit_speed):
+        """
+        Time of trapezoidal speed profile
+        :param entry: entry speed
+        :param exit_speed: exit speed
+        :return: seconds
+        """
+        speed = self.speed
+        acceleration = self.acceleration
+        accelerate = (speed * speed - entry * entry) / (2 * acceleration)
+        decelerate = (speed * speed - exit_speed * exit_speed) / (2 * acceleration)
+        if accelerate + decelerate <= self.length:
+            return ((speed - entry) + (speed - exit_speed)) / acceleration + \
+                   (self.length - accelerate - decelerate) / speed
+        # speed is not reached
+        peak = math.sqrt((2 * acceleration * self.length + entry * entry + exit_speed * exit_speed) / 2)
+        return ((peak - entry) + (peak - exit_speed)) / acceleration
+
+
+class TimeEstimator:
+    """
+    Estimates print time by planning the moves with acceleration and jerk or junction deviation limits.
+    Time is collected per tower section and per tool change, tool change is the g-code between TOWER START
+    and TOWER END comments.
+    """
+
+    def __init__(self, hw=None):
+        """
+        :param hw: HwConfig with the machine limits, defaults are used for limits not given
+        """
+        def limit(attr, default):
+            value = getattr(hw, attr, None)
+            return default if value is None else value
+
+        self.acceleration = limit("acceleration", ACCELERATION_DEFAULT)
+        self.retract_acceleration = limit("retract_acceleration", RETRACT_ACCELERATION_DEFAULT)
+        self.junction_deviation = limit("junction_deviation", None)
+        self.jerk = (limit("jerk_xy", JERK_XY_DEFAULT), limit("jerk_xy", JERK_XY_DEFAULT),
+                     limit("jerk_z", JERK_Z_DEFAULT), limit("jerk_e", JERK_E_DEFAULT))
+
+        self.position = [0.0, 0.0, 0.0, 0.0]
+        self.relative = False
+        self.relative_e = False
+        self.feed_rate = FEED_RATE_DEFAULT / 60
+
+        self.section = SECTION_PRINT
+        self.tool_change = None
+
+        # time of planned moves
+        self.total_time = 0.0
+        self.section_times = collections.OrderedDict((section, 0.0) for section in SECTIONS)
+        self.tool_change_times = []
+
+        self._blocks = []
+
+    def read_file(self, path):
+        """
+        Estimate time of g-code file
+        :param path: file path
+        :return: none
+        """
+        for line in GCodeReader(path):
+            self.add_line(GCodeLine(*gcode.read_gcode_line(line)))
+        self.finish()
+
+    def add_line(self, line):
+        """
+        Add g-code line. Time of a move is added when it leaves the planner lookahead
+        :param line: GCodeLine
+        :return: none
+        """
+        if line.comment:
+            section = SECTION_MARKERS.get(line.comment.strip())
+            if section is not None:
+                self._set_section(section)
+
+        opcode = line.opcode
+        if opcode is None:
+            return
+        if opcode in GCode.MOVE_OPCODES:
+            self._add_move(line)
+        elif opcode == b"G92":
+            self._set_position(line.cmd.split()[1:])
+        elif opcode == b"G90":
+            self.relative = self.relative_e = False
+        elif opcode == b"G91":
+            self.relative = self.relative_e = True
+        elif opcode == b"M82":
+            self.relative_e = False
+        elif opcode == b"M83":
+            self.relative_e = True
+        elif opcode == b"G4":
+            self._dwell(line.cmd.split()[1:])
+        elif opcode in SYNC_OPCODES:
+            self._flush()
+            if opcode == b"G28":
+                self.position[:3] = [0.0, 0.0, 0.0]
+
+    def finish(self):
+        """
+        Plan the remaining moves
+        :return: none
+        """
+        self._flush()
+
+    def _set_section(self, section):
+        if section == SECTION_TOWER:
+            self.tool_change = len(self.tool_change_times)
+            self.tool_change_times.append(0.0)
+        else:
+            self.tool_change = None
+        self.section = section
+
+    def _add_time(self, time, section, tool_change):
+        self.total_time += time
+        self.section_times[section] += time
+        if tool_change is not None:
+            self.tool_change_times[tool_change] += time
+
+    def _set_position(self, words):
+        """
+        G92, set position of given axes, all axes to 0 if none given
+        :param words: command words
+        :return: none
+        """
+        values = {word[:1]: word[1:] for word in words}
+        for index, axis in enumerate((b"X", b"Y", b"Z", b"E")):
+            if not words:
+                self.position[index] = 0.0
+            elif axis in values:
+                try:
+                    self.position[index] = float(values[axis])
+                except ValueError:
+                    pass
+
+    def _dwell(self, words):
+        """
+        G4, wait for the moves and pause. P is milliseconds, S seconds
+        :param words: command words
+        :return: none
+        """
+        self._flush()
+        time = 0.0
+        for word in words:
+            try:
+                if word.startswith(b"P"):
+                    time += float(word[1:]) / 1000
+                elif word.startswith(b"S"):
+                    time += float(word[1:])
+            except ValueError:
+                pass
+        self._add_time(time, self.section, self.tool_change)
+
+    def _add_move(self, line):
+        """
+        Add G0/G1 move to planner
+        :param line: GCodeLine
+        :return: none
+        """
+        if line.f:
+            self.feed_rate = line.f / 60
+        position = self.position
+        deltas = []
+        for index, value in enumerate((line.x, line.y, line.z, line.e)):
+            if value is None:
+                deltas.append(0.0)
+                continue
+            relative = self.relative_e if index == 3 else self.relative
+            target = position[index] + value if relative else value
+            deltas.append(target - position[index])
+            position[index] = target
+
+        dx, dy, dz, de = deltas
+        length = math.sqrt(dx * dx + dy * dy + dz * dz)
+        if length > 0.000001:
+            acceleration = self.acceleration
+        else:
+            # extruder only move
+            length = abs(de)
+            if length <= 0.000001:
+                return
+            acceleration = self.retract_acceleration
+        axes = (dx / length, dy / length, dz / length, de / length)
+
+        block = _Block(length, self.feed_rate, acceleration, axes, self.section, self.tool_change)
+        blocks = self._blocks
+        block.max_entry = self._junction_speed(blocks[-1] if blocks else None, block)
+        if not blocks:
+            block.entry = block.max_entry
+        blocks.append(block)
+
+        # speed limits of the moves before this one can rise as this one doesn't need to stop
+        exit_bound = 0.0
+        for block in reversed(blocks):
+            bound = min(block.max_entry, math.sqrt(exit_bound * exit_bound + 2 * block.acceleration * block.length))
+            if bound == block.entry_bound:
+                break
+            block.entry_bound = bound
+            exit_bound = bound
+
+        if len(blocks) > PLANNER_BLOCKS:
+            self._plan_first()
+
+    def _junction_speed(self, previous, block):
+        """
+        Get max speed at the junction of two moves
+        :param previous: previous block or None if starting from stop
+        :param block: new block
+        :return: speed
+        """
+        if self.junction_deviation is not None:
+            if previous is None or not any(previous.axes[:3]) or not any(block.axes[:3]):
+                # start from stop or extruder only move
+                return 0.0
+            cos_theta = -sum(previous.axes[i] * block.axes[i] for i in range(3))
+            if cos_theta > 0.999999:
+                # reversal
+                return 0.0
+            speed = min(previous.speed, block.speed)
+            if cos_theta < -0.999999:
+                # straight line
+                return speed
+            sin_theta_d2 = math.sqrt(0.5 * (1 - cos_theta))
+            return min(speed, math.sqrt(block.acceleration * self.junction_deviation * sin_theta_d2 /
+                                        (1 - sin_theta_d2)))
+
+        # jerk, velocity change of each axis is limited
+        speed = block.speed if previous is None else min(previous.speed, block.speed)
+        factor = 1.0
+        for i, jerk in enumerate(self.jerk):
+            change = block.axes[i] * speed
+            if previous is not None:
+                change -= previous.axes[i] * speed
+            change = abs(change)
+            if change > jerk:
+                factor = min(factor, jerk / change)
+        return speed * factor
+
+    def _plan_first(self):
+        """
+        Plan the first move in lookahead, its entry speed is already fixed
+        :return: none
+        """
+        blocks = self._blocks
+        block = blocks.pop(0)
+        entry = min(block.entry, block.entry_bound)
+        exit_speed = math.sqrt(entry * entry + 2 * block.acceleration * block.length)
+        if blocks:
+            exit_speed = min(exit_speed, blocks[0].entry_bound)
+            blocks[0].entry = exit_speed
+        else:
+            exit_speed = 0.0
+        self._add_time(block.get_time(entry, exit_speed), block.section, block.tool_change)
+
+    def _flush(self):
+        """
+        Plan all moves to stop
+        :return: none
+        """
+        while self._blocks:
+            self._plan_first()
+
+    def format_report(self):
+        """
+        Format estimated times
+        :return: list of report lines
+        """
+        total = self.total_time
+        lines = ["Estimated print time %s" % format_duration(total)]
+        for section, time in self.section_times.items():
+            if section == SECTION_PRINT or not time:
+                continue
+            lines.append("{}: {} ({:.1f} %)".format(section, format_duration(time), time / total * 100))
+        if self.tool_change_times:
+            times = self.tool_change_times
+            lines.append("{} tool changes, {:.1f} s per tool change (min {:.1f} s, max {:.1f} s)".format(
+                len(times), sum(times) / len(times), min(times), max(times)))
+        return lines
+
+
+def get_progress(elapsed, total):
+    """
+    Get progress values for M73
+    :param elapsed: elapsed time in seconds
+    :param total: total time in seconds
+    :return: percent done and minutes remaining
+    """
+    if total <= 0:
+        return 100, 0
+    percent = min(int(elapsed / total * 100), 100)
+    return percent, int(math.ceil(max(total - elapsed, 0) / 60))
+
+
+def add_progress(path, total_time, hw=None):
+    """
+    Add M73 progress and remaining time lines to g-code file. Lines are added when either value changes,
+    M73 lines already in the file are removed as they don't include the tower
+    :param path: g-code file path
+    :param total_time: estimated time of the file
+    :param hw: HwConfig with machine limits
+    :return: none
+    """
+    estimator = TimeEstimator(hw)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            writer = GCodeWriter(f)
+            progress = get_progress(0, total_time)
+            writer.write(GCodeLine(gcode.gen_progress(*progress)))
+            for line in GCodeReader(path):
+                line = GCodeLine(*gcode.read_gcode_line(line))
+                if line.opcode == b"M73":
+                    continue
+                estimator.add_line(line)
+                new_progress = get_progress(estimator.total_time, total_time)
+                if new_progress != progress:
+                    progress = new_progress
+                    writer.write(GCodeLine(gcode.gen_progress(*progress)))
+                writer.write(line)
+            writer.write(GCodeLine(gcode.gen_progress(100, 0)))
+            writer.close()
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
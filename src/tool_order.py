@@ -0,0 +1,204 @@
+import collections
+import itertools
+
+from gcode import GCodeLine
+from layer import FirstLayer, LineIndex
+
+# blocks with this in a comment print support. Support and model blocks are not moved past each other
+SUPPORT_COMMENT = b"support"
+
+
+class ToolBlock:
+    """
+    Lines of a layer from a tool change to the next one
+    """
+    __slots__ = ("tool", "start", "end", "tool_index", "support")
+
+    def __init__(self, tool, start, tool_index):
+        self.tool = tool
+        self.start = start
+        self.end = None
+        self.tool_index = tool_index
+        self.support = False
+
+
+def is_tool_change_comment(line):
+    return line.comment is not None and line.comment.strip() == b"TOOL CHANGE"
+
+
+def has_position(line):
+    return line.x is not None or line.y is not None or line.z is not None
+
+
+def has_extrusion(lines):
+    return any(line.e is not None and line.e > 0 and (line.x is not None or line.y is not None) for line in lines)
+
+
+def tool_change_lines(tool):
+    return [GCodeLine(None, b"TOOL CHANGE"), GCodeLine(("T%d" % tool).encode())]
+
+
+def tool_change_index(lines, start, end):
+    """
+    Find position for a new tool change: after the last positioning move before the first XY move,
+    like the tool changes of the slicer
+    :param lines: lines of the layer as list
+    :param start: start of the range
+    :param end: end of the range
+    :return: index
+    """
+    index = start
+    while index < end and lines[index].x is None and lines[index].y is None:
+        index += 1
+    while index > start and not has_position(lines[index - 1]):
+        index -= 1
+    return index
+
+
+def layer_region(layer):
+    """
+    Get the part of the layer that is printed, i.e. without start and end g-code
+    :param layer: Layer object
+    :return: start and end index
+    """
+    start = layer.start_gcode_end + 1 if isinstance(layer, FirstLayer) else 0
+    end = layer.offsets.first(LineIndex.END_SCRIPT_START)
+    if end is None:
+        end = len(layer.lines)
+    return start, end
+
+
+def find_tool_blocks(layer, lines, tool=None):
+    """
+    Find tool blocks of a layer. Block starts after the last positioning move before the tool change, so
+    retracts and fan commands of the tool change stay with it. Extrusions before the first tool change
+    are a block of the tool active before the layer, without a tool change
+    :param layer: Layer object
+    :param lines: lines of the layer as list
+    :param tool: tool active before the layer in the original order, None if not known
+    :return: list of ToolBlock in print order, empty if the layer cannot be reordered
+    """
+    start, end = layer_region(layer)
+    blocks = []
+    lower = start
+    for index in layer.offsets.get(b"T"):
+        if index < start or index >= end:
+            continue
+        if index == start or not is_tool_change_comment(lines[index - 1]):
+            # tool change comment is in previous layer or tool command is not a tool change
+            return []
+        block_start = index - 1
+        while block_start > lower and not has_position(lines[block_start - 1]):
+            block_start -= 1
+        if blocks:
+            blocks[-1].end = block_start
+        blocks.append(ToolBlock(lines[index].tool, block_start, index))
+        lower = index + 1
+
+    if blocks:
+        blocks[-1].end = end
+    first = blocks[0].start if blocks else end
+    if tool is not None and has_extrusion(lines[start:first]):
+        block = ToolBlock(tool, tool_change_index(lines, start, first), None)
+        block.end = first
+        blocks.insert(0, block)
+    for block in blocks:
+        for line in lines[block.start:block.end]:
+            if line.comment and SUPPORT_COMMENT in line.comment.lower():
+                block.support = True
+                break
+    return blocks
+
+
+def order_blocks(blocks, tool):
+    """
+    Order blocks so that the active tool continues and each tool is used once. Runs of support and model
+    blocks keep their order, blocks of one tool keep their order
+    :param blocks: list of ToolBlock in print order
+    :param tool: active tool before the blocks
+    :return: ordered list of ToolBlock
+    """
+    ordered = []
+    for _, run in itertools.groupby(blocks, key=lambda b: b.support):
+        tools = collections.OrderedDict()
+        for block in run:
+            tools.setdefault(block.tool, []).append(block)
+        if tool in tools:
+            tools.move_to_end(tool, last=False)
+        for block_tool, tool_blocks in tools.items():
+            ordered += tool_blocks
+            tool = block_tool
+    return ordered
+
+
+def count_tool_changes(tools, tool):
+    """
+    Count changes of tool
+    :param tools: tool numbers in print order
+    :param tool: active tool before the first one, None if the first one is already active
+    :return: number of changes and the last tool
+    """
+    changes = 0
+    for new_tool in tools:
+        if tool is not None and new_tool != tool:
+            changes += 1
+        tool = new_tool
+    return changes, tool
+
+
+def optimize_tool_order(layers):
+    """
+    Reorder tool blocks of the layers so that each layer starts with the tool the previous layer ended with,
+    and remove the tool changes that became redundant. First tool change of the print is kept as is.
+    Blocks that had no tool change in the original order get one if the tool before them changed
+    :param layers: Layer objects in print order
+    :return: tool changes before and after
+    """
+    before = after = 0
+    original_tool = tool = None
+    for layer in layers:
+        lines = list(layer.lines)
+        blocks = find_tool_blocks(layer, lines, original_tool)
+        if not blocks:
+            start, end = layer_region(layer)
+            tool_indexes = [index for index in layer.offsets.get(b"T") if start <= index < end]
+            first = tool_indexes[0] if tool_indexes else end
+            if tool != original_tool and has_extrusion(lines[start:first]):
+                # layer cannot be reordered, restore the tool of the original order for its first lines
+                index = tool_change_index(lines, start, first)
+                layer.set_lines(lines[:index] + tool_change_lines(original_tool) + lines[index:])
+                after += 1
+                tool = original_tool
+            tools = [lines[index].tool for index in tool_indexes]
+            changes, original_tool = count_tool_changes(tools, original_tool)
+            before += changes
+            changes, tool = count_tool_changes(tools, tool)
+            after += changes
+            continue
+
+        changes, original_tool = count_tool_changes([b.tool for b in blocks], original_tool)
+        before += changes
+
+        ordered = order_blocks(blocks, tool)
+        changed = ordered != blocks
+        new_lines = lines[:blocks[0].start]
+        for block in ordered:
+            block_lines = lines[block.start:block.end]
+            if block.tool == tool:
+                if block.tool_index is not None:
+                    # drop the tool change comment and command
+                    index = block.tool_index - block.start
+                    del block_lines[index - 1:index + 1]
+                    changed = True
+            else:
+                if tool is not None:
+                    after += 1
+                if block.tool_index is None:
+                    block_lines = tool_change_lines(block.tool) + block_lines
+                    changed = True
+            tool = block.tool
+            new_lines += block_lines
+        new_lines += lines[blocks[-1].end:]
+        if changed:
+            layer.set_lines(new_lines)
+    return before, after
@@ -40,23 +40,28 @@ def adjust(lines, x, y):
         elif gcode.is_absolute_positioning(cmd):
             skip = False
             new_lines.append((cmd, comment))
-        elif not skip and gcode.is_head_move(cmd):
-            new_x = gcode.last_match[0] + x
-            new_y = gcode.last_match[1] + y
-            speed = gcode.last_match[3]
-            new_cmd = gcode.gen_head_move(new_x, new_y, speed)
-            new_lines.append((new_cmd, comment))
-        elif not skip and gcode.is_extrusion_move(cmd):
-            new_x = gcode.last_match[0] + x
-            new_y = gcode.last_match[1] + y
-            e_length = gcode.last_match[3]
-            if gcode.last_match[4] is not None:
-                new_cmd = gcode.gen_extrusion_speed_move(new_x, new_y, gcode.last_match[4], e_length)
-            else:
-                new_cmd = gcode.gen_extrusion_move(new_x, new_y, e_length)
-            new_lines.append((new_cmd, comment))
-        else:
+        elif skip:
             new_lines.append((cmd, comment))
+        else:
+            head_move = gcode.is_head_move(cmd)
+            extrusion_move = None if head_move else gcode.is_extrusion_move(cmd)
+            if head_move:
+                new_x = head_move[0] + x
+                new_y = head_move[1] + y
+                speed = head_move[3]
+                new_cmd = gcode.gen_head_move(new_x, new_y, speed)
+                new_lines.append((new_cmd, comment))
+            elif extrusion_move:
+                new_x = extrusion_move[0] + x
+                new_y = extrusion_move[1] + y
+                e_length = extrusion_move[3]
+                if extrusion_move[4] is not None:
+                    new_cmd = gcode.gen_extrusion_speed_move(new_x, new_y, extrusion_move[4], e_length)
+                else:
+                    new_cmd = gcode.gen_extrusion_move(new_x, new_y, e_length)
+                new_lines.append((new_cmd, comment))
+            else:
+                new_lines.append((cmd, comment))
 
     return new_lines
 
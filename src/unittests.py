@@ -1,9 +1,39 @@
 
+import concurrent.futures
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from unittest import mock
 
+import batch
 import extruder
-from gcode import GCode, E, W, S, N, NE, SE, NW, SW
+import gcode_io
+from gcode import GCode, GCodeLine, E, W, S, N, NE, SE, NW, SW
+import layer
+import move_table
+import occupancy
+import parse_cache
+import server
 import settings
+import slicer_config
+import switch_tower
+import time_estimator
+import tool_order
+import watch
+from slicer_prusa_slic3r import PrusaSlic3rCodeFile
+from slicer_simplify3d import Simplify3dGCodeFile
 
 
 class TestGcode(unittest.TestCase):
@@ -123,6 +153,10 @@ class TestGcode(unittest.TestCase):
         self.assertEqual((6.408065343285028, 7.335791783307863), self.test_object.get_coordinates_by_offsets(10, 10, 10, -4, -2))
         self.assertEqual((8.724977204643308, 5.713472632617306), self.test_object.get_coordinates_by_offsets(10, 10, 10, -2, -4))
         self.assertEqual((12.664208216692137, 6.408065343285028), self.test_object.get_coordinates_by_offsets(10, 10, 10, 2, -4))
+        # offsets along one axis are rotated too
+        self.assertEqual((10, 5), self.test_object.get_coordinates_by_offsets(0, 10, 10, 0, -5))
+        self.assertEqual((9.999999999999998, 5.0), self.test_object.get_coordinates_by_offsets(180, 10, 10, 0, 5))
+        self.assertEqual((10.0, 14.0), self.test_object.get_coordinates_by_offsets(90, 10, 10, 4, 0))
 
     def test_is_temp_nowait(self):
         self.assertEqual(255, self.test_object.is_temp_nowait(b"M104 S255"))
@@ -150,6 +184,958 @@ class TestGcode(unittest.TestCase):
         self.assertEqual(90, self.test_object.rotate(W, 270))
 
 
+    def test_matchers_are_stateless(self):
+        lines = [(b"G1 X%d Y%d E1.5 F1200" % (i, i), (i, i, None, 1.5, 1200)) for i in range(200)]
+
+        def match_all(results):
+            for line, expected in lines:
+                results.append(GCode.is_extrusion_move(line) == expected)
+
+        results = []
+        threads = [threading.Thread(target=match_all, args=(results,)) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(lines) * 4, len(results))
+        self.assertTrue(all(results))
+        self.assertFalse(hasattr(self.test_object, "last_match"))
+
+
+class BenchmarkMoveTokenizer(unittest.TestCase):
+    """
+    Compares the single pass move tokenizer against the old per-axis regex parser.
+    Prints lines/sec for both implementations
+    """
+
+    LINES = [b"G1 X80.349 Y81.849 E0.04520",
+             b"G1 X65.82 Y76.532 F7800.000",
+             b"G1 E-0.80000 F2100.00000",
+             b"G1 Z0.400 F10800.000",
+             b"G1 F4800.00000 E-3.00000",
+             b"G1 X112.045 Y96.211 Z0.6 E0.01277 F1800",
+             b"M106 S255",
+             b"G92 E0"]
+    ROUNDS = 5000
+
+    MOVE_RE = re.compile(b"^G0\\s+|^G1\\s+")
+    AXIS_RES = [re.compile(b".*\\s+X([-]*\\d+\\.*\\d*)"),
+                re.compile(b".*\\s+Y([-]*\\d+\\.*\\d*)"),
+                re.compile(b".*\\s+Z([-]*\\d+\\.*\\d*)"),
+                re.compile(b".*\\s+E([-]*\\d+\\.*\\d*)"),
+                re.compile(b".*\\s+F(\\d+\\.*\\d*)")]
+
+    def _parse_move_args_regex(self, line):
+        if self.MOVE_RE.match(line):
+            values = []
+            for regex in self.AXIS_RES:
+                m = regex.match(line)
+                values.append(float(m.groups()[0]) if m else None)
+            return tuple(values)
+
+    def _lines_per_second(self, parser):
+        start = time.perf_counter()
+        for _ in range(self.ROUNDS):
+            for line in self.LINES:
+                parser(line)
+        return self.ROUNDS * len(self.LINES) / (time.perf_counter() - start)
+
+    def test_move_tokenizer(self):
+        gcode = GCode()
+        for line in self.LINES:
+            self.assertEqual(self._parse_move_args_regex(line), gcode._parse_move_args(line))
+
+        before = self._lines_per_second(self._parse_move_args_regex)
+        after = self._lines_per_second(gcode._parse_move_args)
+        print("\nMove parsing: regex {:.0f} lines/s, tokenizer {:.0f} lines/s ({:.1f}x)".format(before, after,
+                                                                                            after / before))
+
+
+class TestMoveTable(unittest.TestCase):
+
+    LINES = [(None, b" skirt"),
+             (b"G1 X10 Y10 F7800", None),
+             (b"G1 X20 Y10 E1.0 F1200", b" outer perimeter"),
+             (b"G1 X20 Y30 E2.0 F1200", None),
+             (b"M106 S255", None),
+             (b"G1 E-0.8 F2100", None),
+             (b"G1 X5 Y40 F7800", b" infill"),
+             (b"G1 X50 Y2 E3.0 F1800", None),
+             (b"G1 X50 Y12 E0.5 F1000", b" outer perimeter")]
+
+    def setUp(self):
+        self.layer = layer.Layer(0, 0.2, 0.2)
+        for cmd, comment in self.LINES:
+            self.layer.add_line(cmd, comment)
+
+    def _check(self):
+        moves = self.layer.moves
+        self.assertEqual(7, len(moves))
+        self.assertEqual((50, 20, 30, 2), moves.extrusion_bounds())
+        speed, feed_rate = moves.perimeter_rates({2, 8})
+        self.assertAlmostEqual(1133.333, speed, places=3)
+        self.assertAlmostEqual((0.1 + 0.1 + 0.5 / math.hypot(45, 28)) / 3, feed_rate)
+        self.assertAlmostEqual(10 + 20 + math.hypot(15, 10) + math.hypot(45, 38) + 10, moves.path_length())
+
+    def test_queries(self):
+        self._check()
+
+    def test_queries_without_numpy(self):
+        with mock.patch.object(move_table, "numpy", None):
+            self._check()
+
+    def test_insert_lines(self):
+        def nested():
+            yield b"G1 X1 Y1", b" nested"
+            yield b"G4 S0"
+
+        def tower():
+            yield None, b" TOWER START"
+            yield None
+            yield b"M104 S200"
+            yield nested()
+            yield (c for c in [b"G1 E1", b"G1 E-1"]), b" gen"
+
+        count = self.layer.insert_lines(2, tower())
+        self.assertEqual(6, count)
+        self.assertEqual(len(self.LINES) + 6, len(self.layer.lines))
+        self.assertEqual([(None, b" TOWER START"), (b"M104 S200", None), (b"G1 X1 Y1", b" nested"),
+                          (b"G4 S0", None), (b"G1 E1", b" gen"), (b"G1 E-1", b" gen")],
+                         [(l.cmd, l.comment) for l in self.layer.lines[2:8]])
+        self.assertEqual(self.LINES[2], (self.layer.lines[8].cmd, self.layer.lines[8].comment))
+
+    def test_rebuild_after_edit(self):
+        self.layer.delete_line(4)
+        self.layer.insert_line(1, b"G1 X0 Y0 E0.1", None)
+        self.assertEqual(8, len(self.layer.moves))
+        self.assertEqual((50, 0, 30, 0), self.layer.moves.extrusion_bounds())
+        self.assertEqual(list(range(1, 9)), list(self.layer.moves.index))
+
+    def test_parse_time_bounds(self):
+        self.assertEqual((50, 20, 30, 2), self.layer.extrusion_bounds())
+        # bounds collected while parsing are dropped on edits
+        self.layer.insert_line(1, b"G1 X0 Y0 E0.1", None)
+        self.assertEqual((50, 0, 30, 0), self.layer.extrusion_bounds())
+
+
+class TestLineBuffer(unittest.TestCase):
+
+    def test_matches_list(self):
+        rnd = random.Random(1)
+        expected = list(range(50))
+        buffer = layer.LineBuffer(expected)
+        for i in range(2000):
+            op = rnd.randrange(4)
+            index = rnd.randrange(-len(expected) - 2, len(expected) + 2) if expected else 0
+            if op == 0:
+                expected.insert(index, i)
+                buffer.insert(index, i)
+            elif op == 1 and expected and -len(expected) <= index < len(expected):
+                self.assertEqual(expected.pop(index), buffer.pop(index))
+            elif op == 2:
+                expected.append(i)
+                buffer.append(i)
+            elif expected and -len(expected) <= index < len(expected):
+                expected[index] = -i
+                buffer[index] = -i
+                self.assertEqual(expected[index], buffer[index])
+        self.assertEqual(len(expected), len(buffer))
+        self.assertEqual(expected, list(buffer))
+        self.assertEqual(expected[3:10], buffer[3:10])
+        self.assertRaises(IndexError, buffer.__getitem__, len(expected))
+
+    def test_edit_while_iterating(self):
+        expected = list(range(20))
+        buffer = layer.LineBuffer(expected)
+        # move the gap to the middle
+        buffer.insert(10, 100)
+        expected.insert(10, 100)
+        seen = []
+        expected_seen = []
+        for lines, out in ((buffer, seen), (expected, expected_seen)):
+            for index, line in enumerate(lines):
+                out.append(line)
+                if line in (5, 15) and lines[index - 2] >= 0:
+                    # current line moves one forward and is seen again
+                    lines[index - 2] = -line
+                    lines.insert(index - 3, 200 + line)
+                elif line == 100:
+                    lines.insert(index + 1, 300)
+        self.assertEqual(expected_seen, seen)
+        self.assertEqual(expected, list(buffer))
+
+
+class TestSimplify3d(unittest.TestCase):
+
+    def test_fix_retract_during_wipe(self):
+        s = settings.Settings()
+        s.default_speed = 3000
+        pf = Simplify3dGCodeFile(logging.getLogger("s3d"), s)
+        pf.version = (3, 1, 1)
+        pf.retract_while_wiping = True
+        ext = extruder.Extruder(0)
+        ext.retract = 1.0
+        ext.retract_speed = 1800
+        pf.extruders = {0: ext}
+        lay = layer.Layer(1, 0.2, 0.2)
+        for cmd in [b"G1 X10 Y10 E1 F1200", b"G1 X20 Y10 E-0.5", b"G1 X30 Y10 E-0.5", b"G1 X40 Y10 F6000",
+                    b"G1 X40 Y20 E1", b"G1 X50 Y20 E-0.5", b"G1 X60 Y20 E-0.5", b"G1 X60 Y30 F6000", b"T0",
+                    b"G1 X70 Y30 E1"]:
+            lay.add_line(cmd)
+        pf.layers = [lay]
+        pf.fix_retract_during_wipe()
+        self.assertEqual([b"G1 X10 Y10 E1 F1200", b"G1 E-1.0000 F1800", b"G1 X20.000 Y10.000 F3000",
+                          b"G1 X30.000 Y10.000 F3000", b"G1 X40 Y10 F6000", b"G1 X40 Y20 E1", b"G1 E-1.0000 F1800",
+                          b"G1 X50.000 Y20.000 F6000", b"G1 X60.000 Y20.000 F6000", b"G1 X60 Y30 F6000", b"T0",
+                          b"G1 X70 Y30 E1"], [line.cmd for line in lay.lines])
+
+
+class TestLineIndex(unittest.TestCase):
+
+    LINES = [(b"G28", None),
+             (None, b" START SCRIPT END"),
+             (b"M900 K0.2", None),
+             (None, b" TOOL CHANGE"),
+             (b"T1", None),
+             (b"G1 X10 Y10 E1", None),
+             (None, b" TOOL CHANGE"),
+             (b"T0", None),
+             (None, b" END SCRIPT START"),
+             (b"T1", None)]
+
+    def setUp(self):
+        self.layer = layer.Layer(1, 0.4, 0.2)
+        for cmd, comment in self.LINES:
+            self.layer.add_line(cmd, comment)
+
+    def _scan(self, key):
+        if key in layer.LineIndex.OPCODES:
+            return [i for i, line in enumerate(self.layer.lines) if line.opcode == key]
+        return [i for i, line in enumerate(self.layer.lines) if line.comment and key in line.comment]
+
+    def _check(self):
+        for key in layer.LineIndex.OPCODES + (layer.LineIndex.START_SCRIPT_END, layer.LineIndex.END_SCRIPT_START):
+            self.assertEqual(self._scan(key), self.layer.offsets.get(key))
+
+    def test_offsets_follow_edits(self):
+        self._check()
+        self.assertEqual(1, self.layer.offsets.first(layer.LineIndex.START_SCRIPT_END))
+        self.layer.insert_lines(4, [(b"T2", None), (b"M572 D0 S0.1", None)])
+        self._check()
+        self.layer.insert_line(0, b"T3", None)
+        self._check()
+        self.layer.delete_line(5)
+        self._check()
+        self.layer.replace_line(-1, b"G1 X1 Y1", None)
+        self._check()
+
+    def test_has_tool_changes(self):
+        self.assertEqual(2, self.layer.has_tool_changes())
+        self.assertEqual(2, self.layer.has_tool_changes())
+
+        first = layer.FirstLayer(0, 0.2, 0.2)
+        for cmd, comment in self.LINES:
+            first.add_line(cmd, comment)
+        first.start_gcode_end = 5
+        self.assertEqual(2, first.has_tool_changes())
+
+
+class TestSlicerConfig(unittest.TestCase):
+
+    def test_key_values(self):
+        comments = [b" bed_shape = 0x0,250x0,250x210,0x210", b" filament_type = PLA;PETG", b" notes =",
+                    b" layer_height = 0.2", b" TOOL CHANGE", b" layer_height = 0.15"]
+        config = slicer_config.SlicerConfig.from_comments(comments, b"=")
+        self.assertEqual(4, len(config))
+        self.assertEqual(b"", config.get(b"notes"))
+        self.assertEqual(0.15, config.get_float(b"layer_height"))
+        self.assertEqual([b"PLA", b"PETG"], config.get_list(b"filament_type", separator=b";"))
+        self.assertEqual(4, len(config.get_list(b"bed_shape")))
+        self.assertNotIn(b"TOOL CHANGE", config)
+        self.assertEqual(1, config.get_int(b"brim_width", 1))
+        self.assertEqual([], config.get_list(b"brim_width", float))
+
+    def test_sections(self):
+        comments = [b" num_extruders = 2", b" *** Material Settings for Extruder 1 ***", b" temperature_C = 210",
+                    b" *** Material Settings for Extruder 2 ***", b" temperature_C = 240"]
+        section_re = re.compile(rb".*Material Settings for Extruder (\d+)")
+        config = slicer_config.SlicerConfig.from_comments(comments, b"=", section_re)
+        self.assertEqual(2, config.get_int(b"num_extruders"))
+        self.assertEqual(240, config.get_int(b"temperature_C"))
+        self.assertEqual({b"1", b"2"}, set(config.sections))
+        self.assertEqual(210, config.sections[b"1"].get_int(b"temperature_C"))
+        self.assertNotIn(b"num_extruders", config.sections[b"1"])
+
+    def test_s3d_values(self):
+        comments = [b" G-Code generated by Simplify3D(R) Version 4.0.1", b"   extruderUseRetract,1,0",
+                    b"   printMaterial,PLA"]
+        config = slicer_config.SlicerConfig.from_comments(comments, b",")
+        self.assertEqual([True, False], config.get_list(b"extruderUseRetract", slicer_config.to_bool))
+        self.assertEqual(b"PLA", config.get(b"printMaterial"))
+
+
+class TestGCodeReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "test.gcode")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def test_lines_match_strip(self):
+        data = b"G28\r\n\r\n  G1 X1 Y2 ; move \t\r\n\t\n;comment\nM107 \x0b\x0c\n   \nG1 E1"
+        self._write(data)
+        reader = gcode_io.GCodeReader(self.path)
+        expected = [l.strip() for l in data.split(b"\n") if l.strip()]
+        self.assertEqual(list(reader), expected)
+        # reader can be iterated again
+        self.assertEqual(list(reader), expected)
+
+    def test_empty_file(self):
+        self._write(b"")
+        self.assertEqual(list(gcode_io.GCodeReader(self.path)), [])
+        self._write(b"\r\n  \n")
+        self.assertEqual(list(gcode_io.GCodeReader(self.path)), [])
+
+
+class FixedSettings(settings.Settings):
+    # TestSettings changes the class attribute of Settings
+    HW_CFG_DIR = "hw_configurations"
+
+
+def prusa_settings():
+    """
+    Settings for processing generate_prusa_gcode output
+    :return: FixedSettings object
+    """
+    s = FixedSettings()
+    s.hw_config = "PRUSAMMU2-PLA"
+    s.tower_position = settings.AUTO
+    s.tower_force = "0,0"
+    return s
+
+
+def generate_prusa_gcode(layers, moves_per_tool=200, seed=1, tool_orders=None, parts=((100, 100), (115, 100)),
+                         part_size=10, first_layer=()):
+    """
+    Generate Prusa Slic3r style g-code with tool changes on every layer. By default tool 0 prints at
+    X100-110, tool 1 at X115-125
+    :param layers: number of layers
+    :param moves_per_tool: extrusion moves per tool and layer
+    :param seed: random seed
+    :param tool_orders: tool order for each layer, default (0, 1)
+    :param parts: x, y of the lower left corner of the part of each tool
+    :param part_size: part width and depth
+    :param first_layer: lines printed on the first layer before the parts
+    :return: g-code as bytes
+    """
+    rnd = random.Random(seed)
+    out = ["; generated by Slic3r 1.41.0+linux64 on 2018-09-01 at 12:00:00 https://prusa3d.com",
+           "M107", "M104 S215", "G28 W", "G21", "G90", "M83", "T0",
+           "G1 Z0.2 F720", "G1 X60 Y-3 F1000", "G1 X100 E12.5 F1000", ";START SCRIPT END"]
+    tool = 0
+    for n in range(layers):
+        z = round(0.2 + n * 0.2, 2)
+        out += [";BEFORE_LAYER_CHANGE %d %s" % (n, z), "G92 E0", "G1 E-0.8 F2100", "G1 Z%.3f F10800" % z]
+        if n == 0:
+            out += first_layer
+        for t in tool_orders[n] if tool_orders else (0, 1):
+            if t != tool:
+                out += ["G1 E-0.8 F2100", ";TOOL CHANGE", "T%d" % t]
+                tool = t
+            cx, cy = parts[t]
+            out += ["G1 X%.3f Y%.3f F10800" % (cx, cy), "G1 E0.8 F2100", "; outer perimeter"]
+            for _ in range(moves_per_tool):
+                out.append("G1 X%.3f Y%.3f E%.5f F2400" % (cx + rnd.random() * part_size,
+                                                          cy + rnd.random() * part_size, rnd.random()))
+    out += ["M107", "; END SCRIPT START", "M104 S0", "M84",
+            "; bed_shape = 0x0,250x0,250x210,0x210", "; brim_width = 3",
+            "; external_perimeter_extrusion_width = 0.45", "; external_perimeter_speed = 25",
+            "; extrusion_multiplier = 1,1", "; filament_type = PLA;PLA", "; first_layer_speed = 20",
+            "; first_layer_temperature = 215,215", "; layer_height = 0.2", "; nozzle_diameter = 0.4,0.4",
+            "; perimeter_speed = 40", "; retract_length = 0.8,0.8", "; retract_lift = 0,0",
+            "; retract_speed = 35,35", "; temperature = 215,215", "; travel_speed = 180",
+            "; use_relative_e_distances = 1", "; wipe = 0,0", "; z_offset = 0"]
+    return "\r\n".join(out).encode() + b"\r\n"
+
+
+class BenchmarkStreaming(unittest.TestCase):
+    """
+    Processes the same file in memory and in streaming mode. Outputs must be identical.
+    Prints peak memory of both modes
+    """
+
+    LAYERS = 80
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gcode_file = os.path.join(self.tmp_dir, "bench.gcode")
+        with open(self.gcode_file, "wb") as f:
+            f.write(generate_prusa_gcode(self.LAYERS))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _process(self, stream):
+        s = prusa_settings()
+        s.stream = stream
+        tracemalloc.start()
+        result = PrusaSlic3rCodeFile(logging.getLogger("benchmark"), s).process(self.gcode_file)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        with open(result, "rb") as f:
+            return f.read(), peak
+
+    def test_streaming_memory(self):
+        in_memory, memory_peak = self._process(False)
+        streamed, stream_peak = self._process(True)
+        self.assertEqual(in_memory, streamed)
+        self.assertLess(stream_peak, memory_peak)
+        print("\nPeak memory for {} kB file: in memory {:.0f} kB, streaming {:.0f} kB".format(
+            os.path.getsize(self.gcode_file) // 1024, memory_peak / 1024, stream_peak / 1024))
+
+
+class BenchmarkTowerTemplates(unittest.TestCase):
+    """
+    Processes the same file with and without the tower template cache. Outputs must be identical.
+    Prints tool change g-code generation times
+    """
+
+    LAYERS = 80
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gcode_file = os.path.join(self.tmp_dir, "bench.gcode")
+        with open(self.gcode_file, "wb") as f:
+            f.write(generate_prusa_gcode(self.LAYERS))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _process(self):
+        s = prusa_settings()
+        pf = PrusaSlic3rCodeFile(logging.getLogger("benchmark"), s)
+        add_tool_change_gcode = pf.add_tool_change_gcode
+        run_time = []
+
+        def timed():
+            start = time.perf_counter()
+            add_tool_change_gcode()
+            run_time.append(time.perf_counter() - start)
+
+        pf.add_tool_change_gcode = timed
+        result = pf.process(self.gcode_file)
+        with open(result, "rb") as f:
+            return f.read(), run_time[0], len(pf.switch_tower.templates)
+
+    def test_templates(self):
+        with mock.patch.object(switch_tower.SwitchTower, "get_template_lines",
+                               lambda tower, key, generator, *args: generator(*args)):
+            generated, generate_time, _ = self._process()
+        replayed, replay_time, templates = self._process()
+        self.assertEqual(generated, replayed)
+        self.assertGreater(templates, 0)
+        print("\nTool change g-code: generated {:.3f} s, {} templates replayed {:.3f} s".format(
+            generate_time, templates, replay_time))
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lru_limit(self):
+        # room for three entries
+        cache = parse_cache.ParseCache(self.cache_dir, 13000)
+        data = os.urandom(4000)
+        for n in range(3):
+            cache.store(str(n), data)
+            # make entry use times differ
+            os.utime(os.path.join(self.cache_dir, str(n) + parse_cache.CACHE_EXT), (n, n))
+        self.assertEqual(data, cache.load("0"))
+        cache.store("3", data)
+        # least recently used entry is removed
+        self.assertIsNone(cache.load("1"))
+        self.assertEqual(data, cache.load("0"))
+        self.assertEqual(data, cache.load("3"))
+
+    def test_invalidate(self):
+        cache = parse_cache.ParseCache(self.cache_dir, 10000)
+        cache.store("a", 1)
+        cache.store("b", 2)
+        cache.invalidate("a")
+        self.assertIsNone(cache.load("a"))
+        self.assertEqual(2, cache.load("b"))
+        with open(os.path.join(self.cache_dir, "c" + parse_cache.CACHE_EXT), "wb") as f:
+            f.write(b"broken")
+        self.assertIsNone(cache.load("c"))
+        cache.invalidate()
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_reprocess_from_cache(self):
+        gcode_file = os.path.join(self.tmp_dir, "cache.gcode")
+        with open(gcode_file, "wb") as f:
+            f.write(generate_prusa_gcode(10, moves_per_tool=20))
+
+        def process(purge_lines):
+            s = prusa_settings()
+            s.purge_lines = purge_lines
+            s.cache_dir = self.cache_dir
+            with self.assertLogs("cache", "INFO") as logs:
+                result = PrusaSlic3rCodeFile(logging.getLogger("cache"), s).process(gcode_file)
+            with open(result, "rb") as f:
+                return f.read(), any("cached parse results" in line for line in logs.output)
+
+        first, hit = process(6)
+        self.assertFalse(hit)
+        self.assertEqual((first, True), process(6))
+        other, hit = process(10)
+        self.assertTrue(hit)
+        self.assertNotEqual(first, other)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for n in range(2):
+            with open(os.path.join(self.tmp_dir, "plate%d.gcode" % n), "wb") as f:
+                f.write(generate_prusa_gcode(5 + n, moves_per_tool=10, seed=n))
+        with open(os.path.join(self.tmp_dir, "unknown.gcode"), "wb") as f:
+            f.write(b"; unknown slicer\r\nG28\r\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_batch(self):
+        s = prusa_settings()
+        files = batch.find_files(self.tmp_dir)
+        self.assertEqual(["plate0.gcode", "plate1.gcode", "unknown.gcode"], [os.path.basename(f) for f in files])
+
+        results = batch.run_batch(files, s, jobs=2)
+        self.assertEqual(files, [r.path for r in results])
+        self.assertIsNone(results[0].error)
+        self.assertTrue(os.path.exists(results[1].new_file))
+        # first layer switches once, the others twice
+        self.assertEqual(11, results[1].tool_changes)
+        self.assertIn("No supported gcode file", results[2].error)
+        table = batch.format_summary(results)
+        self.assertEqual(5, len(table))
+        self.assertIn("3 files, 1 failed", table[-1])
+
+        # processed files are skipped
+        self.assertEqual(files, batch.find_files(self.tmp_dir))
+        self.assertEqual(files, batch.find_files(os.path.join(self.tmp_dir, "*.gcode")))
+        self.assertEqual(files[:2], batch.find_files(os.path.join(self.tmp_dir, "plate?.gcode")))
+
+
+class TestToolOrder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gcode_file = os.path.join(self.tmp_dir, "plate.gcode")
+        with open(self.gcode_file, "wb") as f:
+            f.write(generate_prusa_gcode(6, moves_per_tool=10))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_order_blocks(self):
+        blocks = []
+        for tool, support in ((1, True), (0, True), (0, False), (1, False), (0, False)):
+            block = tool_order.ToolBlock(tool, len(blocks), len(blocks))
+            block.support = support
+            blocks.append(block)
+        ordered = tool_order.order_blocks(blocks, 0)
+        # supports stay before the model, blocks of a tool are printed together
+        self.assertEqual([blocks[i] for i in (1, 0, 3, 2, 4)], ordered)
+        self.assertEqual((2, 0), tool_order.count_tool_changes([b.tool for b in ordered], 0))
+        self.assertEqual((4, 0), tool_order.count_tool_changes([b.tool for b in blocks], 0))
+
+    def test_optimize(self):
+        s = prusa_settings()
+        result = batch.process_file(self.gcode_file, s)
+        self.assertEqual(11, result.tool_changes)
+
+        s.optimize_tool_order = True
+        s.stream = True
+        result = batch.process_file(self.gcode_file, s)
+        self.assertIsNone(result.error)
+        # each layer starts with the tool the previous one ended with
+        self.assertEqual(6, result.tool_changes)
+        self.assertEqual(5, result.tool_changes_saved)
+        with open(result.new_file, "rb") as f:
+            output = f.read()
+        # same extrusions in different order
+        with open(self.gcode_file, "rb") as f:
+            moves = sorted(l for l in f.read().splitlines() if l.endswith(b"F2400"))
+        self.assertEqual(moves, sorted(l for l in output.splitlines() if l.endswith(b"F2400")))
+
+    def test_active_tool(self):
+        # third layer starts without a tool change, with the tool the slicer left active
+        with open(self.gcode_file, "wb") as f:
+            f.write(generate_prusa_gcode(4, moves_per_tool=10, tool_orders=((0, 1), (0, 1), (1, 0), (1, 0))))
+        s = prusa_settings()
+        s.optimize_tool_order = True
+        result = batch.process_file(self.gcode_file, s)
+        self.assertIsNone(result.error)
+        self.assertEqual(4, result.tool_changes)
+        self.assertEqual(2, result.tool_changes_saved)
+
+        tool = None
+        extrusions = 0
+        with open(result.new_file, "rb") as f:
+            for line in f.read().splitlines():
+                line = GCodeLine(*GCode.read_gcode_line(line))
+                if line.opcode == b"T":
+                    tool = line.tool
+                elif line.comment is None and line.f == 2400 and line.e:
+                    # tool 0 prints at X100-110, tool 1 at X115-125
+                    self.assertEqual(0 if line.x < 115 else 1, tool, line.cmd)
+                    extrusions += 1
+        self.assertEqual(4 * 2 * 10, extrusions)
+
+
+class TestOccupancyGrid(unittest.TestCase):
+
+    def test_free_rectangles(self):
+        grid = occupancy.OccupancyGrid(0, 0, 100, 60)
+        # two parts with a gap between them
+        for x in (10, 70):
+            grid.add_segment(x, 10, x + 20, 10)
+            grid.add_segment(x + 20, 10, x + 20, 50)
+            grid.add_segment(x + 20, 50, x, 50)
+            grid.add_segment(x, 50, x, 10)
+        grid.dilate(3)
+        positions = list(grid.free_rectangles(20, 20))
+        self.assertIn((40, 20), positions)
+        for x, y in positions:
+            for part_x in (10, 70):
+                overlap = x < part_x + 24 and x + 20 > part_x - 3 and y < 54 and y + 20 > 7
+                self.assertFalse(overlap, (x, y))
+        self.assertEqual([], list(grid.free_rectangles(50, 20)))
+
+    def _assert_tower_clear(self, pf, result):
+        """
+        Check that tower extrusions of the processed file stay inside the tower footprint and off the print
+        :param pf: processed gcode file object
+        :param result: processed file path
+        """
+        tower = pf.switch_tower
+        x_min, y_min, x_max, y_max = tower._tower_footprint(tower.E)
+        x_min += tower.start_pos_x - 0.01
+        x_max += tower.start_pos_x + 0.01
+        y_min += tower.start_pos_y - 0.01
+        y_max += tower.start_pos_y + 0.01
+        # fine cells to see the gap between the brim and the print
+        model = occupancy.OccupancyGrid(-10, -10, 260, 220, 0.25)
+        tower_grid = occupancy.OccupancyGrid(-10, -10, 260, 220, 0.25)
+        estimator = time_estimator.TimeEstimator(None)
+        depth = 0
+        with open(result, "rb") as f:
+            for line in f.read().splitlines():
+                line = GCodeLine(*GCode.read_gcode_line(line))
+                comment = line.comment.strip() if line.comment else b""
+                if comment.startswith(b"TOWER") and comment.endswith(b"START"):
+                    depth += 1
+                elif comment.startswith(b"TOWER") and comment.endswith(b"END"):
+                    depth -= 1
+                x, y = estimator.position[:2]
+                estimator.add_line(line)
+                if line.e and line.e > 0 and (line.x is not None or line.y is not None):
+                    end_x, end_y = estimator.position[:2]
+                    if depth:
+                        tower_grid.add_segment(x, y, end_x, end_y)
+                        for px, py in ((x, y), (end_x, end_y)):
+                            self.assertTrue(x_min <= px <= x_max and y_min <= py <= y_max, line.to_bytes())
+                    else:
+                        model.add_segment(x, y, end_x, end_y)
+        model.dilate(pf.settings.extrusion_width)
+        self.assertEqual(0, int.from_bytes(model.cells, "little") & int.from_bytes(tower_grid.cells, "little"))
+
+    def _auto_tower_footprint(self, gcode):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            gcode_file = os.path.join(tmp_dir, "plate.gcode")
+            with open(gcode_file, "wb") as f:
+                f.write(gcode)
+            pf = PrusaSlic3rCodeFile(logging.getLogger("test"), prusa_settings())
+            # no room next to the print
+            with mock.patch.object(switch_tower.SwitchTower, "_cartesian_positions", lambda tower, *args: iter([])):
+                result = pf.process(gcode_file)
+            self._assert_tower_clear(pf, result)
+        finally:
+            shutil.rmtree(tmp_dir)
+        tower = pf.switch_tower
+        x_min, y_min, x_max, y_max = tower._tower_footprint(tower.E)
+        return (x_min + tower.start_pos_x, y_min + tower.start_pos_y,
+                x_max + tower.start_pos_x, y_max + tower.start_pos_y)
+
+    def test_tower_position(self):
+        gcode = generate_prusa_gcode(6)
+        x_min, y_min, x_max, y_max = self._auto_tower_footprint(gcode)
+        for line in gcode.splitlines():
+            line = GCodeLine(*GCode.read_gcode_line(line))
+            if line.e and line.x is not None and line.y is not None:
+                self.assertFalse(x_min < line.x < x_max and y_min < line.y < y_max, line.to_bytes())
+
+    def test_first_layer_brim(self):
+        # brim connects the parts at X20-60 and X140-180, tool changes are around the gap between them
+        brim = []
+        for y in range(20, 61):
+            brim += ["G1 X60 Y%d F10800" % y, "G1 X140 Y%d E2.5 F1200" % y]
+        gcode = generate_prusa_gcode(6, moves_per_tool=50, parts=((20, 20), (140, 20)), part_size=40,
+                                     first_layer=brim)
+        x_min, y_min, x_max, y_max = self._auto_tower_footprint(gcode)
+        self.assertFalse(x_min < 140 and x_max > 60 and y_min < 60 and y_max > 20, (x_min, y_min, x_max, y_max))
+
+    def test_travel_position(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            gcode_file = os.path.join(tmp_dir, "plate.gcode")
+            with open(gcode_file, "wb") as f:
+                f.write(generate_prusa_gcode(6))
+            travel = {}
+            for position in (settings.AUTO, settings.TOP, settings.BOTTOM):
+                s = prusa_settings()
+                s.tower_position = position
+                pf = PrusaSlic3rCodeFile(logging.getLogger("test"), s)
+                if position == settings.AUTO:
+                    fill_occupancy_grid = pf.fill_occupancy_grid
+
+                    def fill_grid(grid):
+                        # positions before and after the tool changes
+                        points.extend((x, y, 1) for x, y in fill_occupancy_grid(grid))
+                        return [p[:2] for p in points]
+
+                    points = []
+                    pf.fill_occupancy_grid = fill_grid
+                result = pf.process(gcode_file)
+                self._assert_tower_clear(pf, result)
+                tower = pf.switch_tower
+                if position == settings.BOTTOM:
+                    self.assertEqual(180, tower.E)
+                travel[position] = tower._travel_distance((position, tower.start_pos_x, tower.start_pos_y, tower.E),
+                                                          points)
+            # positions before and after each tool change, also on the first layer
+            self.assertEqual(22, len(points))
+            self.assertLessEqual(travel[settings.AUTO], min(travel[settings.TOP], travel[settings.BOTTOM]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestTimeEstimator(unittest.TestCase):
+
+    def _estimate(self, lines, hw=None):
+        estimator = time_estimator.TimeEstimator(hw)
+        for line in lines:
+            estimator.add_line(GCodeLine(*GCode.read_gcode_line(line)))
+        estimator.finish()
+        return estimator
+
+    def test_moves(self):
+        # 100 mm/s moves with 1000 mm/s^2 acceleration and 10 mm/s jerk, reversal at 5 mm/s
+        estimator = self._estimate([b"G90", b"M83", b"G1 X100 F6000", b"G1 X0", b"G4 P500", b"G91",
+                                    b"G1 X10 F600"])
+        self.assertAlmostEqual(3.686, estimator.total_time, places=3)
+        # absolute and relative positioning
+        self.assertEqual([10, 0, 0, 0], estimator.position)
+
+        hw = mock.Mock(acceleration=500.0, retract_acceleration=None, junction_deviation=0.05, jerk_xy=None,
+                       jerk_z=None, jerk_e=None)
+        estimator = self._estimate([b"G1 X100 F6000", b"G1 X0"], hw)
+        # reversal stops with junction deviation
+        self.assertAlmostEqual(2 * (2 * 0.2 + 80 / 100), estimator.total_time, places=5)
+
+    def test_sections(self):
+        lines = [b"M83", b"G1 X10 E1 F600", b";TOWER START", b"G1 E-5 F3000", b"G4 S2", b"G1 E5",
+                 b";TOWER END", b";TOWER INFILL START", b"G1 X20 E1 F600", b";TOWER INFILL END", b";TOWER START",
+                 b"G4 P1500", b";TOWER END"]
+        estimator = self._estimate(lines)
+        times = estimator.section_times
+        self.assertAlmostEqual(estimator.total_time, sum(times.values()))
+        self.assertEqual(2, len(estimator.tool_change_times))
+        self.assertAlmostEqual(1.5, estimator.tool_change_times[1])
+        self.assertAlmostEqual(sum(estimator.tool_change_times), times[time_estimator.SECTION_TOWER])
+        self.assertAlmostEqual(1.006, times[time_estimator.SECTION_INFILL], places=3)
+        self.assertIn("2 tool changes", estimator.format_report()[-1])
+
+    def test_progress(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "plate.gcode")
+            with open(path, "wb") as f:
+                f.write(b"M73 P0 R5\r\n" + b"\r\n".join(b"G1 X%d F600" % (10 * (n % 2)) for n in range(13)))
+            time_estimator.add_progress(path, 12.0)
+            with open(path, "rb") as f:
+                lines = f.read().split(b"\r\n")
+        finally:
+            shutil.rmtree(tmp_dir)
+        progress = [line for line in lines if line.startswith(b"M73")]
+        self.assertEqual(b"M73 P0 R1", progress[0])
+        self.assertEqual(b"M73 P100 R0", progress[-1])
+        self.assertEqual(13, len(lines) - len(progress))
+        self.assertEqual((50, 1), time_estimator.get_progress(30, 60))
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmp_dir, "old.gcode"), "wb") as f:
+            f.write(generate_prusa_gcode(3, moves_per_tool=10))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_new_files(self):
+        s = prusa_settings()
+        uploaded = []
+        log = logging.getLogger("filaswitch.test.watch")
+        watcher = watch.FolderWatcher(self.tmp_dir, s, log, settle_time=0, uploader=uploaded.append)
+        watcher.skip_existing()
+
+        data = generate_prusa_gcode(4, moves_per_tool=10)
+        new_path = os.path.join(self.tmp_dir, "new.gcode")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            with open(new_path, "wb") as f:
+                f.write(data[:len(data) // 2])
+            watcher.poll(executor)
+            self.assertEqual({}, watcher._running)
+            # size changed, file is still being written
+            with open(new_path, "ab") as f:
+                f.write(data[len(data) // 2:])
+            watcher.poll(executor)
+            self.assertEqual({}, watcher._running)
+            watcher.poll(executor)
+            self.assertEqual([new_path], list(watcher._running.values()))
+            concurrent.futures.wait(list(watcher._running))
+            watcher.poll(executor)
+
+        self.assertEqual({}, watcher._running)
+        self.assertEqual([os.path.join(self.tmp_dir, "new_fs.gcode")], uploaded)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "old_fs.gcode")))
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        s = prusa_settings()
+        self.httpd = server.create_server(s, logging.getLogger("filaswitch.test.server"), jobs=1, port=0)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+
+    def _request(self, method, path, body=None):
+        conn = http.client.HTTPConnection(*self.httpd.server_address)
+        try:
+            conn.request(method, path, body)
+            response = conn.getresponse()
+            return response, response.read()
+        finally:
+            conn.close()
+
+    def test_process(self):
+        data = generate_prusa_gcode(4, moves_per_tool=10)
+        response, body = self._request("POST", "/process?hw_config=PRUSAMMU2-PLA&lines=4", data)
+        self.assertEqual(200, response.status)
+        self.assertIn(b"TOWER", body)
+        self.assertEqual("7", response.getheader("X-Filaswitch-Tool-Changes"))
+        self.assertIn("process;dur=", response.getheader("Server-Timing"))
+
+        response, body = self._request("POST", "/process?hw_config=unknown", data)
+        self.assertEqual(400, response.status)
+        response, body = self._request("POST", "/process?hw_config=PRUSAMMU2-PLA", b"; unknown slicer\r\n")
+        self.assertEqual(422, response.status)
+
+        response, body = self._request("GET", "/status")
+        status = json.loads(body.decode())
+        self.assertEqual(2, status["requests"])
+        self.assertEqual(1, status["failed"])
+        self.assertIn("PRUSAMMU2-PLA", status["hw_configs"])
+
+
+class BenchmarkPreTowerRetract(unittest.TestCase):
+    """
+    Pre-tower retracts are moved right after the latest head or extrusion move. Compares the single pass
+    relocation against the original list based version and prints the run times
+    """
+
+    @staticmethod
+    def _relocate_with_list(lines):
+        lines = list(lines)
+        index = 0
+        last_pos_index = -1
+        while index < len(lines):
+            line = lines[index]
+            if line.head_move() or line.extrusion_move():
+                last_pos_index = index
+            if line.comment == b" pre-tower retract" and last_pos_index != -1 and index != last_pos_index + 1:
+                lines.pop(index)
+                lines.insert(last_pos_index + 1, line)
+            index += 1
+        return lines
+
+    def test_relocation(self):
+        rnd = random.Random(3)
+        choices = [(b"G1 X1 Y1 E0.1", None), (b"G1 X2 Y2", None), (b"G1 Z1", None), (b"M107", None),
+                   (None, b" comment"), (b"G1 E-0.8 F2100", b" pre-tower retract"), (b"T1", None)]
+        lines = [GCodeLine(*rnd.choice(choices)) for _ in range(20000)]
+        gf = PrusaSlic3rCodeFile(logging.getLogger("benchmark"), FixedSettings())
+
+        start = time.perf_counter()
+        expected = self._relocate_with_list(lines)
+        list_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = list(gf.add_tool_change_gcode_post(lines))
+        pass_time = time.perf_counter() - start
+
+        self.assertEqual([id(l) for l in result], [id(l) for l in expected])
+        print("\nPre-tower retract relocation: list {:.3f} s, single pass {:.3f} s".format(list_time, pass_time))
+
+
+class BenchmarkImportTime(unittest.TestCase):
+    """
+    Cold start of the command line entry point, measured with python -X importtime. The GUI module imports
+    tkinter, octoprint and the slicer modules like the entry point did before the GUI was split out of it
+    """
+
+    @staticmethod
+    def _import_time(module):
+        src_dir = os.path.dirname(os.path.realpath(__file__))
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd=src_dir,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        modules = {}
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                modules[name.strip()] = int(cumulative)
+        return modules
+
+    def test_cli_import(self):
+        cli = self._import_time("filaswitch")
+        for module in ("tkinter", "octoprint", "slicer_prusa_slic3r", "gcode_file"):
+            self.assertNotIn(module, cli)
+        gui = self._import_time("gui")
+        print("\nImport time: command line {:.1f} ms, GUI {:.1f} ms".format(cli["filaswitch"] / 1000,
+                                                                         gui["gui"] / 1000))
+
+
 class TestSettings(unittest.TestCase):
 
     def setUp(self):
@@ -170,3 +1156,85 @@ class TestSettings(unittest.TestCase):
         # TODO: should this raise exception?
         result = self.settings.get_hw_config_bool_value("does.not.exist")
         self.assertFalse(result)
+
+    def test_compiled_hw_config(self):
+        hw = self.settings.hw
+        self.assertEqual([(20.0, 1500.0), (15.0, 1500.0)], hw.rapid_retract_initial)
+        self.assertEqual([(10.0, 1500.0), (90.0, 3000.0), (20.0, 1500.0)], hw.feed)
+        self.assertEqual([], hw.rapid_retract_cool)
+        self.assertEqual(4, hw.prepurge_sweep_count)
+        self.assertTrue(hw.temperature_use_id)
+        self.assertFalse(hw.prerun_prime)
+        self.assertFalse(hw.rapid_retract_wipe)
+        self.assertIsNone(hw.prepurge_initial_retract)
+        with self.assertRaises(AttributeError):
+            hw.unknown = 1
+
+        values = dict(self.settings.hw_configurations["testcfg"])
+        values["feed[3].length"] = "5"
+        with self.assertRaisesRegex(ValueError, "Not equal amount of feed"):
+            settings.HwConfig("broken", values)
+        del values["feed[3].length"]
+        values["prepurge.sweep.count"] = "four"
+        with self.assertRaisesRegex(ValueError, "prepurge.sweep.count"):
+            settings.HwConfig("broken", values)
+        del values["prepurge.sweep.count"]
+        with self.assertRaisesRegex(ValueError, "Missing 'prepurge.sweep.count'"):
+            settings.HwConfig("broken", values)
+
+    def test_purge_matrix(self):
+        values = dict(self.settings.hw_configurations["testcfg"])
+        self.assertEqual({}, settings.HwConfig("testcfg", values).purge_matrix)
+
+        values["purge.matrix[0]"] = "0, 40"
+        values["purge.matrix[1]"] = "80.5, 0"
+        hw = settings.HwConfig("testcfg", values)
+        self.assertEqual({(0, 0): 0, (0, 1): 40, (1, 0): 80.5, (1, 1): 0}, hw.purge_matrix)
+        self.assertEqual(settings.PURGE_MM3, hw.purge_matrix_unit)
+
+        values["purge.matrix.unit"] = "grams"
+        with self.assertRaisesRegex(ValueError, "Unknown purge.matrix.unit"):
+            settings.HwConfig("broken", values)
+        values["purge.matrix.unit"] = settings.PURGE_LINES
+        values["purge.matrix[1]"] = "80.5"
+        with self.assertRaisesRegex(ValueError, "should have 2 values"):
+            settings.HwConfig("broken", values)
+        values["purge.matrix[1]"] = "-1, 0"
+        with self.assertRaisesRegex(ValueError, "Negative"):
+            settings.HwConfig("broken", values)
+
+    def test_purge_matrix_lines(self):
+        values = dict(self.settings.hw_configurations["testcfg"])
+        values["purge.matrix.unit"] = settings.PURGE_LINES
+        values["purge.matrix[0]"] = "0, 2"
+        values["purge.matrix[1]"] = "100, 0"
+        self.settings._hw = settings.HwConfig("testcfg", values)
+        self.settings.purge_lines = 6
+        self.settings.extrusion_width = 0.45
+        tower = switch_tower.SwitchTower(logging.getLogger("test"), self.settings, 2, 0.2)
+        t0 = extruder.Extruder(0)
+        t1 = extruder.Extruder(1)
+        t0.nozzle = t1.nozzle = 0.4
+        gap, multi, lines = tower._calculate_purge_values(0.2, t1)
+        # larger than default purge has no effect
+        self.assertEqual((gap, multi, lines), tower._calculate_purge_values(0.2, t0, t1))
+        short_gap, _, short_lines = tower._calculate_purge_values(0.2, t1, t0)
+        self.assertLess(short_lines, lines)
+        self.assertGreaterEqual(short_lines, 2)
+        # fewer lines cover the same area
+        self.assertAlmostEqual(gap * (lines - 1), short_gap * (short_lines - 1))
+
+    def test_delta_left_position(self):
+        self.settings.purge_lines = 6
+        self.settings.extrusion_width = 0.45
+        self.settings.stroke_x = 200
+        self.settings.tower_position = settings.LEFT
+        tower = switch_tower.SwitchTower(logging.getLogger("test"), self.settings, 2, 0.2)
+        tower.x_mid, tower.y_mid = 0, 30
+        positions = list(tower._delta_positions(20, -20, 50, 10))
+        self.assertEqual(1, len(positions))
+        position, start_x, start_y, angle = positions[0]
+        self.assertEqual((settings.LEFT, 90), (position, angle))
+        # tower is centered next to the print, print middle is kept for the other sides
+        self.assertAlmostEqual(30 - tower.width / 2, start_y)
+        self.assertEqual(30, tower.y_mid)
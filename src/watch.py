@@ -0,0 +1,123 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+import batch
+
+
+class FolderWatcher:
+    """
+    Polls a directory for new g-code files and processes them when they are completely written, i.e.
+    file size and modification time haven't changed for settle time. Files are processed in a bounded
+    process pool, files waiting for a free worker stay pending until next poll.
+    """
+
+    def __init__(self, path, settings, log, jobs=1, interval=2.0, settle_time=2.0, uploader=None):
+        """
+        :param path: directory to watch
+        :param settings: Settings object, shared by all files
+        :param log: logger
+        :param jobs: number of worker processes
+        :param interval: poll interval in seconds
+        :param settle_time: time in seconds file must stay unchanged before processing
+        :param uploader: function called with the path of each new file, optional
+        """
+        self.path = path
+        self.settings = settings
+        self.log = log
+        self.jobs = jobs
+        self.interval = interval
+        self.settle_time = settle_time
+        self.uploader = uploader
+
+        # path: (size, mtime) of files processed or skipped
+        self._seen = {}
+        # path: (size, mtime, time when state was first seen)
+        self._pending = {}
+        # future: path
+        self._running = {}
+
+    @staticmethod
+    def _file_state(path):
+        """
+        Get file size and modification time
+        :param path: file path
+        :return: (size, mtime) or None if file is gone
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def skip_existing(self):
+        """
+        Mark files already in the directory as seen, only files that arrive later are processed
+        :return: none
+        """
+        for path in batch.find_files(self.path):
+            state = self._file_state(path)
+            if state:
+                self._seen[path] = state
+
+    def poll(self, executor):
+        """
+        Check directory once, submit settled files and report finished ones
+        :param executor: Executor to run the files in
+        :return: none
+        """
+        now = time.monotonic()
+        running = set(self._running.values())
+        for path in batch.find_files(self.path):
+            state = self._file_state(path)
+            if not state or not state[0] or self._seen.get(path) == state or path in running:
+                continue
+            pending = self._pending.get(path)
+            if pending is None or pending[:2] != state:
+                # new or still being written
+                self._pending[path] = state + (now,)
+                continue
+            if now - pending[2] < self.settle_time or len(self._running) >= self.jobs:
+                continue
+            del self._pending[path]
+            self._seen[path] = state
+            self.log.info("Processing %s" % path)
+            self._running[executor.submit(batch.process_file, path, self.settings)] = path
+
+        for future in [f for f in self._running if f.done()]:
+            del self._running[future]
+            self._report(future.result())
+
+    def _report(self, result):
+        """
+        Log result of processed file and upload the new file
+        :param result: FileResult
+        :return: none
+        """
+        if result.error:
+            self.log.error("Processing %s failed: %s" % (result.path, result.error))
+            return
+        self.log.info("New file saved: {} ({:.2f} s, {} tool changes)".format(result.new_file, result.wall_time,
+                                                                            result.tool_changes))
+        if self.uploader:
+            try:
+                self.uploader(result.new_file)
+            except Exception as e:
+                self.log.error("Upload of %s failed: %s" % (result.new_file, e))
+
+    def run(self, stop_event=None):
+        """
+        Watch directory until stop event is set
+        :param stop_event: threading.Event, runs forever if not given
+        :return: none
+        """
+        if stop_event is None:
+            stop_event = threading.Event()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            while not stop_event.is_set():
+                self.poll(executor)
+                stop_event.wait(self.interval)
+            # let running files finish
+            concurrent.futures.wait(list(self._running))
+            self.poll(executor)